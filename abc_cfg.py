@@ -1,10 +1,163 @@
 from typing_extensions import assert_never
 import source
-from typing import Collection, Mapping, NamedTuple, Sequence, TypeVar, Callable, Generic
+from typing import Any, Collection, Iterator, Mapping, NamedTuple, Sequence, TypeVar, Callable, Generic
 
 from utils import clen
 
 
+class DominatorTree(NamedTuple):
+    """ Dominator tree, numbered so that dominance is a constant time check
+
+    The nodes without predecessors (the entry, and whatever is unreachable
+    from it) are the roots: they are treated as the children of a virtual
+    root. Nodes which aren't reachable from any root (a cycle on its own) are
+    dominated by every node, as with the textbook fixpoint.
+    """
+
+    idom: Mapping[source.NodeName, source.NodeName | None]
+    """ Immediate dominator, None for the roots """
+
+    pre: Mapping[source.NodeName, int]
+    post: Mapping[source.NodeName, int]
+    """ Pre and post order numbers of a traversal of the tree """
+
+    unreachable: Collection[source.NodeName]
+
+    def dominates(self, a: source.NodeName, b: source.NodeName) -> bool:
+        if b in self.unreachable:
+            return True
+        if a in self.unreachable:
+            return False
+        return self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a]
+
+
+class Dominators(Mapping[source.NodeName, Sequence[source.NodeName]]):
+    """ all_doms, materialised (by walking up the dominator tree) and cached
+        the first time each node is looked up
+    """
+
+    def __init__(self, tree: DominatorTree, all_nodes: Collection[source.NodeName]):
+        self.tree = tree
+        self.all_nodes = all_nodes
+        self.cache: dict[source.NodeName, Sequence[source.NodeName]] = {}
+
+    def __getitem__(self, n: source.NodeName) -> Sequence[source.NodeName]:
+        if n not in self.cache:
+            if n not in self.all_nodes:
+                raise KeyError(n)
+            if n in self.tree.unreachable:
+                self.cache[n] = tuple(self.all_nodes)
+            else:
+                doms: list[source.NodeName] = []
+                d: source.NodeName | None = n
+                while d is not None:
+                    doms.append(d)
+                    d = self.tree.idom[d]
+                self.cache[n] = tuple(doms)
+        return self.cache[n]
+
+    def __iter__(self) -> Iterator[source.NodeName]:
+        return iter(self.all_nodes)
+
+    def __len__(self) -> int:
+        return len(self.all_nodes)
+
+
+class IndexedCFG(NamedTuple):
+    """ The same graph with the nodes numbered densely, for the inner loops
+
+    Node i is names[i], numbered in the order of all_succs. The edges are
+    stored in compressed sparse row form: the successors of i are
+    succ[succ_start[i]:succ_start[i + 1]] (in the same order as all_succs),
+    and succ_back[e] is 1 if the edge e is a back edge. The predecessors are
+    laid out in the same way.
+    """
+
+    names: Sequence[source.NodeName]
+    ids: Mapping[source.NodeName, int]
+
+    succ_start: Sequence[int]
+    succ: Sequence[int]
+    succ_back: bytes
+
+    pred_start: Sequence[int]
+    pred: Sequence[int]
+    pred_back: bytes
+
+    def acyclic_succs(self, i: int) -> list[int]:
+        return [self.succ[e] for e in range(self.succ_start[i], self.succ_start[i + 1]) if not self.succ_back[e]]
+
+    def acyclic_preds(self, i: int) -> list[int]:
+        return [self.pred[e] for e in range(self.pred_start[i], self.pred_start[i + 1]) if not self.pred_back[e]]
+
+    def is_back_edge(self, tail: int, head: int) -> bool:
+        for e in range(self.succ_start[tail], self.succ_start[tail + 1]):
+            if self.succ[e] == head:
+                return self.succ_back[e] == 1
+        assert False, "not an edge"
+
+    def topological_order(self) -> list[int]:
+        """ Kahn's algorithm: a node is ready once all its predecessors have
+            been visited (ignoring back edges)
+
+        The ready nodes are a stack, the latest one is visited first.
+        """
+        return self.kahn(self.pred_start, self.pred_back,
+                         self.succ_start, self.succ, self.succ_back)
+
+    def topological_order_bottom_up(self) -> list[int]:
+        """ Same, but a node is ready once all its successors have been
+            visited
+        """
+        return self.kahn(self.succ_start, self.succ_back,
+                         self.pred_start, self.pred, self.pred_back)
+
+    def kahn(self, in_start: Sequence[int], in_back: bytes, out_start: Sequence[int], out: Sequence[int], out_back: bytes) -> list[int]:
+        remaining = [in_start[i + 1] - in_start[i] - sum(in_back[in_start[i]:in_start[i + 1]])
+                     for i in range(len(self.names))]
+        ready = [i for i, count in enumerate(remaining) if count == 0]
+        order: list[int] = []
+        while ready:
+            n = ready.pop(-1)
+            order.append(n)
+            for e in range(out_start[n], out_start[n + 1]):
+                if not out_back[e]:
+                    remaining[out[e]] -= 1
+                    if remaining[out[e]] == 0:
+                        ready.append(out[e])
+        return order
+
+
+def compute_indexed_cfg(all_succs: Mapping[source.NodeName, Sequence[source.NodeName]],
+                        all_preds: Mapping[source.NodeName, Sequence[source.NodeName]],
+                        back_edges: Collection[tuple[source.NodeName, source.NodeName]]) -> IndexedCFG:
+    names = list(all_succs)
+    ids = {n: i for i, n in enumerate(names)}
+
+    succ_start = [0]
+    succ: list[int] = []
+    succ_back = bytearray()
+    for n in names:
+        for head in all_succs[n]:
+            succ.append(ids[head])
+            succ_back.append((n, head) in back_edges)
+        succ_start.append(len(succ))
+
+    pred_start = [0]
+    pred: list[int] = []
+    pred_back = bytearray()
+    for n in names:
+        for tail in all_preds[n]:
+            pred.append(ids[tail])
+            pred_back.append((tail, n) in back_edges)
+        pred_start.append(len(pred))
+
+    return IndexedCFG(names=names, ids=ids,
+                      succ_start=succ_start, succ=succ, succ_back=bytes(
+                          succ_back),
+                      pred_start=pred_start, pred=pred, pred_back=bytes(pred_back))
+
+
 class CFG(NamedTuple):
     """
     Class that groups information about a function's control flow graph
@@ -18,25 +171,61 @@ class CFG(NamedTuple):
     """ Predecessors """
 
     all_doms: Mapping[source.NodeName, Sequence[source.NodeName]]
-    """ Dominators of key (a in all_doms[b] means a dominates b) """
+    """ Dominators of key (a in all_doms[b] means a dominates b)
+
+    Prefer dominates(a, b), this is computed lazily from dominator_tree
+    """
+
+    dominator_tree: DominatorTree
 
     back_edges: Collection[tuple[source.NodeName, source.NodeName]]
     """ edges where the head dominates the tail
         Stored as (tail, head), that is (latch, loop_header)
     """
 
+    indexed: IndexedCFG
+
+    def is_back_edge(self, tail: source.NodeName, head: source.NodeName) -> bool:
+        return self.indexed.is_back_edge(self.indexed.ids[tail], self.indexed.ids[head])
+
+    def acyclic_succs_of(self, n: source.NodeName) -> list[source.NodeName]:
+        """ successors, removing the ones that would follow back edges """
+        names = self.indexed.names
+        return [names[i] for i in self.indexed.acyclic_succs(self.indexed.ids[n])]
+
+    def acyclic_preds_of(self, n: source.NodeName) -> list[source.NodeName]:
+        """ predecessors, removing the ones that would follow back edges """
+        names = self.indexed.names
+        return [names[i] for i in self.indexed.acyclic_preds(self.indexed.ids[n])]
+
+    def dominates(self, a: source.NodeName, b: source.NodeName) -> bool:
+        return self.dominator_tree.dominates(a, b)
+
+    def reachable_from(self, n: source.NodeName) -> set[source.NodeName]:
+        """ Nodes reachable from n (including n itself), following every edge
+        """
+        seen = {n}
+        stack = [n]
+        while stack:
+            for succ in self.all_succs[stack.pop()]:
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append(succ)
+        return seen
+
+
+def node_successors(node: source.Node[source.VarNameKind]) -> list[source.NodeName]:
+    if isinstance(node, source.NodeBasic | source.NodeCall | source.NodeEmpty | source.NodeAssume | source.NodeAssert):
+        return [node.succ]
+    elif isinstance(node, source.NodeCond):
+        return [node.succ_then, node.succ_else]
+    assert_never(node)
+
 
 def compute_all_successors_from_nodes(nodes: Mapping[source.NodeName, source.Node[source.VarNameKind]]) -> Mapping[source.NodeName, list[source.NodeName]]:
     all_succs: dict[source.NodeName, list[source.NodeName]] = {}
     for name, node in nodes.items():
-        all_succs[name] = []
-        if isinstance(node, source.NodeBasic | source.NodeCall | source.NodeEmpty | source.NodeAssume | source.NodeAssert):
-            all_succs[name].append(node.succ)
-        elif isinstance(node, source.NodeCond):
-            all_succs[name].append(node.succ_then)
-            all_succs[name].append(node.succ_else)
-        else:
-            assert_never(node)
+        all_succs[name] = node_successors(node)
 
     # if there is at least one node jumping to Err (ie. at least one assert)
     # we add it
@@ -63,38 +252,97 @@ def compute_all_predecessors(all_succs: Mapping[source.NodeName, Sequence[source
             g[succ].append(n)
     return g
 
-# algorithm from https://en.wikipedia.org/wiki/Dominator_(graph_theory) there
-# exists more efficient algorithms, but we can implement them if it turns out
-# this is a bottle neck
 
+def compute_dominator_tree(all_succs: Mapping[source.NodeName, Sequence[source.NodeName]], all_preds: Mapping[source.NodeName, Sequence[source.NodeName]]) -> DominatorTree:
+    """ Cooper, Harvey and Kennedy, "A Simple, Fast Dominance Algorithm"
 
-def compute_dominators(all_succs: Mapping[source.NodeName, Sequence[source.NodeName]], all_preds: Mapping[source.NodeName, Sequence[source.NodeName]], entry: source.NodeName) -> Mapping[source.NodeName, Sequence[source.NodeName]]:
-    # all the nodes that dominate the given node
-    doms: dict[source.NodeName, set[source.NodeName]] = {}
-    for n, preds in all_preds.items():
-        if len(preds) == 0:
-            doms[n] = set([n])
-        else:
-            doms[n] = set(all_preds.keys())
+    Nodes are identified by their post order number, and the intersection of
+    two dominator sets is found by walking up the tree from both nodes.
+    """
+
+    # post order of a depth first traversal from the virtual root
+    order: list[source.NodeName] = []
+    visited: set[source.NodeName] = set()
+    roots = [n for n, preds in all_preds.items() if len(preds) == 0]
+    for root in roots:
+        visited.add(root)
+        stack = [(root, iter(all_succs[root]))]
+        while stack:
+            n, succs = stack[-1]
+            for succ in succs:
+                if succ not in visited:
+                    visited.add(succ)
+                    stack.append((succ, iter(all_succs[succ])))
+                    break
+            else:
+                stack.pop()
+                order.append(n)
+
+    number = {n: i for i, n in enumerate(order)}
+    virtual_root = len(order)
+    preds = [[number[p] for p in all_preds[n] if p in number] for n in order]
+
+    # -1 means not computed yet
+    idom = [-1] * len(order) + [virtual_root]
+    for root in roots:
+        idom[number[root]] = virtual_root
+
+    def intersect(a: int, b: int) -> int:
+        while a != b:
+            while a < b:
+                a = idom[a]
+            while b < a:
+                b = idom[b]
+        return a
 
     changed = True
     while changed:
         changed = False
-
-        for n in all_succs.keys():
-            npreds = all_preds[n]
-            if not npreds:
+        # reverse post order
+        for b in range(len(order) - 1, -1, -1):
+            if idom[b] == virtual_root and len(preds[b]) == 0:
                 continue
+            new_idom = -1
+            for p in preds[b]:
+                if idom[p] == -1:
+                    continue
+                new_idom = p if new_idom == -1 else intersect(p, new_idom)
+            if idom[b] != new_idom:
+                idom[b] = new_idom
+                changed = True
 
-            new_dom = doms[next(iter(npreds))].intersection(
-                *(doms[p] for p in npreds))
-            new_dom.add(n)
+    return number_dominator_tree({n: None if idom[i] == virtual_root else order[idom[i]] for i, n in enumerate(order)},
+                                 unreachable=frozenset(n for n in all_succs if n not in number))
 
-            if new_dom != doms[n]:
-                changed = True
-                doms[n] = new_dom
 
-    return {n: list(doms[n]) for n in doms.keys()}
+def number_dominator_tree(idom: Mapping[source.NodeName, source.NodeName | None], unreachable: Collection[source.NodeName]) -> DominatorTree:
+    """ Numbers the nodes of the tree given by the immediate dominators """
+    children: dict[source.NodeName | None, list[source.NodeName]] = {
+        n: [] for n in idom}
+    children[None] = []
+    for n, d in idom.items():
+        children[d].append(n)
+
+    pre: dict[source.NodeName, int] = {}
+    post: dict[source.NodeName, int] = {}
+    counter = 0
+    # None is the virtual root
+    stack: list[tuple[source.NodeName | None, Iterator[source.NodeName]]] = [
+        (None, iter(children[None]))]
+    while stack:
+        top, top_children = stack[-1]
+        child = next(top_children, None)
+        if child is not None:
+            pre[child] = counter
+            counter += 1
+            stack.append((child, iter(children[child])))
+        else:
+            stack.pop()
+            if top is not None:
+                post[top] = counter
+                counter += 1
+
+    return DominatorTree(idom=idom, pre=pre, post=post, unreachable=unreachable)
 
 
 def compute_cfg_from_all_succs(all_succs: Mapping[source.NodeName, Sequence[source.NodeName]], entry: source.NodeName) -> CFG:
@@ -105,12 +353,16 @@ def compute_cfg_from_all_succs(all_succs: Mapping[source.NodeName, Sequence[sour
     assert len(all_preds) == len(all_succs)
     # assert is_valid_all_preds(all_preds)
 
-    all_doms = compute_dominators(
-        all_succs=all_succs, all_preds=all_preds, entry=entry)
-    return CFG(entry=entry, all_succs=all_succs, all_preds=all_preds, all_doms=all_doms, back_edges=cfg_compute_back_edges(all_succs, all_doms))
+    dominator_tree = compute_dominator_tree(all_succs, all_preds)
+    back_edges = cfg_compute_back_edges(all_succs, dominator_tree)
+    return CFG(entry=entry, all_succs=all_succs, all_preds=all_preds,
+               all_doms=Dominators(dominator_tree, all_succs.keys()),
+               dominator_tree=dominator_tree,
+               back_edges=back_edges,
+               indexed=compute_indexed_cfg(all_succs, all_preds, back_edges))
 
 
-def cfg_compute_back_edges(all_succs: Mapping[source.NodeName, Sequence[source.NodeName]], all_doms: Mapping[source.NodeName, Sequence[source.NodeName]]) -> Collection[tuple[source.NodeName, source.NodeName]]:
+def cfg_compute_back_edges(all_succs: Mapping[source.NodeName, Sequence[source.NodeName]], dominator_tree: DominatorTree) -> Collection[tuple[source.NodeName, source.NodeName]]:
     """ a back edge is an edge who's head dominates their tail
     """
 
@@ -118,11 +370,183 @@ def cfg_compute_back_edges(all_succs: Mapping[source.NodeName, Sequence[source.N
     for n, succs in all_succs.items():
         tail = n
         for head in succs:
-            if head in all_doms[tail]:
+            if dominator_tree.dominates(head, tail):
                 back_edges.add((tail, head))
     return frozenset(back_edges)
 
 
+class CFGBuilder:
+    """ Inserts nodes into a CFG, updating the predecessors, the dominators,
+    the back edges and the loops as it goes, instead of recomputing all of
+    them from scratch.
+
+    It only supports what the passes need: putting a node on an edge
+    (split_edge) or in front of a node (insert_before). The new node must
+    have exactly one successor in the graph, and optionally jump to some sinks
+    (Err). Hence, the loop headers never change.
+
+    The callers construct the nodes, and then give all of them to build,
+    which checks that both agree on the edges.
+    """
+
+    def __init__(self, cfg: CFG, loops: Mapping[source.LoopHeaderName, source.Loop[Any]]):
+        self.entry = cfg.entry
+        self.all_succs = {n: list(succs) for n, succs in cfg.all_succs.items()}
+        self.all_preds = {n: list(preds) for n, preds in cfg.all_preds.items()}
+        self.idom = dict(cfg.dominator_tree.idom)
+        self.unreachable = cfg.dominator_tree.unreachable
+        self.back_edges = set(cfg.back_edges)
+
+        self.original_loops = loops
+        self.loop_back_edges = {lh: loop.back_edge for lh,
+                                loop in loops.items()}
+        self.loop_nodes = {lh: set(loop.nodes) for lh, loop in loops.items()}
+        self.loop_new_targets: dict[source.LoopHeaderName, set[source.ExprVarT[Any]]] = {
+            lh: set() for lh in loops}
+
+    def split_edge(self, tail: source.NodeName, head: source.NodeName, new: source.NodeName, node: source.Node[Any]) -> None:
+        """ tail -> head becomes tail -> new -> head """
+        self.add_node(new, head, node)
+
+        i = self.all_succs[tail].index(head)
+        self.all_succs[tail][i] = new
+        self.all_preds[head].remove(tail)
+        self.all_preds[head].append(new)
+        self.all_preds[new] = [tail]
+        self.idom[new] = tail
+
+        was_back_edge = (tail, head) in self.back_edges
+        if head not in self.all_succs[tail]:
+            self.back_edges.discard((tail, head))
+
+        if was_back_edge:
+            # new is the latch now
+            self.back_edges.add((new, head))
+            header = source.LoopHeaderName(head)
+            assert self.loop_back_edges[header] == (tail, head)
+            self.loop_back_edges[header] = (new, head)
+        elif all((p, head) in self.back_edges for p in self.all_preds[head] if p != new):
+            # tail was the only way into head, now it's new. Otherwise, head's
+            # immediate dominator is also new's: nothing changes.
+            self.idom[head] = new
+        self.connect_sinks(new, head)
+
+        for lh, loop_nodes in self.loop_nodes.items():
+            # if tail is in the loop but head isn't, then it's an exit edge.
+            # If head is in the loop but tail isn't, then head is the loop
+            # header (it's an entry edge).
+            if tail in loop_nodes and head in loop_nodes:
+                self.add_to_loop(lh, new, node)
+
+    def insert_before(self, head: source.NodeName, new: source.NodeName, node: source.Node[Any]) -> None:
+        """ every pred -> head becomes pred -> new -> head
+
+        Like for split_edge, new's successor (head) has to be in the graph
+        already. So to insert a chain of nodes, where each node jumps to the
+        next one, insert the last one first.
+        """
+        assert head not in self.loop_nodes, "more work required: loop headers changed during conversion, need to keep ghost's loop invariant in sync"
+        assert head != self.entry
+        self.add_node(new, head, node)
+
+        preds = self.all_preds[head]
+        assert not any((p, head) in self.back_edges for p in preds)
+        for p in set(preds):
+            self.all_succs[p] = [
+                new if succ == head else succ for succ in self.all_succs[p]]
+        self.all_preds[new] = preds
+        self.all_preds[head] = [new]
+
+        self.idom[new] = self.idom[head]
+        self.idom[head] = new
+        self.connect_sinks(new, head)
+
+        for lh, loop_nodes in self.loop_nodes.items():
+            if head in loop_nodes:
+                self.add_to_loop(lh, new, node)
+
+    def add_node(self, new: source.NodeName, succ: source.NodeName, node: source.Node[Any]) -> None:
+        assert new not in self.all_succs, f"{new} is already in the graph"
+        succs = node_successors(node)
+        assert succ in succs
+        self.all_succs[new] = succs
+
+    def connect_sinks(self, new: source.NodeName, succ: source.NodeName) -> None:
+        """ the edges from new to anything but succ (once new is placed in
+            the dominator tree)
+        """
+        for sink in self.all_succs[new]:
+            if sink == succ:
+                continue
+            if sink not in self.all_succs:
+                # the first jump to Err
+                self.all_succs[sink] = []
+                self.all_preds[sink] = []
+            assert len(
+                self.all_succs[sink]) == 0, "the other successors should be sinks (like Err)"
+            assert len(self.all_preds[sink]) > 0 or sink not in self.idom
+            self.all_preds[sink].append(new)
+            if sink in self.idom:
+                self.idom[sink] = self.common_dominator(self.idom[sink], new)
+            else:
+                self.idom[sink] = new
+
+    def common_dominator(self, a: source.NodeName | None, b: source.NodeName) -> source.NodeName | None:
+        ancestors: set[source.NodeName] = set()
+        while a is not None:
+            ancestors.add(a)
+            a = self.idom[a]
+        d: source.NodeName | None = b
+        while d is not None and d not in ancestors:
+            d = self.idom[d]
+        return d
+
+    def add_to_loop(self, lh: source.LoopHeaderName, new: source.NodeName, node: source.Node[Any]) -> None:
+        self.loop_nodes[lh].add(new)
+        if isinstance(node, source.NodeBasic):
+            self.loop_new_targets[lh].update(upd.var for upd in node.upds)
+        elif isinstance(node, source.NodeCall):
+            self.loop_new_targets[lh].update(node.rets)
+
+    def build(self, nodes: Mapping[source.NodeName, source.Node[Any]]) -> CFG:
+        """ nodes: all the nodes, with the insertions
+
+        The CFG is the same as the one compute_cfg_from_all_succs would give
+        (including the order of the successors and the predecessors, which
+        the topological traversals depend on)
+        """
+        order = list(nodes)
+        if source.NodeNameErr in self.all_succs:
+            order.append(source.NodeNameErr)
+        order.append(source.NodeNameRet)
+        assert len(order) == len(self.all_succs)
+
+        all_succs = {n: self.all_succs[n] for n in order}
+        assert all(all_succs[n] == node_successors(node)
+                   for n, node in nodes.items()), "the nodes don't match the insertions"
+
+        position = {n: i for i, n in enumerate(order)}
+        all_preds = {n: sorted(self.all_preds[n], key=position.__getitem__)
+                     for n in order}
+
+        dominator_tree = number_dominator_tree(self.idom, self.unreachable)
+        back_edges = frozenset(self.back_edges)
+        return CFG(entry=self.entry, all_succs=all_succs, all_preds=all_preds,
+                   all_doms=Dominators(dominator_tree, all_succs.keys()),
+                   dominator_tree=dominator_tree,
+                   back_edges=back_edges,
+                   indexed=compute_indexed_cfg(all_succs, all_preds, back_edges))
+
+    def build_loops(self) -> Mapping[source.LoopHeaderName, source.Loop[Any]]:
+        """ The original loops, with the inserted nodes and the variables they
+            assign
+        """
+        return {lh: source.Loop(back_edge=self.loop_back_edges[lh],
+                                nodes=tuple(self.loop_nodes[lh]),
+                                targets=tuple(sorted(set(loop.targets) | self.loop_new_targets[lh], key=loop_target_sorting_key)))
+                for lh, loop in self.original_loops.items()}
+
+
 def compute_natural_loop(cfg: CFG, back_edge: tuple[source.NodeName, source.NodeName]) -> tuple[source.NodeName, ...]:
     """ Returns all the nodes in the loop
 
@@ -130,7 +554,7 @@ def compute_natural_loop(cfg: CFG, back_edge: tuple[source.NodeName, source.Node
     edges pointing to the same node (right now, we bail out of this case)
     """
     n, d = back_edge
-    assert d in cfg.all_doms[n]
+    assert cfg.dominates(d, n)
 
     loop_nodes = set([d])
     stack = []
@@ -155,17 +579,22 @@ def compute_loop_targets(
         loop_nodes: tuple[source.NodeName, ...]) -> Collection[source.ExprVarT[source.VarNameKind]]:
     # traverse the loop nodes in topological order
     # (if there is a loop in the body, we ignore its back edge)
-    q: list[source.NodeName] = [loop_header]
-    visited = set()
+    g = cfg.indexed
+    in_loop = bytearray(len(g.names))
+    for n in loop_nodes:
+        in_loop[g.ids[n]] = 1
+
+    q: list[int] = [g.ids[loop_header]]
+    visited = bytearray(len(g.names))
 
     loop_targets: set[source.ExprVarT[source.VarNameKind]] = set()
     while q:
-        n = q.pop(0)
-        if not all(p in visited for p in cfg.all_preds[n] if (p, n) not in cfg.back_edges and p in loop_nodes):
+        i = q.pop(0)
+        if not all(visited[g.pred[e]] for e in range(g.pred_start[i], g.pred_start[i + 1]) if not g.pred_back[e] and in_loop[g.pred[e]]):
             continue
-        visited.add(n)
+        visited[i] = 1
 
-        node = nodes[n]
+        node = nodes[g.names[i]]
         if isinstance(node, source.NodeBasic):
             for upd in node.upds:
                 loop_targets.add(upd.var)
@@ -175,11 +604,11 @@ def compute_loop_targets(
         elif not isinstance(node, source.NodeEmpty | source.NodeCond | source.NodeAssume | source.NodeAssert):
             assert_never(node)
 
-        for succ in cfg.all_succs[n]:
-            if succ in loop_nodes and (n, succ) not in cfg.back_edges:
-                q.append(succ)
+        for e in range(g.succ_start[i], g.succ_start[i + 1]):
+            if in_loop[g.succ[e]] and not g.succ_back[e]:
+                q.append(g.succ[e])
 
-    assert len(visited) == len(loop_nodes)
+    assert sum(visited) == len(loop_nodes)
     return loop_targets
 
 
@@ -222,7 +651,7 @@ def compute_loops(nodes: Mapping[source.NodeName, source.Node[source.VarNameKind
 
         loop_nodes = compute_natural_loop(cfg, back_edge)
 
-        assert all(loop_header in cfg.all_doms[n]
+        assert all(cfg.dominates(loop_header, n)
                    for n in loop_nodes), "the loop header should dominate all the nodes in the loop body"
 
         loop_targets = compute_loop_targets(
@@ -1,3 +1,5 @@
+from dataclasses import dataclass, field, replace
+from functools import cached_property
 from typing import Mapping, NamedTuple, NewType, Sequence, Set, TypeAlias, cast, overload
 from typing_extensions import assert_never
 import dsa
@@ -25,7 +27,8 @@ Instruction = InstructionAssume | InstructionProve
 Script = Sequence[InstructionAssume | InstructionProve]
 
 
-class AssumeProveProg(NamedTuple):
+@dataclass(frozen=True)
+class AssumeProveProg:
     nodes_script: Mapping[NodeOkName, Script]
 
     entry: NodeOkName
@@ -35,13 +38,52 @@ class AssumeProveProg(NamedTuple):
     variables: Set[source.ExprVarT[VarName]]
     # TODO: specify each assert with a specific error message
 
+    aliases: Mapping[NodeOkName, NodeOkName] = field(default_factory=dict)
+    """ node_ok variables removed by compact_prog, which are equal to
+        another node_ok variable
+    """
+
+    merged_into: Mapping[NodeOkName, tuple[NodeOkName, int]] = field(
+        default_factory=dict)
+    """ node_ok variables removed by compact_prog, whose script was appended
+        to their only predecessor's
+
+        X: (P, i) means that X's script is nodes_script[P][i:]
+    """
+
+    @cached_property
+    def suffix_weakest_preconditions(self) -> Mapping[NodeOkName, Sequence[source.ExprT[VarName]]]:
+        """ node_ok name => the weakest preconditions of each suffix of its
+            script (see weakest_preconditions), computed once per program
+        """
+        return {name: weakest_preconditions(script) for name, script in self.nodes_script.items()}
+
+    def weakest_precondition(self, name: NodeOkName, start: int = 0) -> source.ExprT[VarName]:
+        """ wp(nodes_script[name][start:], true) """
+        return self.suffix_weakest_preconditions[name][start]
+
+    def node_ok_expr(self, name: NodeOkName) -> source.ExprT[VarName]:
+        """ Equivalent to the node's node_ok variable, even if compact_prog
+            removed it
+        """
+        name = self.aliases.get(name, name)
+        if name in self.merged_into:
+            into, i = self.merged_into[name]
+            return self.weakest_precondition(into, i)
+        assert name in self.nodes_script, f"unknown node {name}"
+        return source.ExprVar(source.type_bool, name)
+
 
 def node_ok_name(n: source.NodeName) -> NodeOkName:
     return NodeOkName(VarName(f'node_{n}_ok'))
 
 
 def node_ok_ap_var(n: source.NodeName) -> APVar:
-    return source.ExprVar(source.type_bool, VarName(node_ok_name(n)))
+    return node_ok_var(node_ok_name(n))
+
+
+def node_ok_var(name: NodeOkName) -> APVar:
+    return source.ExprVar(source.type_bool, VarName(name))
 
 
 def convert_dsa_var_to_ap_var(var: dsa.Incarnation[source.ProgVarName | nip.GuardVarName]) -> VarName:
@@ -142,19 +184,25 @@ def get_loop_count_target_var(loop: source.Loop[dsa.Incarnation[source.ProgVarNa
 
 def make_assume_prove_script_for_node(func: dsa.Function, n: source.NodeName) -> Script:
     node = func.nodes[n]
+    # successors we need to prove, ignoring back edges
+    acyclic_succs = func.cfg.acyclic_succs_of(n)
 
     script: list[Instruction] = []
     if isinstance(node, source.NodeCond):
         # CondNode(expr, succ_then, succ_else)
         #     prove expr --> succ_then_ok
         #     prove not expr --> succ_else_ok
+        #
+        # when the condition is constant (see simplify), the branch which
+        # isn't taken is trivially true, and the other one is just
+        # prove succ_ok
         cond = convert_expr_dsa_vars_to_ap(node.expr)
 
-        if (n, node.succ_then) not in func.cfg.back_edges:
-            script.append(InstructionProve(source.expr_implies(
+        if node.succ_then in acyclic_succs and cond is not source.expr_false:
+            script.append(InstructionProve(node_ok_ap_var(node.succ_then) if cond is source.expr_true else source.expr_implies(
                 cond, node_ok_ap_var(node.succ_then)), n))
-        if (n, node.succ_else) not in func.cfg.back_edges:
-            script.append(InstructionProve(source.expr_implies(
+        if node.succ_else in acyclic_succs and cond is not source.expr_true:
+            script.append(InstructionProve(node_ok_ap_var(node.succ_else) if cond is source.expr_false else source.expr_implies(
                 source.expr_negate(cond), node_ok_ap_var(node.succ_else)), n))
 
     elif isinstance(node, source.NodeBasic):
@@ -165,7 +213,7 @@ def make_assume_prove_script_for_node(func: dsa.Function, n: source.NodeName) ->
             script.append(make_assume(upd.var, upd.expr, n))
 
         # proves successors are correct, ignoring back edges
-        if (n, node.succ) not in func.cfg.back_edges:
+        if node.succ in acyclic_succs:
             script.append(InstructionProve(node_ok_ap_var(node.succ), n))
     elif isinstance(node, source.NodeCall):
         # CallNode(func, args, rets, succ):
@@ -175,22 +223,24 @@ def make_assume_prove_script_for_node(func: dsa.Function, n: source.NodeName) ->
 
         # TODO: pre and post condition
         # proves successors are correct, ignoring back edges
-        if (n, node.succ) not in func.cfg.back_edges:
+        if node.succ in acyclic_succs:
             script.append(InstructionProve(node_ok_ap_var(node.succ), n))
     elif isinstance(node, source.NodeEmpty):
         # proves successors are correct, ignoring back edges
-        if (n, node.succ) not in func.cfg.back_edges:
+        if node.succ in acyclic_succs:
             script.append(InstructionProve(node_ok_ap_var(node.succ), n))
     elif isinstance(node, source.NodeAssume):
-        script.append(InstructionAssume(
-            convert_expr_dsa_vars_to_ap(node.expr), n))
+        if node.expr is not source.expr_true:
+            script.append(InstructionAssume(
+                convert_expr_dsa_vars_to_ap(node.expr), n))
         # proves successors are correct, ignoring back edges
-        if (n, node.succ) not in func.cfg.back_edges:
+        if node.succ in acyclic_succs:
             script.append(InstructionProve(node_ok_ap_var(node.succ), n))
     elif isinstance(node, source.NodeAssert):
-        script.append(InstructionProve(
-            convert_expr_dsa_vars_to_ap(node.expr), n))
-        if (n, node.succ) not in func.cfg.back_edges:
+        if node.expr is not source.expr_true:
+            script.append(InstructionProve(
+                convert_expr_dsa_vars_to_ap(node.expr), n))
+        if node.succ in acyclic_succs:
             script.append(InstructionProve(node_ok_ap_var(node.succ), n))
     else:
         assert_never(node)
@@ -250,6 +300,130 @@ def make_prog(func: dsa.Function) -> AssumeProveProg:
     return AssumeProveProg(nodes_script=nodes_script, entry=node_ok_name(func.cfg.entry), arguments=args, variables=ap_variables)
 
 
+def defined_variable(func: dsa.Function, ins: Instruction) -> APVar | None:
+    """ The variable the instruction defines, if it's the 'assume v = e' of an
+        update (see make_assume)
+    """
+    if not isinstance(ins, InstructionAssume) or not isinstance(func.nodes.get(ins.origin), source.NodeBasic):
+        return None
+    assert isinstance(
+        ins.expr, source.ExprOp) and ins.expr.operator is source.Operator.EQUALS
+    lhs = ins.expr.operands[0]
+    assert isinstance(lhs, source.ExprVar)
+    return lhs
+
+
+def slice_prog(func: dsa.Function, prog: AssumeProveProg) -> AssumeProveProg:
+    """ Drops the definitions of the variables which nothing we prove or
+    assume depends on (the cone of influence of the proof obligations)
+
+    A dropped variable is left unconstrained, but it doesn't appear anywhere
+    else, so the query is satisfiable iff it was before.
+
+    prog must come from func (see make_prog), possibly restricted to some
+    obligations (see split_obligations).
+    """
+    definitions: dict[VarName, list[source.ExprT[VarName]]] = {}
+    relevant: set[VarName] = set()
+    for script in prog.nodes_script.values():
+        for ins in script:
+            var = defined_variable(func, ins)
+            if var is None:
+                relevant.update(
+                    v.name for v in source.all_vars_in_expr(ins.expr))
+            else:
+                assert isinstance(ins.expr, source.ExprOp)
+                definitions.setdefault(var.name, []).append(
+                    ins.expr.operands[1])
+
+    todo = list(relevant)
+    while todo:
+        name = todo.pop()
+        for rhs in definitions.get(name, ()):
+            for v in source.all_vars_in_expr(rhs):
+                if v.name not in relevant:
+                    relevant.add(v.name)
+                    todo.append(v.name)
+
+    nodes_script: dict[NodeOkName, Script] = {}
+    for node_ok_name, script in prog.nodes_script.items():
+        new_script: list[Instruction] = []
+        for ins in script:
+            var = defined_variable(func, ins)
+            if var is None or var.name in relevant:
+                new_script.append(ins)
+        nodes_script[node_ok_name] = new_script
+    return replace(prog, nodes_script=nodes_script)
+
+
+def compact_prog(prog: AssumeProveProg) -> AssumeProveProg:
+    """ Removes the node_ok variables which are just an indirection
+
+    - when X's script is 'prove Y_ok' (empty nodes, calls, ...), X_ok is an
+      alias of Y_ok: we use Y_ok instead
+    - when the only use of X_ok is the last instruction of P's script,
+      'prove X_ok' (straight line code), that instruction is replaced with
+      X's script
+
+    The wp of the remaining nodes doesn't change. nodes_script must be in
+    topological order, apart from Err and Ret (see make_prog).
+    """
+    assert len(prog.aliases) == 0 and len(
+        prog.merged_into) == 0, "already compacted"
+    err_ok = node_ok_name(source.NodeNameErr)
+    ret_ok = node_ok_name(source.NodeNameRet)
+
+    aliases: dict[NodeOkName, NodeOkName] = {}
+    for name, script in prog.nodes_script.items():
+        if len(script) == 1 and isinstance(script[0], InstructionProve) and isinstance(script[0].expr, source.ExprVar) and script[0].expr.name in prog.nodes_script:
+            aliases[name] = NodeOkName(script[0].expr.name)
+    for name in aliases:
+        while aliases[name] in aliases:
+            aliases[name] = aliases[aliases[name]]
+
+    def substitute(var: APVar) -> source.ExprT[VarName]:
+        if var.name in aliases:
+            return node_ok_var(aliases[NodeOkName(var.name)])
+        return var
+
+    # node_ok variables only appear in prove instructions
+    scripts: dict[NodeOkName, list[Instruction]] = {}
+    uses: dict[NodeOkName, list[NodeOkName]] = {}
+    for name, script in prog.nodes_script.items():
+        if name in aliases:
+            continue
+        new_script: list[Instruction] = []
+        for ins in script:
+            if isinstance(ins, InstructionProve):
+                used = set(NodeOkName(var.name) for var in source.all_vars_in_expr(
+                    ins.expr) if var.name in prog.nodes_script)
+                if any(ok in aliases for ok in used):
+                    ins = InstructionProve(source.convert_expr_vars(
+                        substitute, ins.expr), ins.origin)
+                for ok in set(aliases.get(ok, ok) for ok in used):
+                    uses.setdefault(ok, []).append(name)
+            new_script.append(ins)
+        scripts[name] = new_script
+
+    merged_into: dict[NodeOkName, tuple[NodeOkName, int]] = {}
+    order = [name for name in scripts if name not in (err_ok, ret_ok)]
+    order += [name for name in (ret_ok, err_ok) if name in scripts]
+    for name in order:
+        if len(uses.get(name, [])) != 1:
+            continue
+        (into, ) = uses[name]
+        # the predecessors come first, so this is a script which stays
+        into = merged_into[into][0] if into in merged_into else into
+        last = scripts[into][-1]
+        if not (isinstance(last, InstructionProve) and last.expr == node_ok_var(name)):
+            continue
+        merged_into[name] = (into, len(scripts[into]) - 1)
+        scripts[into] = scripts[into][:-1] + scripts.pop(name)
+
+    assert all(into in scripts for into, _ in merged_into.values())
+    return AssumeProveProg(nodes_script=scripts, entry=aliases.get(prog.entry, prog.entry), arguments=prog.arguments, variables=prog.variables, aliases=aliases, merged_into=merged_into)
+
+
 def pretty_instruction_ascii(ins: Instruction) -> str:
     if isinstance(ins, InstructionAssume):
         return f"assume {source.pretty_expr_ascii(ins.expr)}"
@@ -286,36 +460,41 @@ def pretty_print_prog(prog: AssumeProveProg) -> None:
         #       source.pretty_expr_ascii(apply_weakest_precondition(prog.nodes_script[n])))
 
 
-def apply_weakest_precondition(script: Script) -> source.ExprT[VarName]:
+def wp_instruction(ins: Instruction, post: source.ExprT[VarName]) -> source.ExprT[VarName]:
     # A: wp(prove P, Q) = P && Q
     # B: wp(assume P, Q) = P --> Q
+    # the expressions are interned, so post is true iff it is expr_true
+    if isinstance(ins, InstructionProve):
+        if post is source.expr_true:
+            return ins.expr
+        return source.expr_and(ins.expr, post)
+    elif isinstance(ins, InstructionAssume):
+        if post is source.expr_true:
+            # a -> true is a tautology
+            return source.expr_true
+        return source.expr_implies(ins.expr, post)
+    assert_never(ins)
+
+
+def apply_weakest_precondition(script: Script) -> source.ExprT[VarName]:
     # C: wp(S;T, Q) = wp(S, wp(T, Q))
+    #
+    # so the script is folded from the right, one instruction at a time
+    # (compact_prog makes the scripts long enough that recursing over the
+    # slices, which copies them, shows up)
+    post: source.ExprT[VarName] = source.expr_true
+    for i in range(len(script) - 1, -1, -1):
+        post = wp_instruction(script[i], post)
+    return post
+
 
-    # there are only a few instruction per script (about <= 5)
-    # so, we use recursion + copy because the performance won't matter
-    # but the correctness is much clearer that way
-
-    def wp_single(ins: Instruction, post: source.ExprT[VarName]) -> source.ExprT[VarName]:
-        if isinstance(ins, InstructionProve):
-            if post == source.expr_true:
-                return ins.expr
-            return source.expr_and(ins.expr, post)
-        elif isinstance(ins, InstructionAssume):
-            if post == source.expr_true:
-                # a -> true is a tautology
-                return source.expr_true
-            return source.expr_implies(ins.expr, post)
-        assert_never(ins)
-
-    def wp(script: Script, post: source.ExprT[VarName]) -> source.ExprT[VarName]:
-        if len(script) == 0:
-            return post
-
-        if len(script) == 1:
-            return wp_single(script[0], post)
-
-        # from C you can show `wp(S;T;R, Q) = wp(S, wp(T;R, Q)`
-        # (; is associative, put the brackets are T;R)
-        return wp([script[0]], wp(script[1:], post))
-
-    return wp(script, source.expr_true)
+def weakest_preconditions(script: Script) -> Sequence[source.ExprT[VarName]]:
+    """ wps[i] = apply_weakest_precondition(script[i:]), for 0 <= i <= len(script)
+
+    The same right fold as apply_weakest_precondition, which keeps every
+    intermediate result.
+    """
+    wps: list[source.ExprT[VarName]] = [source.expr_true] * (len(script) + 1)
+    for i in range(len(script) - 1, -1, -1):
+        wps[i] = wp_instruction(script[i], wps[i + 1])
+    return wps
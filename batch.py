@@ -0,0 +1,223 @@
+""" Verifies every function of a GraphLang file, in parallel.
+
+The file is parsed once, by the parent. Each worker process installs the
+parsed objects and then runs the whole pipeline for the functions it is
+given. Nothing here exits: every function gets a report, even if some stage
+crashes on it.
+"""
+
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+import time
+import traceback
+from typing import Iterator, Mapping, NamedTuple, Sequence
+import xml.etree.ElementTree as ET
+
+import assume_prove
+import dsa
+import function_cache
+import ghost_code
+import ghost_data
+import nip
+import simplify
+import smt
+import source
+import syntax
+import target_objects
+import validate_dsa
+
+
+def expected_result(func_name: str) -> smt.VerificationResult:
+    """ Functions whose name contains 'fail' (as in foo_fail, fail_foo,
+        foo_fails_bar, ...) are expected not to verify
+    """
+    suffix = func_name.split('.')[-1]
+    should_fail = False
+    should_fail = should_fail or '_fail_' in suffix
+    should_fail = should_fail or suffix.endswith('_fail')
+    should_fail = should_fail or suffix.startswith('fail_')
+    should_fail = should_fail or '_fails_' in suffix
+    should_fail = should_fail or suffix.endswith('_fails')
+    should_fail = should_fail or suffix.startswith('fails_')
+    if should_fail:
+        return smt.VerificationResult.FAIL
+    return smt.VerificationResult.OK
+
+
+class FunctionReport(NamedTuple):
+    name: str
+
+    result: smt.VerificationResult | None
+    """ None if the pipeline crashed (see error) """
+
+    expected: smt.VerificationResult
+
+    timings: Mapping[str, float]
+    """ seconds spent in each stage, in the order they ran """
+
+    cached: bool
+    """ the result comes from function_cache, no stage ran """
+
+    error: str | None
+
+    @property
+    def passed(self) -> bool:
+        return self.result is self.expected
+
+    @property
+    def solver_time(self) -> float:
+        return self.timings.get('solver', 0)
+
+    def to_json(self) -> dict[str, object]:
+        return {
+            'name': self.name,
+            'result': None if self.result is None else self.result.value,
+            'expected': self.expected.value,
+            'passed': self.passed,
+            'cached': self.cached,
+            'timings': dict(self.timings),
+            'solver_time': self.solver_time,
+            'error': self.error,
+        }
+
+
+@contextmanager
+def timed(timings: dict[str, float], stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def verify_function(filename: str, unsafe_func: syntax.Function, functions: Mapping[str, syntax.Function], prelude_files: Sequence[str], solver: smt.Solver, timings: dict[str, float]) -> smt.VerificationResult:
+    with timed(timings, 'convert'):
+        prog_func = source.convert_function(unsafe_func).with_ghost(
+            ghost_data.get(filename, unsafe_func.name))
+    with timed(timings, 'nip'):
+        nip_func = nip.nip(prog_func)
+    with timed(timings, 'ghost'):
+        ghost_func = ghost_code.sprinkle_ghost_code(
+            filename, nip_func, functions)
+    with timed(timings, 'dsa'):
+        dsa_func = dsa.dsa(ghost_func)
+    with timed(timings, 'validate'):
+        validate_dsa.validate(ghost_func, dsa_func)
+    with timed(timings, 'simplify'):
+        simple_func = simplify.simplify(dsa_func)
+    with timed(timings, 'assume_prove'):
+        prog = assume_prove.compact_prog(assume_prove.slice_prog(
+            simple_func, assume_prove.make_prog(simple_func)))
+    query = smt.Query(prog, prelude_files=prelude_files)
+    with timed(timings, 'solver'):
+        # the smtlib is written straight to the solver's stdin (see
+        # smt.run_solver_process), so this includes emitting and hashing it
+        sats = tuple(smt.send_smtlib(query, solver))
+    assert len(sats) == 2
+    return smt.parse_sats(sats)
+
+
+class Job(NamedTuple):
+    filename: str
+    prelude_files: Sequence[str]
+    solver: smt.Solver
+    expect_from_names: bool
+    """ use expected_result, otherwise every function is expected to verify """
+
+
+# set by init_worker, so that the functions are sent to each worker once
+worker_functions: Mapping[str, syntax.Function] = {}
+
+
+def init_worker(arch: str, parsed: tuple[dict[str, syntax.Struct], dict[str, syntax.Function], dict[str, syntax.Expr]], smt_cache: bool, use_function_cache: bool) -> None:
+    global worker_functions
+    syntax.set_arch(arch)
+    structs, functions, const_globals = parsed
+    target_objects.structs.update(structs)
+    target_objects.functions.update(functions)
+    target_objects.const_globals.update(const_globals)
+    worker_functions = functions
+    if not smt_cache:
+        smt.query_cache = None
+    if not use_function_cache:
+        function_cache.results_cache = None
+
+
+def run_job(job: Job, name: str) -> FunctionReport:
+    unsafe_func = worker_functions[name]
+    expected = expected_result(
+        name) if job.expect_from_names else smt.VerificationResult.OK
+
+    # verify_function never splits the prove nodes
+    key = function_cache.function_key(
+        job.filename, unsafe_func, worker_functions, job.prelude_files, job.solver, split_prove_conjunctions=False)
+    cached = function_cache.get(key)
+    if cached is not None:
+        return FunctionReport(name=name, result=cached, expected=expected, timings={}, cached=True, error=None)
+
+    timings: dict[str, float] = {}
+    try:
+        result = verify_function(
+            job.filename, unsafe_func, worker_functions, job.prelude_files, job.solver, timings)
+    except Exception:
+        return FunctionReport(name=name, result=None, expected=expected, timings=timings, cached=False, error=traceback.format_exc())
+
+    function_cache.put(key, result)
+    return FunctionReport(name=name, result=result, expected=expected, timings=timings, cached=False, error=None)
+
+
+def verify_all(job: Job, parsed: tuple[dict[str, syntax.Struct], dict[str, syntax.Function], dict[str, syntax.Expr]], jobs: int | None = None) -> list[FunctionReport]:
+    """ Verifies every function (with a body) of the parsed file
+
+    The reports are in the same order as the functions in the file.
+    """
+    assert syntax.arch is not None
+    init_args = (syntax.arch.name, parsed, smt.query_cache is not None,
+                 function_cache.results_cache is not None)
+    names = [name for name, func in parsed[1].items() if func.entry]
+
+    if jobs == 1:
+        # useful for debugging (and profiling)
+        init_worker(*init_args)
+        return [run_job(job, name) for name in names]
+
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=init_worker, initargs=init_args) as executor:
+        return list(executor.map(run_job, [job] * len(names), names))
+
+
+def json_report(job: Job, reports: Sequence[FunctionReport]) -> str:
+    return json.dumps({
+        'file': job.filename,
+        'solver': job.solver.value,
+        'preludes': list(job.prelude_files),
+        'passed': sum(report.passed for report in reports),
+        'failed': sum(not report.passed for report in reports),
+        'functions': [report.to_json() for report in reports],
+    }, indent=2)
+
+
+def junit_report(job: Job, reports: Sequence[FunctionReport]) -> str:
+    suite = ET.Element('testsuite', {
+        'name': job.filename,
+        'tests': str(len(reports)),
+        'failures': str(sum(not report.passed and report.error is None for report in reports)),
+        'errors': str(sum(report.error is not None for report in reports)),
+        'time': f'{sum(sum(report.timings.values()) for report in reports):.3f}',
+    })
+    for report in reports:
+        case = ET.SubElement(suite, 'testcase', {
+            'classname': job.filename,
+            'name': report.name,
+            'time': f'{sum(report.timings.values()):.3f}',
+        })
+        if report.error is not None:
+            ET.SubElement(case, 'error', {
+                          'message': report.error.splitlines()[-1]}).text = report.error
+        elif not report.passed:
+            assert report.result is not None
+            ET.SubElement(case, 'failure', {
+                          'message': f'expected {report.expected.value}, got {report.result.value}'})
+    return ET.tostring(suite, encoding='unicode')
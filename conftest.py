@@ -0,0 +1,18 @@
+""" Every test run gets its own, empty, caches (see disk_cache)
+
+The caches are created when their modules (smt, syntax and function_cache)
+are imported, that is when the tests are collected, so UBC_CACHE_DIR is set
+before that. A test which wants a cache of its own sets it with monkeypatch.
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    cache_dir = tempfile.mkdtemp(prefix='ubc-cache-')
+    os.environ['UBC_CACHE_DIR'] = cache_dir
+    config.add_cleanup(lambda: shutil.rmtree(cache_dir, ignore_errors=True))
@@ -0,0 +1,111 @@
+""" Size bounded, on disk, least recently used caches.
+
+Each entry is a file named after its key. Reading an entry touches it, so the
+modification times give us the LRU order. Writes go through a temporary file
+and a rename so that concurrent processes (see split_obligations) never see
+half written entries.
+
+Scanning the directory is O(#entries), so puts don't do it every time: each
+cache keeps a running estimate of its size, and only scans (and evicts) when
+the estimate goes over the limit. Eviction then makes some room (down to 7/8
+of the limit), so that a full cache doesn't scan on every put either. Other processes' writes are only seen by a
+scan, so we also rescan every RESCAN_PUTS puts.
+"""
+
+from __future__ import annotations
+import hashlib
+import os
+import tempfile
+
+RESCAN_PUTS = 1024
+
+
+def cache_root() -> str:
+    if 'UBC_CACHE_DIR' in os.environ:
+        return os.environ['UBC_CACHE_DIR']
+    xdg = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg, 'ubc')
+
+
+def hash_key(*parts: str | bytes) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        data = part.encode('utf-8') if isinstance(part, str) else part
+        # length prefix, so that ('ab', 'c') and ('a', 'bc') differ
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # None until the first put scans the directory
+        self.estimated_bytes: int | None = None
+        self.puts_since_scan = 0
+
+    def path(self, key: str) -> str:
+        assert key.isalnum(), "keys are used as file names"
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = f.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            # never cached, or evicted by someone else in the meantime
+            return None
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.replace(tmp, self.path(key))
+
+        self.puts_since_scan += 1
+        if self.estimated_bytes is not None:
+            # overwriting an entry counts it twice, which only means we scan
+            # a bit early
+            self.estimated_bytes += len(value)
+        if (self.estimated_bytes is None or self.estimated_bytes > self.max_bytes
+                or self.puts_since_scan >= RESCAN_PUTS):
+            self.evict()
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries until we fit in max_bytes,
+        with some room to spare
+        """
+        self.puts_since_scan = 0
+        target = self.max_bytes - self.max_bytes // 8
+        entries: list[tuple[float, int, str]] = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.estimated_bytes = total
+
+    def clear(self) -> None:
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        self.estimated_bytes = 0
@@ -1,5 +1,5 @@
 import dataclasses
-from typing import Generic, Mapping, NewType, Set, TypeAlias, TypeVar
+from typing import Generic, Mapping, NamedTuple, NewType, Set, TypeAlias, TypeVar
 from typing_extensions import assert_never
 import abc_cfg
 import source
@@ -7,6 +7,7 @@ import nip
 import ghost_code
 from utils import set_union
 from dataclasses import dataclass
+from pmap import PMap
 import provenance
 
 
@@ -88,6 +89,61 @@ def guard_var_at_node(func: Function, n: source.NodeName, var: Var[source.ProgVa
     return source.ExprVar(var.typ, incarnation)
 
 
+class Liveness(NamedTuple):
+    """ Variables live at the top of each node, that is, which might be read
+        on some path from there before being assigned
+    """
+
+    bit: Mapping[source.ExprVarT[source.ProgVarName | nip.GuardVarName], int]
+    """ variable => its bit in the bitsets """
+
+    live: Mapping[source.NodeName, int]
+    """ node => bitset of the live variables """
+
+    def is_live(self, n: source.NodeName, var: source.ExprVarT[source.ProgVarName | nip.GuardVarName]) -> bool:
+        return var in self.bit and (self.live[n] >> self.bit[var]) & 1 == 1
+
+
+def compute_liveness(func: ghost_code.Function) -> Liveness:
+    """ Backward dataflow, iterated until the loops stabilise
+
+    The loop targets are havoc'd at the top of the loop header (before the
+    header's own reads), so they are never live there.
+    """
+    bit: dict[source.ExprVarT[source.ProgVarName | nip.GuardVarName], int] = {}
+
+    def bitset(variables: Set[source.ExprVarT[source.ProgVarName | nip.GuardVarName]]) -> int:
+        b = 0
+        for var in variables:
+            b |= 1 << bit.setdefault(var, len(bit))
+        return b
+
+    uses = {n: bitset(source.used_variables_in_node(node))
+            for n, node in func.nodes.items()}
+    defs = {n: bitset(source.assigned_variables_in_node(func, n, with_loop_targets=False))
+            for n in func.nodes}
+    havocs = {lh: bitset(set(loop.targets)) for lh, loop in func.loops.items()}
+
+    live: dict[source.NodeName, int] = {n: 0 for n in func.cfg.all_succs}
+    changed = True
+    while changed:
+        changed = False
+        for n in func.traverse_topologically_bottom_up():
+            if n in (source.NodeNameErr, source.NodeNameRet):
+                continue
+            live_out = 0
+            for succ in func.cfg.all_succs[n]:
+                live_out |= live[succ]
+            live_in = uses[n] | (live_out & ~defs[n])
+            if lh := func.is_loop_header(n):
+                live_in &= ~havocs[lh]
+            if live_in != live[n]:
+                live[n] = live_in
+                changed = True
+
+    return Liveness(bit=bit, live=live)
+
+
 @dataclasses.dataclass
 class DSABuilder:
     original_func: ghost_code.Function
@@ -99,9 +155,12 @@ class DSABuilder:
     """
 
     incarnations: dict[source.NodeName,
-                       Mapping[source.ExprVarT[source.ProgVarName | nip.GuardVarName], IncarnationNum]]
+                       PMap[source.ExprVarT[source.ProgVarName | nip.GuardVarName], IncarnationNum]]
     """
-    node_name => prog_var_name => set of incarnation numbers
+    node_name => prog_var_name => incarnation number
+
+    The contexts are persistent maps: a node's context shares most of its
+    structure with its predecessor's.
 
     mutated during construction
     """
@@ -176,7 +235,8 @@ def get_next_dsa_var_incarnation_number_from_context(s: DSABuilder, context: Map
 
 def apply_insertions(
         s: DSABuilder,
-        new_vars: Set[source.ExprVarT[Incarnation[source.ProgVarName | nip.GuardVarName]]]) -> None:
+        new_vars: Set[source.ExprVarT[Incarnation[source.ProgVarName | nip.GuardVarName]]],
+        builder: abc_cfg.CFGBuilder) -> None:
     j = 0
     for node_name, node_insertions in s.insertions.items():
         for pred_name in s.original_func.acyclic_preds_of(node_name):
@@ -221,42 +281,25 @@ def apply_insertions(
             join_node = NodeJoiner(
                 provenance.Provenance.DSA_JOINER, tuple(updates), node_name)
             s.dsa_nodes[join_node_name] = join_node
+            builder.split_edge(pred_name, node_name, join_node_name, join_node)
             assert join_node_name not in s.incarnations
 
-            incarnation_at_joiner_node: dict[source.ExprVarT[source.ProgVarName | nip.GuardVarName], IncarnationNum] = dict(
-                s.incarnations[pred_name])
-            for upd in updates:
-                incarnation_at_joiner_node[get_base_var(
-                    upd.var)] = upd.var.name.inc
-            s.incarnations[join_node_name] = incarnation_at_joiner_node
-
+            s.incarnations[join_node_name] = s.incarnations[pred_name].update(
+                (get_base_var(upd.var), upd.var.name.inc) for upd in updates)
 
-def recompute_loops_post_dsa(s: DSABuilder, dsa_loop_targets: Mapping[source.LoopHeaderName, tuple[Var[BaseVarName], ...]], new_cfg: abc_cfg.CFG) -> Mapping[source.LoopHeaderName, source.Loop[Incarnation[BaseVarName]]]:
-    abc_cfg.assert_single_loop_header_per_loop(new_cfg)
 
-    # loop header => loop nodes
-    all_loop_nodes: dict[source.LoopHeaderName,
-                         tuple[source.NodeName, ...]] = {}
-    for back_edge in new_cfg.back_edges:
-        _, loop_header = back_edge
-        loop_nodes = abc_cfg.compute_natural_loop(new_cfg, back_edge)
-
-        assert all(loop_header in new_cfg.all_doms[n]
-                   for n in loop_nodes), "the loop header should dominate all the nodes in the loop body"
-
-        all_loop_nodes[source.LoopHeaderName(loop_header)] = loop_nodes
-
-    assert all_loop_nodes.keys() == s.original_func.loops.keys(
+def recompute_loops_post_dsa(s: DSABuilder, dsa_loop_targets: Mapping[source.LoopHeaderName, tuple[Var[BaseVarName], ...]], builder: abc_cfg.CFGBuilder) -> Mapping[source.LoopHeaderName, source.Loop[Incarnation[BaseVarName]]]:
+    assert builder.loop_nodes.keys() == s.original_func.loops.keys(
     ), "loop headers should remain the same through DSA transformation"
 
     loops: dict[source.LoopHeaderName,
                 source.Loop[Incarnation[BaseVarName]]] = {}
-    for loop_header, loop_nodes in all_loop_nodes.items():
+    for loop_header, loop_nodes in builder.loop_nodes.items():
         assert set(s.original_func.loops[loop_header].nodes).issubset(
             loop_nodes), "dsa only inserts joiner nodes, all previous loop nodes should still be loop nodes"
         loops[loop_header] = source.Loop(back_edge=s.original_func.loops[loop_header].back_edge,
                                          targets=dsa_loop_targets[loop_header],
-                                         nodes=loop_nodes)
+                                         nodes=tuple(loop_nodes))
     return loops
 
 
@@ -266,16 +309,20 @@ def dsa(func: ghost_code.Function) -> Function:
     expressions into the DSA later on (used to emit the loop invariants)
     """
 
-    # for each node, for each prog variable, keep a set of possible dsa incarnations
-    # (this is going to use a lot of memory but oh well)
+    # for each node, for each prog variable, keep the incarnation at the end
+    # of the node (in persistent maps, so this doesn't use too much memory)
     #
     # when getting the latest incarnation, lookup it in the insertions for the
     # current node. If there, return the incarnation. Otherwise, look in the
     # predecessors. If they all return the same incarnation, return that.
-    # Otherwise,
+    # Otherwise, if the variable is live
     #   - fresh_var = (prog_var_name, max(inc num) + 1)
     #   - record an insertion (current node, prog_var_name, fresh_var)
     #   - return fresh_var
+    # and if it's dead (pruned DSA), nothing reads it before assigning it
+    # again, so we don't need a join node: we just return the biggest
+    # incarnation of the predecessors (so that the incarnation numbers still
+    # only increase along any path)
     #
     # at the end, apply the insertions
     # recompute cfg
@@ -285,15 +332,16 @@ def dsa(func: ghost_code.Function) -> Function:
 
     s = DSABuilder(original_func=func, insertions={},
                    dsa_nodes={}, incarnations={})
+    liveness = compute_liveness(func)
 
-    entry_context: dict[source.ExprVarT[source.ProgVarName |
-                                        nip.GuardVarName], IncarnationNum] = {}
+    entry_context: PMap[source.ExprVarT[source.ProgVarName |
+                                        nip.GuardVarName], IncarnationNum] = PMap()
     dsa_args: list[source.ExprVarT[Incarnation[source.ProgVarName |
                                                nip.GuardVarName]]] = []
     for arg in func.signature.parameters:
         dsa_args.append(make_dsa_var(
             func.variables, new_dsa_vars, arg, IncarnationBase))
-        entry_context[arg] = IncarnationBase
+        entry_context = entry_context.set(arg, IncarnationBase)
 
     assert len(set(unpack_dsa_var_name(arg.name)[0] for arg in dsa_args)) == len(
         dsa_args), "unexpected duplicate argument name"
@@ -309,31 +357,39 @@ def dsa(func: ghost_code.Function) -> Function:
 
         # build up a context (map from prog var to incarnation numbers)
         # TODO: clean this up
-        context: dict[source.ExprVarT[source.ProgVarName |
+        context: PMap[source.ExprVarT[source.ProgVarName |
                                       nip.GuardVarName], IncarnationNum]
         curr_node_insertions: dict[source.ExprVarT[source.ProgVarName | nip.GuardVarName],
                                    IncarnationNum] | None = None
+        preds = s.original_func.acyclic_preds_of(current_node)
         if current_node == func.cfg.entry:
-            context = dict(entry_context)
+            context = entry_context
+        elif len(preds) == 1:
+            # nothing to join, share the predecessor's context
+            context = s.incarnations[preds[0]]
         else:
-            context = {}
+            # start from the first predecessor's context, and only set the
+            # variables which differ
+            context = s.incarnations[preds[0]]
             curr_node_insertions = {}
 
             all_variables: set[source.ExprVarT[source.ProgVarName | nip.GuardVarName]] = set_union(set(s.incarnations[p].keys(
-            )) for p in s.original_func.acyclic_preds_of(current_node))
+            )) for p in preds)
 
             for var in all_variables:
-                possibilities = set(s.incarnations[p][var] for p in s.original_func.acyclic_preds_of(
-                    current_node) if var in s.incarnations[p])
+                possibilities = set(s.incarnations[p][var]
+                                    for p in preds if var in s.incarnations[p])
 
-                if len(possibilities) > 1:
+                if len(possibilities) > 1 and not liveness.is_live(current_node, var):
+                    context = context.set(var, max(possibilities))
+                elif len(possibilities) > 1:
                     # predecessors disagree about predecessors, we need to insert a join node
                     fresh_incarnation_number = get_next_dsa_var_incarnation_number(
                         s, current_node, var)
                     curr_node_insertions[var] = fresh_incarnation_number
-                    context[var] = fresh_incarnation_number
+                    context = context.set(var, fresh_incarnation_number)
                 elif len(possibilities) == 1:
-                    context[var] = next(iter(possibilities))
+                    context = context.set(var, next(iter(possibilities)))
                 else:
                     assert False, "I didn't think this case was possible"
 
@@ -348,7 +404,7 @@ def dsa(func: ghost_code.Function) -> Function:
                 # havoc the loop targets
                 fresh_incarnation_number = get_next_dsa_var_incarnation_number(
                     s, current_node, target)
-                context[target] = fresh_incarnation_number
+                context = context.set(target, fresh_incarnation_number)
                 targets.append(make_dsa_var(
                     func.variables,
                     new_dsa_vars,
@@ -460,21 +516,16 @@ def dsa(func: ghost_code.Function) -> Function:
         # for var, incs in added_incarnations.items():
         #     print(f'  {var.name}', incs.name[1])
 
-        curr_node_incarnations = dict(context)
-        for prog_var, dsa_var in added_incarnations.items():
-            _, incarnation_number = unpack_dsa_var_name(dsa_var.name)
-            curr_node_incarnations[prog_var] = incarnation_number
-        s.incarnations[current_node] = curr_node_incarnations
-
-    apply_insertions(s, new_dsa_vars)
+        s.incarnations[current_node] = context.update(
+            (prog_var, dsa_var.name.inc) for prog_var, dsa_var in added_incarnations.items())
 
-    # need to recompute the cfg from dsa_nodes
-    all_succs = abc_cfg.compute_all_successors_from_nodes(s.dsa_nodes)
-    cfg = abc_cfg.compute_cfg_from_all_succs(all_succs, func.cfg.entry)
+    builder = abc_cfg.CFGBuilder(func.cfg, func.loops)
+    apply_insertions(s, new_dsa_vars, builder)
+    cfg = builder.build(s.dsa_nodes)
+    abc_cfg.assert_single_loop_header_per_loop(cfg)
 
     # FIXME: this function is useless
-    loops = recompute_loops_post_dsa(s, dsa_loop_targets, cfg)
-    # loops = abc_cfg.compute_loops(s.dsa_nodes, cfg)
+    loops = recompute_loops_post_dsa(s, dsa_loop_targets, builder)
 
     assert loops.keys() == func.loops.keys()
 
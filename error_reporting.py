@@ -8,15 +8,13 @@ import sys
 import dsa
 from dsa import DSANode, DSAExprT
 import assume_prove as ap
-from typing import Optional, Set, Tuple, Sequence
+from typing import Collection, Optional, Set, Tuple, Sequence
 from typing_extensions import assert_never
 import source
 import smt
+import logic
 from provenance import *
 import nip
-import subprocess
-import textwrap
-import utils
 import parser_combinator as pc
 from dot_graph import pretty_safe_expr, pretty_safe_update
 import smt_parser
@@ -235,10 +233,12 @@ def extract_and_print_why(func: dsa.Function, reason: FailureReason, node: DSANo
         variables = [varname(v) for v in source.used_variables_in_node(node)]
         succ_node_name = node.succ_then
         succ_node = func.nodes[succ_node_name]
-        # a guard is always followed:
-        assert isinstance(succ_node, nip.NodeGuard)
-        # now the node which causes the overflow
-        succ_succ_node_name = succ_node.succ_then
+        # the node which causes the overflow, after its guard (unless nip
+        # knew its variables were initialised)
+        if isinstance(succ_node, nip.NodeGuard):
+            succ_succ_node_name = succ_node.succ_then
+        else:
+            succ_succ_node_name = succ_node_name
         succ_succ_node = func.nodes[succ_succ_node_name]
         assert isinstance(succ_succ_node, source.NodeBasic)
         if len(variables) == 0:
@@ -281,12 +281,12 @@ def extract_and_print_why(func: dsa.Function, reason: FailureReason, node: DSANo
         assert False, "unreachable"
 
 
-def get_sat(smtlib: smt.SMTLIB) -> Tuple[bool, smt.CheckSatResult]:
+def get_sat(smtlib: smt.SMTLIB, session: smt.SolverSession | None = None) -> Tuple[bool, smt.CheckSatResult]:
     """Returns a tuple, one determining if the logic used is consistent, 
     another indicating if the statements resulted in a program being unsat (verified) or sat. 
     This structure is given by how smt.make_smtlib is defined.
     """
-    results = tuple(smt.send_smtlib(smtlib, smt.Solver.Z3))
+    results = tuple(smt.send_smtlib(smtlib, smt.Solver.Z3, session))
     sz = len(results)
     assert sz >= 2
     for i in range(0, sz-1):
@@ -295,6 +295,118 @@ def get_sat(smtlib: smt.SMTLIB) -> Tuple[bool, smt.CheckSatResult]:
     return True, results[-1]
 
 
+@unique
+class Localisation(Enum):
+    REBUILD = "rebuild"
+    """ Rebuild and re-solve the whole query for every question """
+
+    INCREMENTAL = "incremental"
+    """ Declare the program once, and ask every question with
+        check-sat-assuming on the same solver
+    """
+
+    BISECT = "bisect"
+    """ Like INCREMENTAL, but binary searches over the topological order of
+        the node_ok checks instead of walking the CFG one node at a time:
+        a logarithmic number of questions (see bisect_func_smt)
+    """
+
+
+class RebuildingOracle:
+    """ Answers "assuming those nodes are ok, does the program verify?" by
+    emitting a fresh query (see smt.make_smtlib) for every question.
+    """
+
+    def __init__(self, prog: ap.AssumeProveProg, prelude_files: Sequence[str], session: smt.SolverSession):
+        self.prog = prog
+        self.prelude_files = prelude_files
+        self.session = session
+
+    def ask(self, assert_ok_nodes: Collection[source.NodeName]) -> Tuple[bool, smt.CheckSatResult]:
+        smtlib = smt.make_smtlib(self.prog, prelude_files=self.prelude_files,
+                                 assert_ok_nodes=assert_ok_nodes, extra_cmds=[])
+        return get_sat(smtlib, self.session)
+
+    def model(self, assert_ok_nodes: Collection[source.NodeName]) -> smt.Responses:
+        smtlib = smt.make_smtlib(self.prog, prelude_files=self.prelude_files,
+                                 assert_ok_nodes=assert_ok_nodes, with_model=True, extra_cmds=[])
+        return send_smtlib_model(smtlib, smt.Solver.Z3, self.session)
+
+
+class IncrementalOracle:
+    """ Same questions as the RebuildingOracle, but the program is declared
+    once on a live solver and every question is a check-sat-assuming.
+
+    The solver keeps what it learns between questions.
+
+    The answers match get_sat's: asserting the node_ok variables one after the
+    other and checking each time is consistent iff assuming all of them at
+    once is satisfiable.
+    """
+
+    def __init__(self, prog: ap.AssumeProveProg, session: smt.SolverSession):
+        self.prog = prog
+        self.session = session
+        self.defined: set[ap.NodeOkName] = set()
+        """ node_ok variables (removed by compact_prog) defined on demand """
+
+        pushed = session.push()
+        assert pushed, "the solver session failed"
+        declared = session.stream(lambda sink: smt.write_cmds(
+            sink, smt.emit_prog_cmds(prog, [])))
+        assert declared is not None
+        self.consistent = session.check_sat_assuming(
+            []) == smt.CheckSatResult.SAT
+
+    def literals(self, assert_ok_nodes: Collection[source.NodeName]) -> list[smt.SMTLIB]:
+        literals = []
+        for n in assert_ok_nodes:
+            node_ok_name = ap.node_ok_name(n)
+            node_ok = self.prog.node_ok_expr(node_ok_name)
+            if isinstance(node_ok, source.ExprVar):
+                literals.append(smt.SMTLIB(smt.identifier(node_ok.name)))
+                continue
+
+            # compact_prog merged the node into its predecessor, so it
+            # doesn't have a variable we can assume anymore: define one
+            if node_ok_name not in self.defined:
+                defined = self.session.command(smt.emit_cmd(smt.CmdDefineFun(
+                    smt.identifier(node_ok_name), (), source.type_bool, node_ok)))
+                assert defined is not None
+                self.defined.add(node_ok_name)
+            literals.append(smt.SMTLIB(smt.identifier(node_ok_name)))
+        return literals
+
+    def negated_entry(self) -> smt.SMTLIB:
+        return smt.SMTLIB(f"(not {smt.identifier(self.prog.entry)})")
+
+    def ask(self, assert_ok_nodes: Collection[source.NodeName]) -> Tuple[bool, smt.CheckSatResult]:
+        literals = self.literals(assert_ok_nodes)
+        if not self.consistent or self.session.check_sat_assuming(literals) != smt.CheckSatResult.SAT:
+            # inconsistent, adding the negated entry can't make it sat again
+            return False, smt.CheckSatResult.UNSAT
+        return True, self.session.check_sat_assuming(literals + [self.negated_entry()])
+
+    def model(self, assert_ok_nodes: Collection[source.NodeName]) -> smt.Responses:
+        literals = self.literals(assert_ok_nodes) + [self.negated_entry()]
+        output = self.session.command(smt.SMTLIB(
+            f'(check-sat-assuming ({" ".join(literals)}))\n(get-model)'))
+        assert output is not None
+        res = smt_parser.parse_responses()(output)
+        assert not isinstance(
+            res, pc.ParseError), "The smt parser doesn't handle the output here, only a small subset of SMT is parsed at the moment"
+        responses, leftover = res
+        assert leftover.strip() == ""
+        return responses
+
+    def close(self) -> None:
+        # if this fails, the pool doesn't reuse the session
+        self.session.pop()
+
+
+Oracle = RebuildingOracle | IncrementalOracle
+
+
 def pretty_node(node: source.Node[source.VarNameKind]) -> str:
     if isinstance(node, source.NodeBasic):
         return "\n".join(pretty_safe_update(u) for u in node.upds)
@@ -314,30 +426,19 @@ def pretty_node(node: source.Node[source.VarNameKind]) -> str:
         assert_never(node)
 
 
-def send_smtlib_model(smtlib: smt.SMTLIB, solver: smt.Solver) -> smt.Responses:
+def send_smtlib_model(smtlib: smt.SMTLIB, solver: smt.Solver, session: smt.SolverSession | None = None) -> smt.Responses:
     """Send command to any smt solver and returns a boolean per (check-sat)
     """
-    with utils.open_temp_file(suffix='.smt2') as (f, fullpath):
-        f.write(smtlib)
-        f.close()
-        p = subprocess.Popen(smt.get_subprocess_file(
-            solver, fullpath), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-        output, error = p.communicate()
-        ret = p.wait()
-
-        if ret != 0:
-            print("stderr:")
-            print(textwrap.indent(error.decode('utf-8'), '   '))
-            sys.exit(1)
-        lines = output.decode('utf-8')
-        fn = smt_parser.parse_responses()
-        res = fn(lines)
-        assert not isinstance(
-            res, pc.ParseError), "The smt parser doesn't handle the output here, only a small subset of SMT is parsed at the moment"
-        responses, leftover = res
-        assert leftover.strip() == ""
-        return responses
+    lines = smt.run_solver(smtlib, solver, session)
+    if lines is None:
+        sys.exit(1)
+    fn = smt_parser.parse_responses()
+    res = fn(lines)
+    assert not isinstance(
+        res, pc.ParseError), "The smt parser doesn't handle the output here, only a small subset of SMT is parsed at the moment"
+    responses, leftover = res
+    assert leftover.strip() == ""
+    return responses
 
 
 def get_relevant_responses(node_vars: Set[source.ExprVarT[ap.VarName]], responses: smt.Responses) -> None:
@@ -384,7 +485,7 @@ def node_dsa_to_node_ap(node: DSANode) -> source.Node[ap.VarName]:
         assert_never(node)
 
 
-def diagnose_error(func: dsa.Function, node_name: source.NodeName, prog: ap.AssumeProveProg, not_taken_path: Set[source.NodeName], successors: Sequence[source.NodeName], prelude_files: Sequence[str]) -> Tuple[FailureReason, source.NodeName, Optional[source.NodeName]]:
+def diagnose_error(func: dsa.Function, node_name: source.NodeName, prog: ap.AssumeProveProg, not_taken_path: Set[source.NodeName], successors: Sequence[source.NodeName], oracle: Oracle) -> Tuple[FailureReason, source.NodeName, Optional[source.NodeName]]:
     node = func.nodes[node_name]
     eprint("ERROR REPORTING", style="red on white", justify="center")
     # This is our error node
@@ -397,8 +498,16 @@ def diagnose_error(func: dsa.Function, node_name: source.NodeName, prog: ap.Assu
     eprint("FAILING ASSERTION", style="red on white", justify="center")
     node_as_ap = node_dsa_to_node_ap(node)
     eprint("ASSERT", pretty_node(node_as_ap))
-    expr = ap.apply_weakest_precondition(
-        prog.nodes_script[ap.node_ok_name(node_name)])
+    # the node's own script, prog's might contain its successors' too (see
+    # assume_prove.compact_prog)
+    script = ap.make_assume_prove_script_for_node(func, node_name)
+    into, start = ap.node_ok_name(node_name), 0
+    into, start = prog.merged_into.get(into, (into, start))
+    if into in prog.nodes_script and prog.nodes_script[into][start:] == script:
+        # reuse the weakest precondition computed for the query
+        expr = prog.weakest_precondition(into, start)
+    else:
+        expr = ap.apply_weakest_precondition(script)
     eprint("FAILING ASSERT SMT", style="red on white", justify="center")
     eprint(smt.emit_cmd(smt.CmdAssert(expr)))
     if used_node_name is not None:
@@ -409,11 +518,7 @@ def diagnose_error(func: dsa.Function, node_name: source.NodeName, prog: ap.Assu
                justify="center", style="red on white")
         eprint(pretty_node(used_node_as_ap), style="magenta bold")
 
-    succ_smtlib_with_model = smt.make_smtlib(
-        prog, prelude_files=prelude_files, assert_ok_nodes=not_taken_path.union(set(successors)), with_model=True, extra_cmds=[])
-
-    succ_model = send_smtlib_model(
-        succ_smtlib_with_model, smt.Solver.Z3)
+    succ_model = oracle.model(not_taken_path.union(set(successors)))
 
     node_vars = set(
         map(ap.convert_expr_var, source.used_variables_in_node(node)))
@@ -426,7 +531,7 @@ def diagnose_error(func: dsa.Function, node_name: source.NodeName, prog: ap.Assu
     return (reason, node_name, used_node_name)
 
 
-def debug_func_smt(func: dsa.Function, prelude_files: Sequence[str]) -> Tuple[FailureReason, source.NodeName, Optional[source.NodeName]]:
+def debug_func_smt(func: dsa.Function, prelude_files: Sequence[str], localisation: Localisation = Localisation.INCREMENTAL) -> Tuple[FailureReason, source.NodeName, Optional[source.NodeName]]:
     """Traverses the function/graph and asks the questions (in the context of a node): 
     (q1) "If my successors are okay, does the program verify?"
     (q2) "If I am okay, does the program verify?"
@@ -434,17 +539,77 @@ def debug_func_smt(func: dsa.Function, prelude_files: Sequence[str]) -> Tuple[Fa
     the successors. 
     Given the question asked in q1 => 
         If the program does verify with the assumption in q2, the error point must be the current node. 
+
+    All the questions are asked to the same (warm) z3 process.
     """
-    prog = ap.make_prog(func)
+    prog = ap.compact_prog(ap.make_prog(func))
+    with smt.solver_pool.session(smt.Solver.Z3, prelude_files) as session:
+        if localisation is Localisation.REBUILD:
+            return walk_func_smt(func, prog, RebuildingOracle(prog, prelude_files, session))
+        elif localisation is Localisation.INCREMENTAL:
+            oracle = IncrementalOracle(prog, session)
+            try:
+                return walk_func_smt(func, prog, oracle)
+            finally:
+                oracle.close()
+        elif localisation is Localisation.BISECT:
+            oracle = IncrementalOracle(prog, session)
+            try:
+                return bisect_func_smt(func, prog, oracle)
+            finally:
+                oracle.close()
+        else:
+            assert_never(localisation)
+
+
+def bisect_func_smt(func: dsa.Function, prog: ap.AssumeProveProg, oracle: Oracle) -> Tuple[FailureReason, source.NodeName, Optional[source.NodeName]]:
+    """Finds a failing node with a logarithmic number of questions.
+
+    Let order be the nodes in topological order, and ask
+        "If order[i:] are all okay, does the program still fail?"
+    For i = 0, the entry is assumed to be okay, so the program verifies. For
+    i = len(order), nothing is assumed, so the program fails (that's why we
+    are here). The answer is monotonic in i (assuming more can only make the
+    program verify), so we can bisect for the least i where it fails.
+
+    Then order[i-1] is the culprit: all its successors come after it in the
+    topological order, so they are assumed to be okay, and yet the program
+    fails unless we also assume order[i-1] is okay.
+    """
+
+    # Err's script is 'prove false', assuming it would be inconsistent.
+    # Assuming Ret tells us nothing.
+    order = list(func.traverse_topologically(skip_err_and_ret=True))
+
+    def fails_assuming_from(i: int) -> bool:
+        _, sat = oracle.ask(order[i:])
+        return sat == smt.CheckSatResult.SAT
+
+    i = logic.binary_search_least(fails_assuming_from, 0, len(order))
+    assert i is not None, "the program verifies, nothing to localise"
+    assert i > 0, "the program fails even when the entry node is assumed to be okay"
+
+    node_name = order[i - 1]
+    if not isinstance(func.nodes[node_name], source.NodeCond | source.NodeAssert):
+        # the node doesn't prove anything, it just leads straight to Err
+        assert source.NodeNameErr in func.cfg.all_succs[node_name]
+        eprint(f"node {node_name} always leads to Err")
+        print_reason(FailureReason.UnknownFailure)
+        return FailureReason.UnknownFailure, node_name, None
+
+    successors = [succ for succ in func.cfg.all_succs[node_name]
+                  if succ not in (source.NodeNameErr, source.NodeNameRet) and (node_name, succ) not in func.cfg.back_edges]
+    return diagnose_error(func, node_name, prog, set(order[i:]), successors, oracle)
+
+
+def walk_func_smt(func: dsa.Function, prog: ap.AssumeProveProg, oracle: Oracle) -> Tuple[FailureReason, source.NodeName, Optional[source.NodeName]]:
     q: set[source.NodeName] = set([func.cfg.entry])
     not_taken_path: set[source.NodeName] = set([])
     while len(q) != 0:
         node_name = q.pop()
         node = func.nodes[node_name]
         not_taken_path_and_node = not_taken_path.union(set([node_name]))
-        node_smtlib = smt.make_smtlib(
-            prog, prelude_files=prelude_files, assert_ok_nodes=not_taken_path_and_node, extra_cmds=[])
-        consistent, node_sat = get_sat(node_smtlib)
+        consistent, node_sat = oracle.ask(not_taken_path_and_node)
         assert consistent
         # we do not care about the Err and Ret node
         # what are we erasing here?
@@ -455,9 +620,7 @@ def debug_func_smt(func: dsa.Function, prelude_files: Sequence[str]) -> Tuple[Fa
         # NOTE: We do not **need** to erase Ret.
         successors = list(
             filter(lambda x: x != source.NodeNameErr and x != source.NodeNameRet and ((node_name, x) not in func.cfg.back_edges), func.cfg.all_succs[node_name]))
-        successors_smtlib = smt.make_smtlib(
-            prog, prelude_files=prelude_files, assert_ok_nodes=not_taken_path.union(set(successors)), extra_cmds=[])
-        _, successors_sat = get_sat(successors_smtlib)
+        _, successors_sat = oracle.ask(not_taken_path.union(set(successors)))
 
         # len(successors) can be 0, 1 or 2.
         # 0 means there was a NodeCond with Error and backedge
@@ -508,13 +671,12 @@ def debug_func_smt(func: dsa.Function, prelude_files: Sequence[str]) -> Tuple[Fa
                 # that the other subgraphs are correct by the usage of the not_taken_path.
                 my_succs = list(filter(lambda x: x != source.NodeNameErr and x !=
                                        source.NodeNameRet, func.cfg.all_succs[node_name]))
-                my_succ_smtlib = smt.make_smtlib(
-                    prog, prelude_files=prelude_files, assert_ok_nodes=not_taken_path.union(set(my_succs)), extra_cmds=[])
-                my_succ_const, my_succ_sat = get_sat(my_succ_smtlib)
+                my_succ_const, my_succ_sat = oracle.ask(
+                    not_taken_path.union(set(my_succs)))
                 assert my_succ_const, "Expected to be consistent"
                 assert my_succ_sat == smt.CheckSatResult.UNSAT, "Expected to pass"
 
-            return diagnose_error(func, node_name, prog, not_taken_path, successors, prelude_files)
+            return diagnose_error(func, node_name, prog, not_taken_path, successors, oracle)
 
         # handle the case where we have two paths to take
         if isinstance(node, source.NodeCond) and len(successors) == 2:
@@ -522,12 +684,10 @@ def debug_func_smt(func: dsa.Function, prelude_files: Sequence[str]) -> Tuple[Fa
             node2 = successors[1]
             not_taken_path_and_succ1 = not_taken_path.union(set([node1]))
             not_taken_path_and_succ2 = not_taken_path.union(set([node2]))
-            succ_node1_smtlib = smt.make_smtlib(
-                prog, prelude_files=prelude_files, assert_ok_nodes=not_taken_path_and_succ1, extra_cmds=[])
-            succ_node2_smtlib = smt.make_smtlib(
-                prog, prelude_files=prelude_files, assert_ok_nodes=not_taken_path_and_succ2, extra_cmds=[])
-            succ_node1_consistent, succ_node1_sat = get_sat(succ_node1_smtlib)
-            succ_node2_consistent, succ_node2_sat = get_sat(succ_node2_smtlib)
+            succ_node1_consistent, succ_node1_sat = oracle.ask(
+                not_taken_path_and_succ1)
+            succ_node2_consistent, succ_node2_sat = oracle.ask(
+                not_taken_path_and_succ2)
             # for some reason, the C parser will emit nonsense such as (assert True) => cond(when False) => assume True => Err.
             # The consistentcy is used as an "reachability analysis" of sorts.
             # This works because False `implies` True will give us False, returning an UNSAT (NOTE: this is before the UNSAT for the condition of program verification).
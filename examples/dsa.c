@@ -220,9 +220,10 @@ int arr_static()
 //     return 3;
 // }
 
-int straight_into_loop___fail_because_missing_invariant(int i)
+int straight_into_loop(int i)
 {
-    // need invariant to prove that i is initialized
+    // i is an argument, nip knows it is initialised in the loop without an
+    // invariant (see nip.compute_initialised)
     while (i < 10)
     {
         i++;
@@ -248,7 +249,7 @@ int greater_than_op___fail_overflow(int a, int b)
     return a > -b;
 }
 
-int branch_then_loop___fail_because_no_invariant(int cond, unsigned int a)
+int branch_then_loop(int cond, unsigned int a)
 {
     a = a % 100;
     if (cond)
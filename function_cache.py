@@ -0,0 +1,128 @@
+""" Remembers the verification result of functions which haven't changed.
+
+The key of a function is a hash of everything its verification depends on:
+    - its nodes (as serialised in the graph lang)
+    - the headers and specifications (ghost pre/post conditions) of its callees
+    - its own specification
+    - the definitions of the constant globals it refers to
+    - the struct layouts and the architecture
+    - the content of the prelude files
+    - the solver, the source code of this tool and the command line options
+      which change the result
+
+This is coarser than smt.query_cache (which also needs the whole pipeline to
+run to produce the SMTLIB) but lets us skip every stage for the functions
+which haven't been touched.
+"""
+
+from __future__ import annotations
+import functools
+import glob
+import os
+from typing import Mapping, Sequence
+
+import disk_cache
+import ghost_data
+import smt
+import syntax
+import target_objects
+
+
+def is_test_module(path: str) -> bool:
+    name = os.path.basename(path)
+    return name.startswith('test_') or name == 'conftest.py'
+
+
+@functools.cache
+def tool_version() -> str:
+    """ Hash of the source code of this tool (but not of its tests), any
+        change to it invalidates every entry
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    parts: list[bytes] = []
+    for path in sorted(glob.glob(os.path.join(here, '*.py'))):
+        if is_test_module(path):
+            continue
+        with open(path, 'rb') as f:
+            parts.append(f.read())
+    return disk_cache.hash_key(*parts)
+
+
+def callees(func: syntax.Function) -> set[str]:
+    return set(node.fname for node in func.nodes.values() if node.kind == 'Call')
+
+
+def referenced_const_globals(func: syntax.Function) -> set[str]:
+    """ The constant globals func refers to, and the ones their definitions
+        refer to
+    """
+    names: set[str] = set()
+    todo: list[syntax.Expr] = []
+
+    def visit(expr: syntax.Expr) -> None:
+        if expr.kind == 'ConstGlobal' and expr.name not in names:
+            names.add(expr.name)
+            todo.append(target_objects.const_globals[expr.name])
+
+    for node in func.nodes.values():
+        node.visit(lambda lval: None, visit)
+    while len(todo) > 0:
+        todo.pop().visit(visit)
+    return names
+
+
+def serialise_struct(struct: syntax.Struct) -> str:
+    xs = ['Struct', struct.name, str(struct.size), str(struct.align)]
+    for name, (_, offset, typ) in struct.fields.items():
+        xs.extend([name, str(offset)])
+        typ.serialise(xs)
+    return ' '.join(xs)
+
+
+def function_key(filename: str, func: syntax.Function, functions: Mapping[str, syntax.Function], prelude_files: Sequence[str], solver: smt.Solver, *, split_prove_conjunctions: bool) -> str:
+    """ split_prove_conjunctions: the only command line option which changes
+        the result (see split_prove_nodes)
+    """
+    parts: list[str] = [tool_version(), solver.value, repr(syntax.arch)]
+    parts.append(f'split_prove_conjunctions={split_prove_conjunctions}')
+
+    parts.extend(func.serialise())
+    parts.append(repr(ghost_data.get(filename, func.name)))
+    for callee in sorted(callees(func)):
+        parts.append(functions[callee].serialise_header())
+        parts.append(repr(ghost_data.get(filename, callee)))
+
+    for name in sorted(referenced_const_globals(func)):
+        xs = ['ConstGlobalDef', name]
+        target_objects.const_globals[name].serialise(xs)
+        parts.append(' '.join(xs))
+
+    for name in sorted(target_objects.structs):
+        parts.append(serialise_struct(target_objects.structs[name]))
+
+    for prelude in prelude_files:
+        with open(prelude) as f:
+            parts.append(f.read())
+
+    return disk_cache.hash_key(*parts)
+
+
+results_cache: disk_cache.DiskCache | None = disk_cache.DiskCache(
+    os.path.join(disk_cache.cache_root(), 'functions'), max_bytes=16 * 1024 * 1024)
+""" Verification result of previously checked functions, set to None to
+    always verify (--no-function-cache)
+"""
+
+
+def get(key: str) -> smt.VerificationResult | None:
+    if results_cache is None:
+        return None
+    cached = results_cache.get(key)
+    if cached is None:
+        return None
+    return smt.VerificationResult(cached.decode('utf-8'))
+
+
+def put(key: str, result: smt.VerificationResult) -> None:
+    if results_cache is not None:
+        results_cache.put(key, result.value.encode('utf-8'))
@@ -85,7 +85,8 @@ class Insertion(NamedTuple):
 Edge: TypeAlias = tuple[source.NodeName, source.NodeName]
 
 
-def apply_insertions(func: nip.Function, insertions: Sequence[Insertion]) -> Mapping[source.NodeName, source.Node[source.ProgVarName | nip.GuardVarName]]:
+def apply_insertions(func: nip.Function, insertions: Sequence[Insertion], builder: abc_cfg.CFGBuilder) -> Mapping[source.NodeName, source.Node[source.ProgVarName | nip.GuardVarName]]:
+    """ builder: func's cfg, the insertions are recorded on it """
     # edge -> list of insertion to apply on that edge, _in order_ (first is
     # inserted first, etc)
 
@@ -123,6 +124,12 @@ def apply_insertions(func: nip.Function, insertions: Sequence[Insertion]) -> Map
                 new_nodes[insertion.node_name] = insertion.mk_node(
                     insertion_succ)
 
+            chain_head = before_name
+            for insertion in reversed(edge_insertions[edge]):
+                builder.split_edge(after_name, chain_head, insertion.node_name,
+                                   new_nodes[insertion.node_name])
+                chain_head = insertion.node_name
+
             first_inserted_node_name: source.NodeName = edge_insertions[edge][0].node_name
             # connect node_name to the first insertion node
             if isinstance(node, source.NodeBasic | source.NodeCall | source.NodeEmpty | source.NodeAssume | source.NodeAssert):
@@ -480,12 +487,9 @@ def sprinkle_ghost_code(filename: str, func: nip.Function, unsafe_ctx: Mapping[s
     insertions.extend(sprinkle_loop_invariants(func))
     insertions.extend(sprinkle_pre_and_post_loop_iterations(func))
 
-    new_nodes = apply_insertions(func, insertions)
-    all_succs = abc_cfg.compute_all_successors_from_nodes(new_nodes)
-    cfg = abc_cfg.compute_cfg_from_all_succs(all_succs, func.cfg.entry)
-    loops = abc_cfg.compute_loops(
-        new_nodes, cfg)
-    assert loops.keys() == func.loops.keys(
-    ), "more work required: loop headers changed during conversion, need to keep ghost's loop invariant in sync"
+    builder = abc_cfg.CFGBuilder(func.cfg, func.loops)
+    new_nodes = apply_insertions(func, insertions, builder)
+    cfg = builder.build(new_nodes)
+    loops = builder.build_loops()
 
     return Function(name=func.name, variables=func.variables | new_variables, nodes=new_nodes, cfg=cfg, loops=loops, ghost=func.ghost, signature=func.signature)
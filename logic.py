@@ -18,7 +18,7 @@ from syntax import (mk_var, mk_plus, mk_uminus, mk_minus, mk_times, mk_modulus,
 
 from syntax import structs
 from target_objects import trace, printout
-from typing import List
+from typing import Callable, List
 
 
 def is_int(n):
@@ -1767,35 +1767,41 @@ def split_disjuncts(expr):
         return [expr]
 
 
-def binary_search_least(test, minimum, maximum):
-    """find least n, minimum <= n <= maximum, for which test (n)."""
+def binary_search_least(test: Callable[[int], bool], minimum: int, maximum: int) -> int | None:
+    """find least n, minimum <= n <= maximum, for which test (n).
+
+    test must be monotonic (once true, it stays true)."""
     assert maximum >= minimum
     if test(minimum):
         return minimum
     if maximum == minimum or not test(maximum):
         return None
+    # invariant: not test(minimum) and test(maximum)
     while maximum > minimum + 1:
-        cur = (minimum + maximum) / 2
+        cur = (minimum + maximum) // 2
         if test(cur):
             maximum = cur
         else:
-            minimum = cur + 1
+            minimum = cur
     assert minimum + 1 == maximum
     return maximum
 
 
-def binary_search_greatest(test, minimum, maximum):
-    """find greatest n, minimum <= n <= maximum, for which test (n)."""
+def binary_search_greatest(test: Callable[[int], bool], minimum: int, maximum: int) -> int | None:
+    """find greatest n, minimum <= n <= maximum, for which test (n).
+
+    test must be monotonic (once false, it stays false)."""
     assert maximum >= minimum
     if test(maximum):
         return maximum
     if maximum == minimum or not test(minimum):
         return None
+    # invariant: test(minimum) and not test(maximum)
     while maximum > minimum + 1:
-        cur = (minimum + maximum) / 2
+        cur = (minimum + maximum) // 2
         if test(cur):
             minimum = cur
         else:
-            maximum = cur - 1
+            maximum = cur
     assert minimum + 1 == maximum
     return minimum
@@ -8,6 +8,9 @@ from typing_extensions import assert_never
 from dot_graph import viz_function, viz_raw_function
 import error_reporting as er
 from split_prove_nodes import split_prove_nodes
+import split_obligations
+import batch
+import function_cache
 
 import syntax
 import source
@@ -16,6 +19,7 @@ import smt
 import dsa
 import nip
 import assume_prove
+import simplify
 import ghost_data
 import ghost_code
 
@@ -94,6 +98,9 @@ class CmdlineOption(Enum):
 
     QUIT_FAST = "--quit"
 
+    SPLIT_OBLIGATIONS = "--split-obligations"
+    """ One query per proof obligation, solved in parallel """
+
 
 def find_functions_by_name(function_names: Collection[str], target: str) -> str:
     if target in function_names:
@@ -121,7 +128,10 @@ def find_functions_by_name(function_names: Collection[str], target: str) -> str:
     return selected
 
 
-def run(filename: str, function_names: Collection[str], options: Collection[CmdlineOption], preludes: Sequence[str]) -> None:
+def resolve_filename(filename: str) -> str:
+    """ Expands the shorthands (dsa, kernel, all) and exits if the file
+        doesn't exist
+    """
     if filename.lower() == 'dsa':
         filename = 'examples/dsa.txt'
     elif filename.lower() == 'kernel':
@@ -135,22 +145,42 @@ def run(filename: str, function_names: Collection[str], options: Collection[Cmdl
         print("If not, don't be silly and rename it to .txt", file=sys.stderr)
         exit(1)
 
-    if os.path.isfile(filename):
-        with open(filename) as f:
-            stuff = syntax.parse_and_install_all(f, None)
-    else:
+    if not os.path.isfile(filename):
         print(f"filename {filename} should be the path of a file")
         exit(1)
+    return filename
+
+
+def run(filename: str, function_names: Collection[str], options: Collection[CmdlineOption], preludes: Sequence[str], localisation: er.Localisation = er.Localisation.INCREMENTAL) -> None:
+    filename = resolve_filename(filename)
+    with open(filename) as f:
+        # only the bodies of the functions we verify are parsed
+        stuff = syntax.parse_and_install_all(f, None, lazy=True)
 
     if len(function_names) == 0:
         print("list of functions in the file")
         for func in stuff[1].values():
-            print(f'  {func.name} ({len(func.nodes)} nodes)')
+            print(f'  {func.name} ({func.node_count()} nodes)')
 
     _, functions, _ = stuff
 
+    # the cache only records the verdict, skipping the pipeline would skip
+    # whatever these options show
+    use_function_cache = len(set(options) & {
+        CmdlineOption.SHOW_RAW, CmdlineOption.SHOW_GRAPH, CmdlineOption.SHOW_NIP, CmdlineOption.SHOW_GHOST,
+        CmdlineOption.SHOW_DSA, CmdlineOption.SHOW_AP, CmdlineOption.SHOW_SMT, CmdlineOption.SHOW_SATS,
+        CmdlineOption.EMIT_EVALS}) == 0
+
     for name in function_names:
         unsafe_func = functions[find_functions_by_name(functions.keys(), name)]
+
+        function_key = function_cache.function_key(
+            filename, unsafe_func, functions, preludes, smt.Solver.CVC5,
+            split_prove_conjunctions=CmdlineOption.SPLIT_PROVE_CONJUNCTIONS in options)
+        if use_function_cache and function_cache.get(function_key) is smt.VerificationResult.OK:
+            print("verification succeeded (unchanged since last run)", file=sys.stderr)
+            exit(0)
+
         if CmdlineOption.SHOW_RAW in options:
             viz_raw_function(unsafe_func)
 
@@ -181,25 +211,46 @@ def run(filename: str, function_names: Collection[str], options: Collection[Cmdl
             extra_cmds = ep.make_smt_commands(evals)
         validate_dsa.validate(ghost_func, dsa_func)
 
-        prog = assume_prove.make_prog(dsa_func)
+        simple_func = simplify.simplify(dsa_func)
+        prog = assume_prove.make_prog(simple_func)
         if CmdlineOption.SHOW_AP in options:
             assume_prove.pretty_print_prog(prog)
 
-        smtlib = smt.make_smtlib(prog, extra_cmds, prelude_files=preludes)
-        if CmdlineOption.SHOW_SMT in options:
-            if CmdlineOption.SHOW_LINE_NUMBERS in options:
-                lines = smtlib.splitlines()
-                w = len(str(len(lines)))
-                for i, line in enumerate(lines):
-                    print(f'{str(i).rjust(w)}  {line}')
-            else:
-                print(smtlib)
+        if CmdlineOption.SPLIT_OBLIGATIONS in options:
+            result, obligation_results = split_obligations.verify_split(
+                simple_func, prog, preludes, smt.Solver.CVC5)
+            for obligation, obligation_result in obligation_results.items():
+                if obligation_result is not smt.VerificationResult.OK:
+                    print(
+                        f"obligation {obligation}: {obligation_result.value}", file=sys.stderr)
+        else:
+            if not extra_cmds:
+                # the evals can refer to any variable, keep their definitions
+                prog = assume_prove.slice_prog(simple_func, prog)
+            compact_prog = assume_prove.compact_prog(prog)
+            query: smt.SMTLIB | smt.Query = smt.Query(
+                compact_prog, extra_cmds, prelude_files=preludes)
+            if CmdlineOption.SHOW_SMT in options:
+                smtlib = smt.make_smtlib(
+                    compact_prog, extra_cmds, prelude_files=preludes)
+                query = smtlib
+                if CmdlineOption.SHOW_LINE_NUMBERS in options:
+                    lines = smtlib.splitlines()
+                    w = len(str(len(lines)))
+                    for i, line in enumerate(lines):
+                        print(f'{str(i).rjust(w)}  {line}')
+                else:
+                    print(smtlib)
+
+            sats = tuple(smt.send_smtlib(query, smt.Solver.CVC5))
+            if CmdlineOption.SHOW_SATS in options:
+                print(sats)
+            assert len(sats) == 2
+            result = smt.parse_sats(sats)
+
+        if use_function_cache:
+            function_cache.put(function_key, result)
 
-        sats = tuple(smt.send_smtlib(smtlib, smt.Solver.CVC5))
-        if CmdlineOption.SHOW_SATS in options:
-            print(sats)
-        assert len(sats) == 2
-        result = smt.parse_sats(sats)
         if result is smt.VerificationResult.OK:
             print("verification succeeded", file=sys.stderr)
             exit(0)
@@ -210,12 +261,47 @@ def run(filename: str, function_names: Collection[str], options: Collection[Cmdl
             print("verification failed (good luck figuring out why)", file=sys.stderr)
             if CmdlineOption.QUIT_FAST in options:
                 exit(1)
-            er.debug_func_smt(dsa_func, preludes)
+            er.debug_func_smt(dsa_func, preludes, localisation)
             exit(1)
         else:
             assert_never(result)
 
 
+def run_all(filename: str, preludes: Sequence[str], jobs: int | None, expect_from_names: bool, report_path: str | None, junit_path: str | None) -> None:
+    """ Verifies every function in the file, exits with 1 if any of them
+        didn't give the expected result
+    """
+    filename = resolve_filename(filename)
+    with open(filename) as f:
+        parsed = syntax.parse_and_install_all(f, None)
+
+    job = batch.Job(filename=filename, prelude_files=preludes,
+                    solver=smt.Solver.CVC5, expect_from_names=expect_from_names)
+    reports = batch.verify_all(job, parsed, jobs)
+
+    for report in reports:
+        if report.passed:
+            continue
+        if report.error is not None:
+            print(f"{report.name}: error\n{report.error}", file=sys.stderr)
+        else:
+            assert report.result is not None
+            print(
+                f"{report.name}: expected {report.expected.value}, got {report.result.value}", file=sys.stderr)
+
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            f.write(batch.json_report(job, reports))
+    if junit_path is not None:
+        with open(junit_path, 'w') as f:
+            f.write(batch.junit_report(job, reports))
+
+    passed = sum(report.passed for report in reports)
+    print(f"{passed}/{len(reports)} functions gave the expected result",
+          file=sys.stderr)
+    exit(0 if passed == len(reports) else 1)
+
+
 def usage() -> None:
     print('usage: python3 main.py [options] <graphfile.txt> function-names...')
     print()
@@ -226,6 +312,10 @@ def usage() -> None:
     print('  --show-ap: Show the assume prove prog')
     print('  --show-smt: Show the SMT given to the solvers')
     print('  --show-sats: Show the raw results from the smt solvers (sat/unsat)')
+    print('  --localisation incremental|rebuild|bisect: How error reporting finds the failing node.')
+    print('      incremental (default) asks every question to one live solver, rebuild re-solves')
+    print('      the whole query each time, bisect binary searches over the topological order of')
+    print('      the node_ok checks (a logarithmic number of questions)')
     exit(0)
 
 
@@ -293,6 +383,29 @@ def main() -> None:
     parser.add_argument("-r", "--show-sats", help="Show the raw results from the smt solvers",
                         default=False, action="store_true")
     parser.add_argument("-p", "--preludes", default=[], nargs="+")
+    parser.add_argument("--split-obligations", help="Check each proof obligation in its own query, in parallel",
+                        default=False, action="store_true")
+    parser.add_argument("--no-smt-cache", help="Always run the solver, don't reuse the results of identical queries",
+                        default=False, action="store_true")
+    parser.add_argument("--no-parse-cache", help="Always parse the GraphLang file, don't load the snapshot of a previous parse",
+                        default=False, action="store_true")
+    parser.add_argument("--no-function-cache", help="Always verify, even the functions which haven't changed since they were last verified",
+                        default=False, action="store_true")
+    parser.add_argument("--all", help="Verify every function in the file (in parallel) instead of the given ones",
+                        default=False, action="store_true")
+    parser.add_argument("-j", "--jobs", help="Number of worker processes for --all (defaults to the number of cpus)",
+                        type=int, default=None)
+    parser.add_argument("--expect-from-names", help="With --all, functions whose name contains 'fail' are expected not to verify",
+                        default=False, action="store_true")
+    parser.add_argument("--report", help="With --all, write a JSON report to this file",
+                        type=str, default=None)
+    parser.add_argument("--junit", help="With --all, write a JUnit XML report to this file",
+                        type=str, default=None)
+    parser.add_argument("--localisation", help="How error reporting finds the failing node: "
+                        "'incremental' asks every question to one live solver, "
+                        "'rebuild' re-solves the whole query each time, "
+                        "'bisect' binary searches over the topological order of the node_ok checks",
+                        choices=[l.value for l in er.Localisation], default=er.Localisation.INCREMENTAL.value)
     args = parser.parse_args()
 
     for file in args.preludes:
@@ -300,9 +413,7 @@ def main() -> None:
             print(f"{file} does not exist")
             exit(1)
 
-    if not os.path.isfile(args.file):
-        print(f"{args.file} is not a valid file")
-        exit(1)
+    args.file = resolve_filename(args.file)
 
     if '--help' in sys.argv or '-h' in sys.argv or len(sys.argv) == 1:
         usage()
@@ -311,6 +422,19 @@ def main() -> None:
         debug()
         exit(0)
 
+    if args.no_smt_cache:
+        smt.query_cache = None
+
+    if args.no_parse_cache:
+        syntax.parse_cache = None
+
+    if args.no_function_cache:
+        function_cache.results_cache = None
+
+    if args.all:
+        run_all(args.file, args.preludes, args.jobs,
+                args.expect_from_names, args.report, args.junit)
+
     # FIXME: uh why are we doing this? just pass args straight
     options: set[CmdlineOption] = set([])
     if args.show_graph:
@@ -333,7 +457,10 @@ def main() -> None:
         options.add(CmdlineOption.EMIT_EVALS)
     if args.quit:
         options.add(CmdlineOption.QUIT_FAST)
-    run(args.file, args.fnames, options, args.preludes)
+    if args.split_obligations:
+        options.add(CmdlineOption.SPLIT_OBLIGATIONS)
+    run(args.file, args.fnames, options, args.preludes,
+        er.Localisation(args.localisation))
 
 
 # if __name__ == "__main__":
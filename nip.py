@@ -16,7 +16,7 @@ from dataclasses import dataclass
 import dataclasses
 from functools import reduce
 import abc_cfg
-from typing import Any, Callable, Iterator, Mapping, NewType, Sequence, Set, TypeAlias, overload, Tuple
+from typing import Any, Callable, Iterable, Iterator, Mapping, NamedTuple, NewType, Sequence, Set, TypeAlias, overload, Tuple
 from typing_extensions import assert_never
 from provenance import Provenance
 import source
@@ -63,21 +63,26 @@ def guard_var(var: source.ProgVar) -> GuardVar:
     return GuardVar(source.type_bool, guard_name(var.name))
 
 
-def var_deps(expr: source.ExprT[source.ProgVarName]) -> source.ExprT[GuardVarName]:
+def var_deps(expr: source.ExprT[source.ProgVarName], initialised: Set[source.ProgVar]) -> source.ExprT[GuardVarName]:
     # for now, we ignore short circuiting
     # if a = b + c, returns a#assigned = b#assigned && c#assigned
-    return reduce(source.expr_and, map(guard_var, source.all_vars_in_expr(expr)), source.expr_true)
+    #
+    # the guards of the initialised variables are true, we leave them out
+    return reduce(source.expr_and, (guard_var(v) for v in source.all_vars_in_expr(expr) if v not in initialised), source.expr_true)
 
 
-def make_state_update_for_node(node: source.Node[source.ProgVarName], new_variables: Set[source.ExprVarT[GuardVarName]]) -> Iterator[source.Update[GuardVarName]]:
+def make_state_update_for_node(node: source.Node[source.ProgVarName], new_variables: Set[source.ExprVarT[GuardVarName]], initialised: Set[source.ProgVar]) -> Iterator[source.Update[GuardVarName]]:
+    """ initialised: variables whose guard is definitely true when the node
+        runs
+    """
     if isinstance(node, source.NodeBasic):
         for upd in node.upds:
             if not source.is_loop_counter_name(upd.var.name):
                 # new variables go in LHS
                 new_variables.add(guard_var(upd.var))
-                yield source.Update(guard_var(upd.var), var_deps(upd.expr))
+                yield source.Update(guard_var(upd.var), var_deps(upd.expr, initialised))
     elif isinstance(node, source.NodeCall):
-        deps = reduce(source.expr_and, (var_deps(arg)
+        deps = reduce(source.expr_and, (var_deps(arg, initialised)
                                         for arg in node.args), source.expr_true)
         for ret in node.rets:
             assert not source.is_loop_counter_name(
@@ -90,10 +95,13 @@ def make_state_update_for_node(node: source.Node[source.ProgVarName], new_variab
         assert_never(node)
 
 
-def make_protection_for_node(node: source.Node[source.ProgVarName]) -> Tuple[Set[source.ExprVarT[GuardVarName]], source.ExprT[GuardVarName]]:
+def make_protection_for_node(node: source.Node[source.ProgVarName], initialised: Set[source.ProgVar]) -> Tuple[Set[source.ExprVarT[GuardVarName]], source.ExprT[GuardVarName]]:
+    """ initialised: variables whose guard is definitely true before the node,
+        we don't need to check them
+    """
     variables: Set[source.ExprVarT[GuardVarName]] = set()
     guards: Tuple[source.ExprVarT[GuardVarName], ...] = tuple(guard_var(
-        v) for v in source.used_variables_in_node(node) if not source.is_loop_counter_name(v.name))
+        v) for v in source.used_variables_in_node(node) if not source.is_loop_counter_name(v.name) and v not in initialised)
     variables = set(guards)
 
     # return variables, source.ExprOp(source.type_bool, source.Operator.AND, guards)
@@ -127,6 +135,120 @@ def update_node_successors(node: source.Node[source.VarNameKind], successors: Se
     assert_never(node)
 
 
+class Initialised(NamedTuple):
+    """ Variables whose guard is definitely true at the top of each node
+        (before the node's own guard), on every path from the entry
+    """
+
+    bit: Mapping[source.ProgVar, int]
+    """ variable => its bit in the bitsets """
+
+    initialised: Mapping[source.NodeName, int]
+    """ node => bitset of the initialised variables """
+
+    def variables(self, n: source.NodeName, candidates: Iterable[source.ProgVar]) -> Set[source.ProgVar]:
+        """ the candidates which are initialised at the top of n """
+        return set(v for v in candidates if v in self.bit and (self.initialised[n] >> self.bit[v]) & 1 == 1)
+
+
+def compute_initialised(func: source.Function) -> Initialised:
+    """ Forward must dataflow (intersection over all the predecessors,
+    including the back edges), iterated until the loops stabilise
+
+    It follows what the guard variables compute: the arguments are
+    initialised on entry, the variables used by a node are initialised after
+    it (otherwise, its guard jumps to Err), and an assignment initialises its
+    target iff its dependencies are initialised (see var_deps). The loop
+    counters never are.
+    """
+    bit: dict[source.ProgVar, int] = {}
+
+    def bitset(variables: Iterable[source.ProgVar]) -> int:
+        b = 0
+        for var in variables:
+            if not source.is_loop_counter_name(var.name):
+                b |= 1 << bit.setdefault(var, len(bit))
+        return b
+
+    uses = {n: bitset(source.used_variables_in_node(node))
+            for n, node in func.nodes.items()}
+    # node => (target bit, its dependencies)
+    assigns: dict[source.NodeName, list[tuple[int, int]]] = {}
+    for n, node in func.nodes.items():
+        if isinstance(node, source.NodeBasic):
+            assigns[n] = [(bitset([upd.var]), bitset(source.all_vars_in_expr(upd.expr)) | loop_counter_deps(upd.expr))
+                          for upd in node.upds if not source.is_loop_counter_name(upd.var.name)]
+        elif isinstance(node, source.NodeCall):
+            deps = 0
+            for arg in node.args:
+                deps |= bitset(source.all_vars_in_expr(arg)
+                               ) | loop_counter_deps(arg)
+            assigns[n] = [(bitset([ret]), deps) for ret in node.rets]
+
+    # before everything, which must include the parameters the body never
+    # mentions
+    entry = bitset(func.signature.parameters)
+    everything = (1 << len(bit)) - 1
+    initialised: dict[source.NodeName, int] = {
+        n: everything for n in func.nodes}
+    initialised[func.cfg.entry] = entry
+    changed = True
+    while changed:
+        changed = False
+        for n in func.traverse_topologically(skip_err_and_ret=True):
+            # if the entry is a loop header, its back edges count too
+            before = entry if n == func.cfg.entry else everything
+            for pred in func.cfg.all_preds[n]:
+                before &= after_node(pred, initialised[pred], uses, assigns)
+            if before != initialised[n]:
+                initialised[n] = before
+                changed = True
+
+    return Initialised(bit=bit, initialised=initialised)
+
+
+def loop_counter_deps(expr: source.ExprT[source.ProgVarName]) -> int:
+    """ -1 (every bit, hence never initialised) if expr reads a loop counter,
+        whose guard is always false
+    """
+    if any(source.is_loop_counter_name(v.name) for v in source.all_vars_in_expr(expr)):
+        return -1
+    return 0
+
+
+def after_node(n: source.NodeName, before: int, uses: Mapping[source.NodeName, int], assigns: Mapping[source.NodeName, Sequence[tuple[int, int]]]) -> int:
+    state = before | uses[n]
+    after = state
+    for b, deps in assigns.get(n, ()):
+        if deps & ~state == 0:
+            after |= b
+        else:
+            after &= ~b
+    return after
+
+
+def statically_checked(func: source.Function, initialised: Initialised, n: source.NodeName, used: Set[source.ProgVar]) -> Set[source.ProgVar]:
+    """ The variables n's guard doesn't need to check
+
+    When a node is both successors of a conditional node, we keep its whole
+    guard: ghost_code can't insert nodes (the call stashes) on two parallel
+    edges, the guard is their single successor.
+    """
+    preds = func.cfg.all_preds[n]
+    if len(set(preds)) != len(preds):
+        return set()
+    return initialised.variables(n, used)
+
+
+def ghost_exprs(ghost: source.Ghost[source.VarNameKind]) -> Iterator[source.ExprT[source.VarNameKind]]:
+    yield ghost.precondition
+    yield ghost.postcondition
+    yield from ghost.loop_invariants.values()
+    for it in ghost.loop_iterations.values():
+        yield it.pre_iter
+        yield it.post_iter
+
+
 class UnificationError(Exception):
     pass
 
@@ -206,13 +328,19 @@ def nip(func: source.Function) -> Function:
 
     all_guard_vars: Set[source.ExprVarT[GuardVarName]] = set([])
 
+    # we don't check the variables which are statically known to be
+    # initialised
+    initialised = compute_initialised(func)
+
     state_updates[func.cfg.entry] = tuple(
         make_initial_state(func, all_guard_vars))
     for n in func.traverse_topologically(skip_err_and_ret=True):
         node = func.nodes[n]
+        used = source.used_variables_in_node(node)
         if isinstance(node, source.NodeBasic | source.NodeCall | source.NodeCond):
             assert n not in protections
-            guard_vars, p = make_protection_for_node(node)
+            guard_vars, p = make_protection_for_node(
+                node, statically_checked(func, initialised, n, used))
             all_guard_vars = all_guard_vars | guard_vars
             if p != source.expr_true:
                 protections[n] = p
@@ -224,12 +352,45 @@ def nip(func: source.Function) -> Function:
 
         if isinstance(node, source.NodeBasic | source.NodeCall):
             assert n not in state_updates
-            upds = tuple(make_state_update_for_node(node, all_guard_vars))
+            # after the node's guard, the variables it uses are initialised
+            # (and the dependencies of its updates are some of those)
+            checked = set(
+                v for v in used if not source.is_loop_counter_name(v.name))
+            upds = tuple(make_state_update_for_node(
+                node, all_guard_vars, checked))
             if len(upds) > 0:
                 state_updates[n] = upds
         elif not isinstance(node, source.NodeEmpty | source.NodeCond):
             assert_never(node)
 
+    # only keep the guard variables something reads: the guards, the ghost
+    # code, and the updates of those
+    read = set(v for p in protections.values()
+               for v in source.all_vars_in_expr(p))
+    for expr in ghost_exprs(func.ghost):
+        read |= set(GuardVar(v.typ, GuardVarName(v.name))
+                    for v in source.all_vars_in_expr(expr) if v in all_guard_vars)
+    todo = list(read)
+    deps: dict[source.ExprVarT[GuardVarName],
+               set[source.ExprVarT[GuardVarName]]] = {}
+    for upds in state_updates.values():
+        for upd in upds:
+            deps.setdefault(upd.var, set()).update(
+                source.all_vars_in_expr(upd.expr))
+    while todo:
+        for v in deps.get(todo.pop(), ()):
+            if v not in read:
+                read.add(v)
+                todo.append(v)
+
+    for n in list(state_updates):
+        upds = tuple(upd for upd in state_updates[n] if upd.var in read)
+        if len(upds) > 0:
+            state_updates[n] = upds
+        else:
+            del state_updates[n]
+    all_guard_vars = read
+
     # Before: Node1 ----------------------------------------------> Node2
     #                             becomes
     #     or: Node1 ----------------------------------------------> Node2
@@ -285,13 +446,19 @@ def nip(func: source.Function) -> Function:
 
         new_nodes[n] = update_node_successors(node, jump_to)
 
-    all_succs = abc_cfg.compute_all_successors_from_nodes(new_nodes)
-    cfg = abc_cfg.compute_cfg_from_all_succs(all_succs, func.cfg.entry)
-    loops = abc_cfg.compute_loops(
-        new_nodes, cfg)
-
-    assert loops.keys() == func.loops.keys(
-    ), "more work required: loop headers changed during conversion, need to keep ghost's loop invariant in sync"
+    # replay the insertions to update the cfg
+    builder = abc_cfg.CFGBuilder(func.cfg, func.loops)
+    for n in protections:
+        protection_name = source.NodeName(f'guard_n{n}')
+        if protection_name in new_nodes:
+            builder.insert_before(n, protection_name,
+                                  new_nodes[protection_name])
+    for n in state_updates:
+        update_name = source.NodeName(f'upd_n{n}')
+        builder.split_edge(
+            n, builder.all_succs[n][0], update_name, new_nodes[update_name])
+    cfg = builder.build(new_nodes)
+    loops = builder.build_loops()
 
     # return Function(cfg=cfg, nodes=new_nodes, loops=loops, signature=func.signature,
     #                 name=func.name, ghost=unify_variables_to_make_ghost(func))
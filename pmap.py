@@ -0,0 +1,200 @@
+""" Persistent maps: setting a key returns a new map, which shares most of its
+structure with the old one.
+
+This is a hash array mapped trie (Bagwell, "Ideal Hash Trees"). Each node
+has up to 32 children, indexed by 5 bits of the keys' hashes, and only
+stores the children which are present (the bitmap tells which ones). Setting
+a key copies the nodes on the path from the root to that key, that is
+O(log32 n) nodes, everything else is shared with the old map.
+
+Keys whose hashes are entirely equal end up in the same collision node, a
+plain list of pairs.
+"""
+
+from __future__ import annotations
+from typing import Any, Iterable, Iterator, Mapping, TypeVar
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+class Subnode:
+    """ Marks the key slot of an entry whose value slot is a child node """
+
+
+SUBNODE = Subnode()
+
+
+class BitmapNode:
+    __slots__ = ('bitmap', 'array')
+
+    def __init__(self, bitmap: int, array: tuple[Any, ...]):
+        self.bitmap = bitmap
+        self.array = array
+        """ key0, value0, key1, value1, ... in the order of the bits
+
+        The key is SUBNODE if the value is a child node
+        """
+
+
+class CollisionNode:
+    __slots__ = ('hash', 'array')
+
+    def __init__(self, hash: int, array: tuple[Any, ...]):
+        self.hash = hash
+        self.array = array
+        """ key0, value0, key1, value1, ... all of which have the same hash """
+
+
+Node = BitmapNode | CollisionNode
+
+EMPTY = BitmapNode(0, ())
+
+
+def key_hash(key: object) -> int:
+    return hash(key) & HASH_MASK
+
+
+def node_get(node: Node, shift: int, h: int, key: object) -> tuple[bool, Any]:
+    while True:
+        if isinstance(node, CollisionNode):
+            if node.hash == h:
+                for i in range(0, len(node.array), 2):
+                    if node.array[i] == key:
+                        return True, node.array[i + 1]
+            return False, None
+
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return False, None
+        i = 2 * (node.bitmap & (bit - 1)).bit_count()
+        k = node.array[i]
+        if k is SUBNODE:
+            node = node.array[i + 1]
+            shift += BITS
+        elif k is key or k == key:
+            return True, node.array[i + 1]
+        else:
+            return False, None
+
+
+def merge(shift: int, h1: int, k1: object, v1: object, h2: int, k2: object, v2: object) -> Node:
+    """ A node with the two entries (which have different keys) """
+    if h1 == h2:
+        return CollisionNode(h1, (k1, v1, k2, v2))
+    b1 = (h1 >> shift) & MASK
+    b2 = (h2 >> shift) & MASK
+    if b1 == b2:
+        return BitmapNode(1 << b1, (SUBNODE, merge(shift + BITS, h1, k1, v1, h2, k2, v2)))
+    if b1 < b2:
+        return BitmapNode((1 << b1) | (1 << b2), (k1, v1, k2, v2))
+    return BitmapNode((1 << b1) | (1 << b2), (k2, v2, k1, v1))
+
+
+def wrap_collision(shift: int, node: CollisionNode, h: int, key: object, value: object) -> Node:
+    """ A node with the collision node and the entry (whose hash differs) """
+    b1 = (node.hash >> shift) & MASK
+    b2 = (h >> shift) & MASK
+    if b1 == b2:
+        return BitmapNode(1 << b1, (SUBNODE, wrap_collision(shift + BITS, node, h, key, value)))
+    if b1 < b2:
+        return BitmapNode((1 << b1) | (1 << b2), (SUBNODE, node, key, value))
+    return BitmapNode((1 << b1) | (1 << b2), (key, value, SUBNODE, node))
+
+
+def node_set(node: Node, shift: int, h: int, key: object, value: object) -> tuple[Node, bool]:
+    """ Returns the new node, and whether the key was added (rather than
+        replaced)
+    """
+    if isinstance(node, CollisionNode):
+        if node.hash != h:
+            return wrap_collision(shift, node, h, key, value), True
+        for i in range(0, len(node.array), 2):
+            if node.array[i] == key:
+                if node.array[i + 1] is value:
+                    return node, False
+                return CollisionNode(h, node.array[:i + 1] + (value,) + node.array[i + 2:]), False
+        return CollisionNode(h, node.array + (key, value)), True
+
+    bit = 1 << ((h >> shift) & MASK)
+    i = 2 * (node.bitmap & (bit - 1)).bit_count()
+    if not node.bitmap & bit:
+        return BitmapNode(node.bitmap | bit, node.array[:i] + (key, value) + node.array[i:]), True
+
+    k = node.array[i]
+    v = node.array[i + 1]
+    if k is SUBNODE:
+        child, added = node_set(v, shift + BITS, h, key, value)
+        if child is v:
+            return node, False
+        return BitmapNode(node.bitmap, node.array[:i + 1] + (child,) + node.array[i + 2:]), added
+    elif k is key or k == key:
+        if v is value:
+            return node, False
+        return BitmapNode(node.bitmap, node.array[:i + 1] + (value,) + node.array[i + 2:]), False
+
+    child = merge(shift + BITS, key_hash(k), k, v, h, key, value)
+    return BitmapNode(node.bitmap, node.array[:i] + (SUBNODE, child) + node.array[i + 2:]), True
+
+
+def node_items(node: Node) -> Iterator[tuple[Any, Any]]:
+    for i in range(0, len(node.array), 2):
+        if node.array[i] is SUBNODE:
+            yield from node_items(node.array[i + 1])
+        else:
+            yield node.array[i], node.array[i + 1]
+
+
+class PMap(Mapping[K, V]):
+    """ Immutable map, use set to get an updated copy """
+
+    __slots__ = ('root', 'size')
+
+    def __init__(self, items: Mapping[K, V] | Iterable[tuple[K, V]] = ()):
+        self.root: Node = EMPTY
+        self.size = 0
+        pairs = items.items() if isinstance(items, Mapping) else items
+        for key, value in pairs:
+            self.root, added = node_set(
+                self.root, 0, key_hash(key), key, value)
+            self.size += added
+
+    def set(self, key: K, value: V) -> PMap[K, V]:
+        root, added = node_set(self.root, 0, key_hash(key), key, value)
+        if root is self.root:
+            return self
+        new: PMap[K, V] = PMap()
+        new.root = root
+        new.size = self.size + added
+        return new
+
+    def update(self, items: Mapping[K, V] | Iterable[tuple[K, V]]) -> PMap[K, V]:
+        new = self
+        pairs = items.items() if isinstance(items, Mapping) else items
+        for key, value in pairs:
+            new = new.set(key, value)
+        return new
+
+    def __getitem__(self, key: K) -> V:
+        found, value = node_get(self.root, 0, key_hash(key), key)
+        if not found:
+            raise KeyError(key)
+        # mypy doesn't know what the nodes contain
+        return value  # type: ignore
+
+    def __contains__(self, key: object) -> bool:
+        return node_get(self.root, 0, key_hash(key), key)[0]
+
+    def __iter__(self) -> Iterator[K]:
+        return (key for key, _ in node_items(self.root))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        return f'PMap({dict(node_items(self.root))!r})'
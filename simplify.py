@@ -0,0 +1,302 @@
+""" Simplifies a DSA function before it's turned into an assume/prove program
+
+In DSA, every incarnation is assigned once. So when an update is a constant
+or a copy (x~3 = x~2, joiners, loop counters initialisations, nip's
+x#assigned = true, ...), its uses can refer to the right hand side directly.
+The expressions are then folded (constant bitvector arithmetic, boolean
+identities, if-then-else, implications), which turns most of nip's guards
+into true (see assume_prove.make_assume_prove_script_for_node, which drops
+the trivial branches).
+
+The updates themselves are kept, so that the function stays a valid DSA
+function (and its incarnations keep their values in the models). Nothing
+refers to the propagated ones anymore: assume_prove.slice_prog drops them.
+"""
+
+from __future__ import annotations
+import dataclasses
+from typing import Callable, Mapping, Sequence
+from typing_extensions import assert_never
+
+import dsa
+import nip
+import source
+
+
+def bits(expr: source.ExprT[source.VarNameKind]) -> int | None:
+    """ The value of a constant bitvector, None if expr isn't one
+
+    Negative numbers aren't emitted modulo their size (see
+    smt.emit_num_with_correct_type), we leave them alone.
+    """
+    if isinstance(expr, source.ExprNum) and isinstance(expr.typ, source.TypeBitVec) and 0 <= expr.num < 1 << expr.typ.size:
+        return expr.num
+    return None
+
+
+def signed(value: int, size: int) -> int:
+    if value >= 1 << (size - 1):
+        return value - (1 << size)
+    return value
+
+
+def fold_bitvec(op: source.Operator, size: int, values: Sequence[int]) -> int | bool | None:
+    """ The result of the (smt) operator on constant bitvectors of the given
+        size, None if it isn't folded
+    """
+    mask = (1 << size) - 1
+    if op is source.Operator.BW_NOT:
+        return ~values[0] & mask
+    if op in (source.Operator.WORD_CAST, source.Operator.WORD_CAST_SIGNED):
+        # the result's size is handled by the caller
+        return None
+
+    if len(values) != 2:
+        return None
+    a, b = values
+    if op is source.Operator.PLUS:
+        return (a + b) & mask
+    elif op is source.Operator.MINUS:
+        return (a - b) & mask
+    elif op is source.Operator.TIMES:
+        return (a * b) & mask
+    elif op is source.Operator.DIVIDED_BY and b != 0:
+        return a // b
+    elif op is source.Operator.MODULUS and b != 0:
+        return a % b
+    elif op is source.Operator.BW_AND:
+        return a & b
+    elif op is source.Operator.BW_OR:
+        return a | b
+    elif op is source.Operator.BW_XOR:
+        return a ^ b
+    elif op is source.Operator.SHIFT_LEFT:
+        return (a << b) & mask if b < size else 0
+    elif op is source.Operator.SHIFT_RIGHT:
+        return a >> b if b < size else 0
+    elif op is source.Operator.SIGNED_SHIFT_RIGHT:
+        return (signed(a, size) >> min(b, size)) & mask
+    elif op is source.Operator.EQUALS:
+        return a == b
+    elif op is source.Operator.LESS:
+        return a < b
+    elif op is source.Operator.LESS_EQUALS:
+        return a <= b
+    elif op is source.Operator.SIGNED_LESS:
+        return signed(a, size) < signed(b, size)
+    elif op is source.Operator.SIGNED_LESS_EQUALS:
+        return signed(a, size) <= signed(b, size)
+    return None
+
+
+def fold_cast(expr: source.ExprOpT[source.VarNameKind], value: int) -> source.ExprT[source.VarNameKind]:
+    operand = expr.operands[0]
+    assert isinstance(expr.typ, source.TypeBitVec)
+    assert isinstance(operand.typ, source.TypeBitVec)
+    if expr.operator is source.Operator.WORD_CAST_SIGNED and expr.typ.size > operand.typ.size:
+        value = signed(value, operand.typ.size)
+    return source.ExprNum(expr.typ, value & ((1 << expr.typ.size) - 1))
+
+
+def bool_const(value: bool) -> source.ExprT[source.VarNameKind]:
+    return source.expr_true if value else source.expr_false
+
+
+def simplify_op(expr: source.ExprOpT[source.VarNameKind]) -> source.ExprT[source.VarNameKind]:
+    """ expr's operands are already simplified """
+    op = expr.operator
+    args = expr.operands
+    t = source.expr_true
+    f = source.expr_false
+
+    if op is source.Operator.NOT:
+        return source.expr_negate(args[0])
+
+    if op in (source.Operator.AND, source.Operator.OR):
+        absorbing, neutral = (f, t) if op is source.Operator.AND else (t, f)
+        if absorbing in args:
+            return absorbing
+        kept: list[source.ExprT[source.VarNameKind]] = []
+        for arg in args:
+            if arg is not neutral and arg not in kept:
+                kept.append(arg)
+        if len(kept) == 0:
+            return neutral
+        if len(kept) == 1:
+            return kept[0]
+        if len(kept) == len(args):
+            return expr
+        return source.ExprOp(expr.typ, op, tuple(kept))
+
+    if op is source.Operator.IMPLIES:
+        antecedent, consequent = args
+        if antecedent is f or consequent is t or antecedent is consequent:
+            return t
+        if antecedent is t:
+            return consequent
+        if consequent is f:
+            return source.expr_negate(antecedent)
+        return expr
+
+    if op is source.Operator.IF_THEN_ELSE:
+        cond, yes, no = args
+        if cond is t or yes is no:
+            return yes
+        if cond is f:
+            return no
+        if yes is t and no is f:
+            return cond
+        if yes is f and no is t:
+            return source.expr_negate(cond)
+        return expr
+
+    if op is source.Operator.EQUALS:
+        lhs, rhs = args
+        if lhs is rhs:
+            return t
+        if lhs.typ == source.type_bool:
+            for const, other in ((lhs, rhs), (rhs, lhs)):
+                if const is t:
+                    return other
+                if const is f:
+                    return source.expr_negate(other)
+
+    values = [bits(arg) for arg in args]
+    if len(values) > 0 and all(v is not None for v in values):
+        ints = [v for v in values if v is not None]
+        if op in (source.Operator.WORD_CAST, source.Operator.WORD_CAST_SIGNED):
+            return fold_cast(expr, ints[0])
+        assert isinstance(args[0].typ, source.TypeBitVec)
+        folded = fold_bitvec(op, args[0].typ.size, ints)
+        if isinstance(folded, bool):
+            return bool_const(folded)
+        if folded is not None:
+            return source.ExprNum(expr.typ, folded)
+        return expr
+
+    if len(args) == 2 and isinstance(expr.typ, source.TypeBitVec):
+        # neutral elements
+        lhs, rhs = args
+        if op in (source.Operator.PLUS, source.Operator.MINUS, source.Operator.BW_OR, source.Operator.BW_XOR, source.Operator.SHIFT_LEFT, source.Operator.SHIFT_RIGHT, source.Operator.SIGNED_SHIFT_RIGHT) and bits(rhs) == 0:
+            return lhs
+        if op in (source.Operator.PLUS, source.Operator.BW_OR, source.Operator.BW_XOR) and bits(lhs) == 0:
+            return rhs
+        if op is source.Operator.TIMES and bits(rhs) == 1:
+            return lhs
+        if op is source.Operator.TIMES and bits(lhs) == 1:
+            return rhs
+
+    return expr
+
+
+def simplify_expr(expr: source.ExprT[source.VarNameKind],
+                  substitute: Callable[[source.ExprVarT[source.VarNameKind]],
+                                       source.ExprT[source.VarNameKind]] = lambda v: v,
+                  cache: dict[source.ExprT[source.VarNameKind], source.ExprT[source.VarNameKind]] | None = None) -> source.ExprT[source.VarNameKind]:
+    """ Replaces the variables (substitute's result is simplified too) and
+        folds the constants
+
+    cache: the simplified expressions, reused as long as substitute doesn't
+    change
+    """
+    if cache is None:
+        cache = {}
+
+    def simplify(expr: source.ExprT[source.VarNameKind]) -> source.ExprT[source.VarNameKind]:
+        if expr in cache:
+            return cache[expr]
+
+        simple: source.ExprT[source.VarNameKind]
+        if isinstance(expr, source.ExprNum | source.ExprType | source.ExprSymbol):
+            simple = expr
+        elif isinstance(expr, source.ExprVar):
+            new = substitute(expr)
+            simple = expr if new is expr else simplify(new)
+        elif isinstance(expr, source.ExprOp):
+            operands = tuple(simplify(operand) for operand in expr.operands)
+            if any(new is not old for new, old in zip(operands, expr.operands)):
+                expr = source.ExprOp(expr.typ, expr.operator, operands)
+            simple = simplify_op(expr)
+        elif isinstance(expr, source.ExprFunction):
+            arguments = tuple(simplify(arg) for arg in expr.arguments)
+            if any(new is not old for new, old in zip(arguments, expr.arguments)):
+                simple = source.ExprFunction(
+                    expr.typ, expr.function_name, arguments)
+            else:
+                simple = expr
+        else:
+            assert_never(expr)
+
+        cache[expr] = simple
+        return simple
+
+    return simplify(expr)
+
+
+def propagated_definitions(func: dsa.Function) -> Mapping[dsa.Var[source.ProgVarName | nip.GuardVarName], dsa.DSAExprT]:
+    """ The updates var = e where e is a constant or a variable, which we can
+        substitute in every use of var
+
+    The update must be var's only definition (the joiners define the same
+    incarnation on each branch), and it must dominate every use of var.
+    """
+    definitions: dict[dsa.Var[source.ProgVarName | nip.GuardVarName],
+                      list[tuple[source.NodeName, dsa.DSAExprT]]] = {}
+    for n, node in func.nodes.items():
+        if isinstance(node, source.NodeBasic):
+            for upd in node.upds:
+                definitions.setdefault(upd.var, []).append((n, upd.expr))
+
+    candidates = {var: defs[0] for var, defs in definitions.items()
+                  if len(defs) == 1 and is_propagatable(defs[0][1])}
+    for n, node in func.nodes.items():
+        for var in source.used_variables_in_node(node):
+            if var in candidates:
+                def_node = candidates[var][0]
+                if def_node == n or not func.cfg.dominates(def_node, n):
+                    del candidates[var]
+
+    return {var: expr for var, (_, expr) in candidates.items()}
+
+
+def is_propagatable(expr: dsa.DSAExprT) -> bool:
+    return isinstance(expr, source.ExprVar | source.ExprNum) or expr is source.expr_true or expr is source.expr_false
+
+
+def simplify_node(node: dsa.DSANode, simplify: Callable[[dsa.DSAExprT], dsa.DSAExprT]) -> dsa.DSANode:
+    # dataclasses.replace keeps the subclasses of the nodes (nip.NodeGuard,
+    # dsa.NodeJoiner, ...), see dsa.dsa
+    if isinstance(node, source.NodeBasic):
+        upds = tuple(source.Update(upd.var, simplify(upd.expr))
+                     for upd in node.upds)
+        if all(new.expr is old.expr for new, old in zip(upds, node.upds)):
+            return node
+        return dataclasses.replace(node, upds=upds)
+    elif isinstance(node, source.NodeCall):
+        args = tuple(simplify(arg) for arg in node.args)
+        if all(new is old for new, old in zip(args, node.args)):
+            return node
+        return dataclasses.replace(node, args=args)
+    elif isinstance(node, source.NodeCond | source.NodeAssume | source.NodeAssert):
+        expr = simplify(node.expr)
+        if expr is node.expr:
+            return node
+        return dataclasses.replace(node, expr=expr)
+    elif isinstance(node, source.NodeEmpty):
+        return node
+    assert_never(node)
+
+
+def simplify(func: dsa.Function) -> dsa.Function:
+    """ Propagates the constants and the copies, and folds the expressions of
+        every node. The CFG doesn't change.
+    """
+    definitions = propagated_definitions(func)
+
+    def substitute(var: dsa.Var[source.ProgVarName | nip.GuardVarName]) -> dsa.DSAExprT:
+        return definitions.get(var, var)
+
+    cache: dict[dsa.DSAExprT, dsa.DSAExprT] = {}
+    nodes = {n: simplify_node(node, lambda expr: simplify_expr(expr, substitute, cache))
+             for n, node in func.nodes.items()}
+    return dataclasses.replace(func, nodes=nodes)
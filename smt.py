@@ -1,17 +1,33 @@
 from __future__ import annotations
+from contextlib import contextmanager, suppress
 from enum import Enum
+import atexit
+import functools
+import hashlib
+import io
+import os
 import subprocess
-from typing import Any, Collection, Iterator, Literal, Mapping, Sequence
+import threading
+from typing import Any, Callable, Collection, Iterable, Iterator, Literal, Mapping, Protocol, Sequence
 from typing_extensions import NamedTuple, NewType, assert_never
 
 import textwrap
 import assume_prove
+import disk_cache
 import source
 import re
-from utils import open_temp_file
 
 SMTLIB = NewType("SMTLIB", str)
 
+
+class Sink(Protocol):
+    """ Anything SMTLIB can be written to: an io.StringIO, a file, the stdin
+        of a solver...
+    """
+
+    def write(self, s: str, /) -> object: ...
+
+
 statically_infered_must_be_true = SMTLIB('true')
 
 ops_to_smt: Mapping[source.Operator, SMTLIB] = {
@@ -163,7 +179,7 @@ def smt_bitvec_of_size(val: int, size: int) -> SMTLIB:
     return SMTLIB(f"(_ bv{val} {size})")
 
 
-def smt_extract(msb_idx: int, lsb_idx: int, expected_num_bits: int, lhs: source.ExprT[assume_prove.VarName]) -> SMTLIB:
+def write_extract(sink: Sink, msb_idx: int, lsb_idx: int, expected_num_bits: int, lhs: source.ExprT[assume_prove.VarName]) -> None:
     """
     msb_idx: most significant bit index
     lsb_idx: least significant bit index
@@ -183,24 +199,30 @@ def smt_extract(msb_idx: int, lsb_idx: int, expected_num_bits: int, lhs: source.
     assert lhs.typ.size > msb_idx >= lsb_idx >= 0
     assert expected_num_bits == msb_idx - lsb_idx + 1
 
-    return SMTLIB(f"((_ extract {msb_idx} {lsb_idx}) {emit_expr(lhs)})")
+    sink.write(f"((_ extract {msb_idx} {lsb_idx}) ")
+    write_expr(sink, lhs)
+    sink.write(")")
 
 
-def smt_zero_extend(num_extra_bits: int, lhs: source.ExprT[assume_prove.VarName]) -> SMTLIB:
+def write_zero_extend(sink: Sink, num_extra_bits: int, lhs: source.ExprT[assume_prove.VarName]) -> None:
     # ((_ zero_extend 0) t) stands for t
     # ((_ zero_extend i) t) abbreviates (concat ((_ repeat i) #b0) t)
 
     assert num_extra_bits >= 0
-    return SMTLIB(f"((_ zero_extend {num_extra_bits}) {emit_expr(lhs)})")
+    sink.write(f"((_ zero_extend {num_extra_bits}) ")
+    write_expr(sink, lhs)
+    sink.write(")")
 
 
-def smt_sign_extend(num_extra_bits: int, lhs: source.ExprT[assume_prove.VarName]) -> SMTLIB:
+def write_sign_extend(sink: Sink, num_extra_bits: int, lhs: source.ExprT[assume_prove.VarName]) -> None:
     # ((_ sign_extend 0) t) stands for t
     # ((_ sign_extend i) t) abbreviates
     #   (concat ((_ repeat i) ((_ extract |m-1| |m-1|) t)) t)
 
     assert num_extra_bits >= 0
-    return SMTLIB(f"((_ sign_extend {num_extra_bits}) {emit_expr(lhs)})")
+    sink.write(f"((_ sign_extend {num_extra_bits}) ")
+    write_expr(sink, lhs)
+    sink.write(")")
 
 
 def emit_num_with_correct_type(expr: source.ExprNumT) -> SMTLIB:
@@ -215,22 +237,27 @@ def emit_num_with_correct_type(expr: source.ExprNumT) -> SMTLIB:
     assert False, f"{expr} not supported"
 
 
-def emit_bitvec_cast(target_typ: source.TypeBitVec, operator: Literal[source.Operator.WORD_CAST, source.Operator.WORD_CAST_SIGNED], lhs: source.ExprT[assume_prove.VarName]) -> SMTLIB:
+def write_bitvec_cast(sink: Sink, target_typ: source.TypeBitVec, operator: Literal[source.Operator.WORD_CAST, source.Operator.WORD_CAST_SIGNED], lhs: source.ExprT[assume_prove.VarName]) -> None:
     assert isinstance(lhs.typ, source.TypeBitVec)
     if lhs.typ.size == target_typ.size:
-        return emit_expr(lhs)
+        write_expr(sink, lhs)
+        return
 
     if target_typ.size < lhs.typ.size:
         # extract the bottom <target_type.size> bits
-        return smt_extract(msb_idx=target_typ.size - 1, lsb_idx=0, expected_num_bits=target_typ.size, lhs=lhs)
+        write_extract(sink, msb_idx=target_typ.size - 1, lsb_idx=0,
+                      expected_num_bits=target_typ.size, lhs=lhs)
+        return
 
     assert lhs.typ.size < target_typ.size
     if operator == source.Operator.WORD_CAST:
-        return smt_zero_extend(num_extra_bits=target_typ.size - lhs.typ.size, lhs=lhs)
+        write_zero_extend(
+            sink, num_extra_bits=target_typ.size - lhs.typ.size, lhs=lhs)
     elif operator == source.Operator.WORD_CAST_SIGNED:
-        return smt_sign_extend(num_extra_bits=target_typ.size - lhs.typ.size, lhs=lhs)
-
-    assert_never(operator)
+        write_sign_extend(
+            sink, num_extra_bits=target_typ.size - lhs.typ.size, lhs=lhs)
+    else:
+        assert_never(operator)
 
 
 def emit_expr_symbol(expr: source.ExprSymbol[Any]) -> SMTLIB:
@@ -252,34 +279,44 @@ store_word_map: Mapping[int, Identifier] = {
 }
 
 
-def emit_expr(expr: source.ExprT[assume_prove.VarName]) -> SMTLIB:
+def write_expr(sink: Sink, expr: source.ExprT[assume_prove.VarName]) -> None:
+    """ Writes the expression piece by piece, building it as a string would
+        copy every subterm once per enclosing term
+    """
     if isinstance(expr, source.ExprNum):
-        return emit_num_with_correct_type(expr)
+        sink.write(emit_num_with_correct_type(expr))
     elif isinstance(expr, source.ExprOp):
 
         # mypy isn't smart enough to understand `in`, so we split the iffs
         if expr.operator == source.Operator.WORD_CAST:
             assert len(expr.operands) == 1
             assert isinstance(expr.typ, source.TypeBitVec)
-            return emit_bitvec_cast(expr.typ, source.Operator.WORD_CAST, expr.operands[0])
+            write_bitvec_cast(sink, expr.typ, source.Operator.WORD_CAST,
+                              expr.operands[0])
+            return
 
         if expr.operator == source.Operator.WORD_CAST_SIGNED:
             assert len(expr.operands) == 1
             assert isinstance(expr.typ, source.TypeBitVec)
-            return emit_bitvec_cast(expr.typ, source.Operator.WORD_CAST_SIGNED, expr.operands[0])
+            write_bitvec_cast(sink, expr.typ, source.Operator.WORD_CAST_SIGNED,
+                              expr.operands[0])
+            return
 
         if expr.operator in source.nulary_operators:
-            return SMTLIB(ops_to_smt[expr.operator])
+            sink.write(ops_to_smt[expr.operator])
+            return
 
         if expr.operator is source.Operator.P_GLOBAL_VALID:
-            return statically_infered_must_be_true
+            sink.write(statically_infered_must_be_true)
+            return
 
         if expr.operator is source.Operator.P_ALIGN_VALID:
             assert len(expr.operands) == 2
             typ, val = expr.operands
             assert isinstance(typ, source.ExprType), typ
             if isinstance(val, source.ExprSymbol):
-                return statically_infered_must_be_true
+                sink.write(statically_infered_must_be_true)
+                return
             # return statically_infered_must_be_true
             raise NotImplementedError(
                 "PAlignValid for non symbols isn't supported")
@@ -293,13 +330,16 @@ def emit_expr(expr: source.ExprT[assume_prove.VarName]) -> SMTLIB:
             assert isinstance(
                 expr.typ, source.TypeBitVec), "Only type bitvec is supported"
 
-            as_fn_call = emit_expr(symb_or_addr)
-
             if expr.typ.size not in load_word_map.keys():
                 raise NotImplementedError(
                     f"MemAcc for BitVec of size {expr.typ.size} is not supported")
 
-            return SMTLIB(f"({load_word_map[expr.typ.size]} {emit_expr(mem)} {as_fn_call})")
+            sink.write(f"({load_word_map[expr.typ.size]} ")
+            write_expr(sink, mem)
+            sink.write(" ")
+            write_expr(sink, symb_or_addr)
+            sink.write(")")
+            return
 
         if expr.operator is source.Operator.MEM_UPDATE:
             mem, symb_or_addr, val = expr.operands
@@ -307,21 +347,43 @@ def emit_expr(expr: source.ExprT[assume_prove.VarName]) -> SMTLIB:
             if not isinstance(val.typ, source.TypeBitVec):
                 assert False, "Only type bitvec is supported"
 
-            as_fn_call = emit_expr(symb_or_addr)
-            return SMTLIB(f"({store_word_map[val.typ.size]} {emit_expr(mem)} {as_fn_call} {emit_expr(val)})")
-
-        return SMTLIB(f'({ops_to_smt[expr.operator]} {" ".join(emit_expr(op) for op in expr.operands)})')
+            sink.write(f"({store_word_map[val.typ.size]} ")
+            write_expr(sink, mem)
+            sink.write(" ")
+            write_expr(sink, symb_or_addr)
+            sink.write(" ")
+            write_expr(sink, val)
+            sink.write(")")
+            return
+
+        sink.write(f'({ops_to_smt[expr.operator]}')
+        for op in expr.operands:
+            sink.write(' ')
+            write_expr(sink, op)
+        sink.write(')')
     elif isinstance(expr, source.ExprVar):
-        return SMTLIB(f'{identifier(expr.name)}')
+        sink.write(identifier(expr.name))
     elif isinstance(expr, source.ExprSymbol):
-        return emit_expr_symbol(expr)
+        sink.write(emit_expr_symbol(expr))
     elif isinstance(expr, source.ExprType):
         assert False, "what do i do with this?"
     elif isinstance(expr, source.ExprFunction):
         if len(expr.arguments) == 0:
-            return SMTLIB(expr.function_name)
-        return SMTLIB(f'({expr.function_name} {" ".join(emit_expr(arg) for arg in expr.arguments)})')
-    assert_never(expr)
+            sink.write(expr.function_name)
+            return
+        sink.write(f'({expr.function_name}')
+        for arg in expr.arguments:
+            sink.write(' ')
+            write_expr(sink, arg)
+        sink.write(')')
+    else:
+        assert_never(expr)
+
+
+def emit_expr(expr: source.ExprT[assume_prove.VarName]) -> SMTLIB:
+    sink = io.StringIO()
+    write_expr(sink, expr)
+    return SMTLIB(sink.getvalue())
 
 
 def emit_sort(typ: source.Type) -> SMTLIB:
@@ -342,16 +404,18 @@ def emit_sort(typ: source.Type) -> SMTLIB:
     assert False, f'unhandled sort {typ}'
 
 
-def emit_cmd(cmd: Cmd) -> SMTLIB:
+def write_cmd(sink: Sink, cmd: Cmd) -> None:
     if isinstance(cmd, CmdDeclareFun):
         # (declare-fun func_name (T1 T2 ...) T)
         arg_sorts = " ".join(emit_sort(s) for s in cmd.arg_sorts)
         ret_sort = emit_sort(cmd.ret_sort)
-        return SMTLIB(f'(declare-fun {cmd.symbol} ({arg_sorts}) {ret_sort})')
+        sink.write(f'(declare-fun {cmd.symbol} ({arg_sorts}) {ret_sort})')
     elif isinstance(cmd, CmdAssert):
-        return SMTLIB(f"(assert {emit_expr(cmd.expr)})")
+        sink.write("(assert ")
+        write_expr(sink, cmd.expr)
+        sink.write(")")
     elif isinstance(cmd, CmdCheckSat):
-        return SMTLIB(f"(check-sat)")
+        sink.write(f"(check-sat)")
     elif isinstance(cmd, CmdDefineFun):
         # (define-fun func_name ((a T1) (b T2) ...) T (body))
 
@@ -363,18 +427,35 @@ def emit_cmd(cmd: Cmd) -> SMTLIB:
 
         args = ' '.join(
             f'({identifier(arg.name)} {emit_sort(arg.typ)})' for arg in cmd.args)
-        return SMTLIB(f"(define-fun {cmd.symbol} ({args}) {emit_sort(cmd.ret_sort)} {emit_expr(cmd.term)})")
+        sink.write(
+            f"(define-fun {cmd.symbol} ({args}) {emit_sort(cmd.ret_sort)} ")
+        write_expr(sink, cmd.term)
+        sink.write(")")
     elif isinstance(cmd, CmdComment):
-        if cmd.comment == '':
-            return SMTLIB('')
-        return SMTLIB('; ' + cmd.comment)
+        if cmd.comment != '':
+            sink.write('; ' + cmd.comment)
     elif isinstance(cmd, CmdSetLogic):
-        return SMTLIB(f'(set-logic {cmd.logic.value})')
+        sink.write(f'(set-logic {cmd.logic.value})')
     elif isinstance(cmd, CmdDeclareSort):
-        return SMTLIB(f"(declare-sort {cmd.symbol} {cmd.arity})")
+        sink.write(f"(declare-sort {cmd.symbol} {cmd.arity})")
     elif isinstance(cmd, CmdGetModel):
-        return SMTLIB(f"(get-model)")
-    assert_never(cmd)
+        sink.write(f"(get-model)")
+    else:
+        assert_never(cmd)
+
+
+def emit_cmd(cmd: Cmd) -> SMTLIB:
+    sink = io.StringIO()
+    write_cmd(sink, cmd)
+    return SMTLIB(sink.getvalue())
+
+
+def write_cmds(sink: Sink, cmds: Iterable[Cmd]) -> None:
+    """ One command per line, like merge_smtlib """
+    for i, cmd in enumerate(cmds):
+        if i > 0:
+            sink.write('\n')
+        write_cmd(sink, cmd)
 
 
 def cmd_assert_eq(name: assume_prove.VarName, rhs: source.ExprT[assume_prove.VarName]) -> Cmd:
@@ -468,18 +549,121 @@ def gen_mem_acc_prelude() -> SMTLIB:
     return SMTLIB(''.join(raw))
 
 
-def make_smtlib(p: assume_prove.AssumeProveProg, extra_cmds: list[Cmd], prelude_files: Sequence[str] = (), assert_ok_nodes: Collection[source.NodeName] = (), with_model: bool = False) -> SMTLIB:
+def make_smtlib_prelude(prelude_files: Sequence[str] = ()) -> SMTLIB:
+    """ Everything make_smtlib emits before the program itself
 
-    # WARN: Please look at error_reporting.get_sat
-    # before changing any of the smt emission code.
-    # The error_reporting expects a certain structure in the
-    # check-sats emitted.
+    This doesn't depend on the program, and so a solver session can load it
+    once and reuse it for every query (see SolverSession).
+    """
+    raw_prelude = ""
+    # overwritten if file prelude exists
+    if len(prelude_files) == 0:
+        raw_prelude = SMTLIB('(set-logic QF_ABV)')
+
+    # NOTE: prelude order matters
+    for file in prelude_files:
+        with open(file) as f:
+            raw_prelude += SMTLIB(f"; prelude from {file}\n")
+            raw_prelude += SMTLIB(f.read() + "\n\n")
+
+    sorts = merge_smtlib(emit_cmd(cmd) for cmd in emit_prelude())
+    return SMTLIB(raw_prelude + gen_mem_acc_prelude() + sorts + '\n')
+
+
+SHARED_PREFIX = 'shared%'
+""" Name of the define-funs introduced by share_subterms, '%' doesn't appear in
+    any other variable name
+"""
+
+
+def is_shareable(expr: source.ExprT[assume_prove.VarName]) -> bool:
+    """ Naming a leaf (or something emitted as 'true') wouldn't make the query
+        smaller, and define-fun can only return the sorts emit_sort knows
+    """
+    if isinstance(expr, source.ExprOp):
+        if expr.operator in source.nulary_operators or expr.operator in (source.Operator.P_ALIGN_VALID, source.Operator.P_GLOBAL_VALID):
+            return False
+    elif isinstance(expr, source.ExprFunction):
+        if len(expr.arguments) == 0:
+            return False
+    else:
+        return False
+
+    if isinstance(expr.typ, source.TypeBuiltin):
+        return expr.typ.builtin in (source.Builtin.BOOL, source.Builtin.MEM, source.Builtin.PMS, source.Builtin.HTD)
+    return isinstance(expr.typ, (source.TypeBitVec, source.TypeWordArray))
+
+
+def subterms(expr: source.ExprT[assume_prove.VarName]) -> Sequence[source.ExprT[assume_prove.VarName]]:
+    """ The operands emit_expr actually emits """
+    if isinstance(expr, source.ExprOp):
+        if expr.operator in (source.Operator.P_ALIGN_VALID, source.Operator.P_GLOBAL_VALID):
+            return ()
+        return expr.operands
+    elif isinstance(expr, source.ExprFunction):
+        return expr.arguments
+    return ()
+
+
+def share_subterms(exprs: Sequence[source.ExprT[assume_prove.VarName]]) -> tuple[list[CmdDefineFun], list[source.ExprT[assume_prove.VarName]]]:
+    """ Defines every subterm which is used more than once (across all the
+    exprs) with a define-fun, and replaces its uses with the name of the
+    definition.
+
+    Printed as a tree, a DAG can be exponentially bigger than itself: the wp
+    and the specs reuse big subterms (the memory, the conditions of the
+    branches, ...) all over the place. Expressions are interned, so equal
+    subterms are the same object and we can count the uses of each one
+    without comparing them structurally.
+
+    Returns the definitions (every definition comes after the ones it uses)
+    and the rewritten exprs.
+    """
+
+    uses: dict[source.ExprT[assume_prove.VarName], int] = {}
+    todo = list(exprs)
+    while todo:
+        expr = todo.pop()
+        if expr in uses:
+            uses[expr] += 1
+            continue
+        uses[expr] = 1
+        todo.extend(subterms(expr))
+
+    definitions: list[CmdDefineFun] = []
+    rewritten: dict[source.ExprT[assume_prove.VarName],
+                    source.ExprT[assume_prove.VarName]] = {}
+
+    def rewrite(expr: source.ExprT[assume_prove.VarName]) -> source.ExprT[assume_prove.VarName]:
+        if expr in rewritten:
+            return rewritten[expr]
+
+        new = expr
+        if isinstance(expr, source.ExprOp) and len(subterms(expr)) > 0:
+            new = source.ExprOp(expr.typ, expr.operator, tuple(
+                rewrite(operand) for operand in expr.operands))
+        elif isinstance(expr, source.ExprFunction):
+            new = source.ExprFunction(expr.typ, expr.function_name, tuple(
+                rewrite(arg) for arg in expr.arguments))
+
+        if uses[expr] > 1 and is_shareable(expr):
+            name = Identifier(f'{SHARED_PREFIX}{len(definitions)}')
+            definitions.append(CmdDefineFun(name, (), expr.typ, new))
+            new = source.ExprVar(expr.typ, assume_prove.VarName(name))
+
+        rewritten[expr] = new
+        return new
+
+    return definitions, [rewrite(expr) for expr in exprs]
+
+
+def emit_prog_cmds(p: assume_prove.AssumeProveProg, extra_cmds: Sequence[Cmd]) -> list[Cmd]:
+    """ Declarations and node_ok definitions of the program, no check-sat """
 
     emited_identifiers: set[Identifier] = set()
     emited_variables: set[assume_prove.VarName] = set()
 
     cmds: list[Cmd] = []
-    cmds.extend(emit_prelude())
 
     # emit all auxilary variable declaration (declare-fun node_x_ok () Bool)
     for node_ok_name in p.nodes_script:
@@ -514,43 +698,81 @@ def make_smtlib(p: assume_prove.AssumeProveProg, extra_cmds: list[Cmd], prelude_
 
     cmds.append(EmptyLine)
 
+    # emit the subterms shared by the assertions once (define-fun shared%x () <sort> ...)
+    definitions, wps = share_subterms(
+        [p.weakest_precondition(name) for name in p.nodes_script])
+    cmds.extend(definitions)
+    if definitions:
+        cmds.append(EmptyLine)
+
     # emit all assertions from nodes (node_x_ok = wp(x))
-    for node_ok_name, script in p.nodes_script.items():
-        expr = assume_prove.apply_weakest_precondition(script)
+    for node_ok_name, expr in zip(p.nodes_script, wps, strict=True):
         cmds.append(cmd_assert_eq(node_ok_name, expr))
     for extra_cmd in extra_cmds:
         cmds.append(extra_cmd)
-    cmds.append(CmdCheckSat())
-    if assert_ok_nodes is not None:
-        for ok_node in assert_ok_nodes:
-            # sanity check if this assert_additional_node actually exists
-            node_ok_name = assume_prove.node_ok_name(ok_node)
-            assert node_ok_name in p.nodes_script
+    return cmds
+
+
+class Query(NamedTuple):
+    """ The arguments of make_smtlib
+
+    A query is written straight to where it's going (see write_query and
+    run_solver) instead of being built as one big string first.
+    """
+
+    prog: assume_prove.AssumeProveProg
+    extra_cmds: Sequence[Cmd] = ()
+    prelude_files: Sequence[str] = ()
+    assert_ok_nodes: Collection[source.NodeName] = ()
+    with_model: bool = False
+
+    def cmds(self) -> list[Cmd]:
+        """ Everything after the prelude """
+
+        # WARN: Please look at error_reporting.get_sat
+        # before changing any of the smt emission code.
+        # The error_reporting expects a certain structure in the
+        # check-sats emitted.
+
+        p = self.prog
+        cmds = emit_prog_cmds(p, self.extra_cmds)
+        cmds.append(CmdCheckSat())
+        for ok_node in self.assert_ok_nodes:
+            # the node might have been compacted away (see
+            # assume_prove.compact_prog)
+            node_ok = p.node_ok_expr(assume_prove.node_ok_name(ok_node))
             cmds.append(CmdComment(
                 "WARNING: NOT A VALID PROOF RELATED SMT EXPORT This is used for error reporting only"))
-            cmds.append(CmdAssert(source.ExprVar(
-                source.type_bool, node_ok_name)))
+            cmds.append(CmdAssert(node_ok))
             cmds.append(CmdCheckSat())
 
-    cmds.append(CmdAssert(source.expr_negate(
-        source.ExprVar(source.type_bool, p.entry))))
-    cmds.append(CmdCheckSat())
+        cmds.append(CmdAssert(source.expr_negate(
+            source.ExprVar(source.type_bool, p.entry))))
+        cmds.append(CmdCheckSat())
 
-    raw_prelude = ""
-    # overwritten if file prelude exists
-    if len(prelude_files) == 0:
-        raw_prelude = SMTLIB('(set-logic QF_ABV)')
+        if self.with_model:
+            cmds.append(CmdGetModel())
+        return cmds
 
-    # NOTE: prelude order matters
-    for file in prelude_files:
-        with open(file) as f:
-            raw_prelude += SMTLIB(f"; prelude from {file}\n")
-            raw_prelude += SMTLIB(f.read() + "\n\n")
-    if with_model:
-        cmds.append(CmdGetModel())
+    def write_body(self, sink: Sink) -> None:
+        write_cmds(sink, self.cmds())
+
+    def write(self, sink: Sink) -> None:
+        sink.write(make_smtlib_prelude(self.prelude_files))
+        self.write_body(sink)
+
+
+def write_query(sink: Sink, query: SMTLIB | Query) -> None:
+    if isinstance(query, str):
+        sink.write(query)
+    else:
+        query.write(sink)
 
-    clean_smt = merge_smtlib(emit_cmd(cmd) for cmd in cmds)
-    return SMTLIB(raw_prelude + gen_mem_acc_prelude() + clean_smt)
+
+def make_smtlib(p: assume_prove.AssumeProveProg, extra_cmds: Sequence[Cmd], prelude_files: Sequence[str] = (), assert_ok_nodes: Collection[source.NodeName] = (), with_model: bool = False) -> SMTLIB:
+    sink = io.StringIO()
+    Query(p, extra_cmds, prelude_files, assert_ok_nodes, with_model).write(sink)
+    return SMTLIB(sink.getvalue())
 
 
 class CheckSatResult(Enum):
@@ -564,35 +786,352 @@ class Solver(Enum):
     CVC5 = 'cvc5'
 
 
-def get_subprocess_file(solver: Solver, filepath: str) -> Sequence[str]:
+def get_subprocess_interactive(solver: Solver) -> Sequence[str]:
+    """ Command line for a solver reading commands from its stdin """
     if solver is Solver.Z3:
-        return ["z3", "-file:"+filepath]
+        return ["z3", "-in", "-smt2"]
     elif solver is Solver.CVC5:
-        return ["cvc5", "--incremental", "--produce-models", filepath]
+        return ["cvc5", "--incremental", "--produce-models", "--lang=smt2"]
     else:
         assert_never(solver)
 
 
-def send_smtlib(smtlib: SMTLIB, solver: Solver) -> Iterator[CheckSatResult]:
-    """Send command to any smt solver and returns a boolean per (check-sat)
+class SolverSession:
+    """ A solver process kept alive between queries
+
+    The prelude (see make_smtlib_prelude) is loaded once, when the session
+    starts. Every query is then wrapped in a (push 1) ... (pop 1) pair so that
+    it leaves the session as it found it.
+
+    Queries are fed through the solver's stdin. To know where the solver's
+    answer to a query ends, we ask it to echo a marker back.
+    """
+
+    MARKER = 'ubc-session-done'
+
+    def __init__(self, solver: Solver, prelude_files: Sequence[str] = ()):
+        self.solver = solver
+        self.prelude_files = tuple(prelude_files)
+        self.prelude = make_smtlib_prelude(prelude_files)
+        self.depth = 0
+        """ number of (push 1) without a matching (pop 1) """
+
+        self.process = subprocess.Popen(get_subprocess_interactive(solver), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        output = self.command(self.prelude)
+        assert output is not None, "solver rejected the prelude"
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def command(self, smtlib: SMTLIB) -> str | None:
+        """ Sends some commands and returns the solver's answers to them
+
+        Returns None (after printing the solver's complaints) if the solver
+        reported an error.
+        """
+        return self.stream(lambda sink: sink.write(smtlib))
+
+    def stream(self, write: Callable[[Sink], object]) -> str | None:
+        """ Like command, but the commands are written (by write) straight to
+            the solver's stdin
+        """
+        stdin = self.process.stdin
+        assert stdin is not None and self.process.stdout is not None
+
+        # the solver's answers are read while the commands are written, the
+        # solver would block on a full stdout otherwise (and so would we)
+        errors: list[BaseException] = []
+
+        def feed() -> None:
+            try:
+                write(stdin)
+                stdin.write(f'\n(echo "{self.MARKER}")\n')
+                stdin.flush()
+            except BrokenPipeError:
+                # the solver died, the reader sees its output end
+                pass
+            except BaseException as e:
+                errors.append(e)
+                # the solver exits at the end of its input, so that the
+                # reader stops waiting
+                with suppress(BrokenPipeError):
+                    stdin.close()
+
+        writer = threading.Thread(target=feed)
+        writer.start()
+        try:
+            output = self.read_answers()
+        finally:
+            writer.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return output
+
+    def read_answers(self) -> str | None:
+        """ The solver's output up to the marker, None if it failed """
+        assert self.process.stdout is not None
+        lines: list[str] = []
+        while True:
+            ln = self.process.stdout.readline()
+            if ln == '':
+                # the solver died on us
+                print("stderr:")
+                print(textwrap.indent(''.join(lines), '   '))
+                return None
+            # cvc5 prints the quotes back, z3 doesn't
+            if ln.strip().strip('"') == self.MARKER:
+                break
+            lines.append(ln)
+
+        if any(ln.startswith('(error') for ln in lines):
+            print("stderr:")
+            print(textwrap.indent(''.join(lines), '   '))
+            return None
+        return ''.join(lines)
+
+    def push(self) -> bool:
+        """ False if the solver failed (or died), the session is then unusable """
+        if self.command(SMTLIB('(push 1)')) is None:
+            return False
+        self.depth += 1
+        return True
+
+    def pop(self) -> bool:
+        """ False if the solver failed (or died), the session is then unusable
+
+        The depth isn't decreased then, so that the session isn't reused (see
+        SolverPool.session).
+        """
+        assert self.depth > 0
+        if self.command(SMTLIB('(pop 1)')) is None:
+            return False
+        self.depth -= 1
+        return True
+
+    def check_sat_assuming(self, literals: Sequence[SMTLIB]) -> CheckSatResult:
+        output = self.command(
+            SMTLIB(f'(check-sat-assuming ({" ".join(literals)}))'))
+        assert output is not None
+        return CheckSatResult(output.strip())
+
+    def run(self, query: SMTLIB | Query) -> str | None:
+        """ Runs a whole query, as produced by make_smtlib
+
+        The query must have been generated with the same prelude files as this
+        session's.
+        """
+        if isinstance(query, str):
+            assert query.startswith(
+                self.prelude), "query wasn't generated with this session's prelude"
+            if not self.push():
+                return None
+            output = self.command(SMTLIB(query[len(self.prelude):]))
+        else:
+            assert tuple(
+                query.prelude_files) == self.prelude_files, "query wasn't generated with this session's prelude"
+            if not self.push():
+                return None
+            output = self.stream(query.write_body)
+        if not self.pop():
+            return None
+        return output
+
+    def close(self) -> None:
+        if self.is_alive():
+            assert self.process.stdin is not None
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class SolverPool:
+    """ Warm solver sessions, keyed by solver and prelude files """
+
+    def __init__(self) -> None:
+        self.idle: dict[tuple[Solver, tuple[str, ...]],
+                        list[SolverSession]] = {}
+
+    @contextmanager
+    def session(self, solver: Solver, prelude_files: Sequence[str] = ()) -> Iterator[SolverSession]:
+        key = (solver, tuple(prelude_files))
+        idle = self.idle.setdefault(key, [])
+        session = idle.pop() if len(idle) > 0 else SolverSession(
+            solver, prelude_files)
+        try:
+            yield session
+        finally:
+            # a session in the middle of a query can't be reused
+            if session.is_alive() and session.depth == 0:
+                idle.append(session)
+            else:
+                session.close()
+
+    def close(self) -> None:
+        for sessions in self.idle.values():
+            for session in sessions:
+                session.close()
+        self.idle.clear()
+
+
+solver_pool = SolverPool()
+atexit.register(solver_pool.close)
+
+
+@functools.cache
+def solver_version(solver: Solver) -> str:
+    p = subprocess.run([solver.value, '--version'],
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return p.stdout.decode('utf-8').strip()
+
+
+query_cache: disk_cache.DiskCache | None = disk_cache.DiskCache(
+    os.path.join(disk_cache.cache_root(), 'smt'), max_bytes=512 * 1024 * 1024)
+""" Solver outputs (check-sat results and models) of previous queries, set
+    to None to always run the solver (--no-smt-cache)
+"""
+
+
+class HashingSink:
+    """ Hashes everything written to it """
+
+    def __init__(self) -> None:
+        self.hash = hashlib.sha256()
+
+    def write(self, s: str, /) -> None:
+        self.hash.update(s.encode('utf-8'))
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class TeeSink:
+    """ Writes everything to both sinks """
+
+    def __init__(self, first: Sink, second: Sink):
+        self.first = first
+        self.second = second
+
+    def write(self, s: str, /) -> None:
+        self.first.write(s)
+        self.second.write(s)
+
+
+def run_solver(query: SMTLIB | Query, solver: Solver, session: SolverSession | None = None) -> str | None:
+    """ Runs a query and returns the solver's raw output
+
+    Returns None (after printing the solver's complaints) if the solver
+    failed.
+
+    The output is cached, keyed on the query, the solver and its version.
+    The query goes straight to the solver's stdin, hashed on the way (see
+    run_solver_process): if the output turns out to be cached once the whole
+    query is written, the solver is stopped.
+
+    In a session, only SMTLIB strings (whose key is known before they run)
+    go through the cache. The queries made of commands run on the session
+    uncached.
     """
+    if session is None:
+        return run_solver_process(query, solver, query_cache)
+    if query_cache is None or not isinstance(query, str):
+        return run_solver_uncached(query, solver, session)
+
+    key = query_key(solver, hashlib.sha256(
+        query.encode('utf-8')).hexdigest())
+    cached = query_cache.get(key)
+    if cached is not None:
+        return cached.decode('utf-8')
+    output = run_solver_uncached(query, solver, session)
+    if output is not None:
+        query_cache.put(key, output.encode('utf-8'))
+    return output
+
+
+def query_key(solver: Solver, query_hash: str) -> str:
+    return disk_cache.hash_key(solver.value, solver_version(solver), query_hash)
+
+
+def run_solver_uncached(query: SMTLIB | Query, solver: Solver, session: SolverSession | None = None) -> str | None:
+    if session is not None:
+        assert session.solver is solver
+        return session.run(query)
+    return run_solver_process(query, solver, None)
+
+
+def run_solver_process(query: SMTLIB | Query, solver: Solver, cache: disk_cache.DiskCache | None) -> str | None:
+    """ Runs the query on a fresh solver process
 
-    with open_temp_file(suffix='.smt2') as (f, fullpath):
-        print("FILE: ", fullpath)
-        f.write(smtlib)
-        f.close()
-        p = subprocess.Popen(get_subprocess_file(
-            solver, fullpath), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        output, error = p.communicate()
-        p.wait()
+    The solver parses the beginning of the query while we write the rest,
+    and communicate reads its outputs (the solver would block on a full
+    stdout or stderr otherwise, and so would we).
+
+    cache: the query is hashed as it's written, and looked up once it's
+    complete (the solver is then stopped if it's a hit). A miss is stored.
+    """
+    p = subprocess.Popen(get_subprocess_interactive(solver), stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    stdin = p.stdin
+    assert stdin is not None
+    # the writer owns stdin, communicate mustn't flush or close it
+    p.stdin = None
+    errors: list[BaseException] = []
+    hashing = HashingSink()
+    key: str | None = None
+    cached: bytes | None = None
+
+    def feed() -> None:
+        nonlocal key, cached
+        try:
+            write_query(stdin if cache is None else TeeSink(
+                stdin, hashing), query)
+            stdin.close()
+        except BrokenPipeError:
+            # the solver died, communicate gives us its complaints (and the
+            # hash is incomplete)
+            return
+        except BaseException as e:
+            errors.append(e)
+            with suppress(BrokenPipeError):
+                stdin.close()
+            return
+
+        if cache is not None:
+            key = query_key(solver, hashing.hexdigest())
+            cached = cache.get(key)
+            if cached is not None:
+                p.kill()
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    output, error = p.communicate()
+    writer.join()
+    if len(errors) > 0:
+        raise errors[0]
+    if cached is not None:
+        return cached.decode('utf-8')
     if p.returncode != 0:
         print("stderr:")
-        print(textwrap.indent(error.decode('utf-8'), '   '))
+        print(textwrap.indent(error, '   '))
+        return None
+    if cache is not None and key is not None:
+        cache.put(key, output.encode('utf-8'))
+    return output
+
+
+def send_smtlib(query: SMTLIB | Query, solver: Solver, session: SolverSession | None = None) -> Iterator[CheckSatResult]:
+    """Send command to any smt solver and returns a boolean per (check-sat)
+
+    If a session is given, the query runs on that (already running) solver
+    instead of a fresh process.
+    """
+
+    output = run_solver(query, solver, session)
+    if output is None:
         return
 
     lines = output.splitlines()
     for ln in lines:
-        yield CheckSatResult(ln.decode('utf-8'))
+        yield CheckSatResult(ln)
 
 
 class VerificationResult(Enum):
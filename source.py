@@ -1,13 +1,16 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
+from functools import cached_property
 from enum import Enum, unique
 from typing import Any, Callable, Dict, Generic, Iterator, Literal, Mapping, NamedTuple, NewType, Sequence, Set, TypeAlias, TypeVar, Tuple
 import typing
+import weakref
 from typing_extensions import assert_never
 from provenance import *
 
 import syntax
+from utils import clen
 
 if typing.TYPE_CHECKING:
     import nip
@@ -223,12 +226,59 @@ def convert_type(typ: syntax.Type) -> Type:
     raise NotImplementedError(f"Type {typ.kind} not implemented")
 
 
-@dataclass(frozen=True)
-class ABCExpr(Generic[TypeKind, VarNameKind]):
+class InternedExpr(type):
+    """ Hash consing: structurally equal expressions are the same object
+
+    Constructing an expression looks it up in a table first (keyed on its
+    class and its fields, whose operands are themselves interned). Hence, ==
+    is identity and the hash is computed once, instead of recursing through
+    the whole expression every time we put one in a set or a dict, and
+    repeated terms share memory.
+
+    The hash is still structural (rather than the object's address), so that
+    the iteration order of sets of expressions doesn't change from one run to
+    the next (with the same PYTHONHASHSEED).
+
+    The table only holds weak references, unused expressions are freed.
+    """
+
+    table: weakref.WeakValueDictionary[tuple[Any, ...],
+                                       Any] = weakref.WeakValueDictionary()
+
+    def __call__(cls, *args: Any, **kwargs: Any) -> Any:
+        expr = super().__call__(*args, **kwargs)
+        values = tuple(expr.__dict__.values())
+        key = (cls, values)
+        interned = InternedExpr.table.get(key)
+        if interned is None:
+            # the same hash as the dataclass would compute
+            object.__setattr__(expr, 'hash', hash(values))
+            InternedExpr.table[key] = expr
+            return expr
+        return interned
+
+
+@dataclass(frozen=True, eq=False)
+class ABCExpr(Generic[TypeKind, VarNameKind], metaclass=InternedExpr):
+    """ Expressions are interned (see InternedExpr), so they are compared by
+        identity
+    """
+
     typ: TypeKind
 
+    hash: int = field(init=False, repr=False)
+    """ set by InternedExpr """
 
-@dataclass(frozen=True, order=True)
+    def __hash__(self) -> int:
+        return self.hash
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # goes through the constructor, to intern the unpickled (or copied)
+        # expression
+        return type(self), tuple(getattr(self, f.name) for f in fields(self) if f.init)
+
+
+@dataclass(frozen=True, eq=False)
 class ExprVar(ABCExpr[TypeKind, VarNameKind]):
     name: VarNameKind
 
@@ -236,7 +286,7 @@ class ExprVar(ABCExpr[TypeKind, VarNameKind]):
 ExprVarT: TypeAlias = ExprVar[Type, VarNameKind]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class ExprNum(ABCExpr[TypeKind, Any]):
     num: int
 
@@ -244,7 +294,7 @@ class ExprNum(ABCExpr[TypeKind, Any]):
 ExprNumT: TypeAlias = ExprNum[Type]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class ExprType(ABCExpr[TypeKind, Any]):
     """ should have typ builtin.Type
     """
@@ -254,7 +304,7 @@ class ExprType(ABCExpr[TypeKind, Any]):
 ExprTypeT: TypeAlias = ExprType[Type]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class ExprSymbol(ABCExpr[TypeKind, Any]):
     name: str
 
@@ -265,12 +315,16 @@ FunctionName = NewType('FunctionName', str)
 """ This is an *smt* function, not a C function """
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class ExprFunction(ABCExpr[VarNameKind, TypeKind]):
     """ This is an *smt* function, not a C function """
     function_name: FunctionName
     arguments: Sequence[Expr[VarNameKind, TypeKind]]
 
+    def __post_init__(self) -> None:
+        # the arguments are often given as a list, which isn't hashable
+        object.__setattr__(self, 'arguments', tuple(self.arguments))
+
 
 ExprFunctionT: TypeAlias = ExprFunction[Type, VarNameKind]
 
@@ -406,7 +460,7 @@ pretty_binary_operators_ascii = {
 }
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class ExprOp(ABCExpr[TypeKind, VarNameKind]):
     operator: Operator
     operands: tuple[Expr[TypeKind, VarNameKind], ...]
@@ -905,54 +959,43 @@ class GhostlessFunction(Generic[VarNameKind, VarNameKind2]):
     def is_loop_latch_or_loop_entry(self, node_name: NodeName) -> bool:
         return any(self.is_loop_header(succ) is not None for succ in self.cfg.all_succs[node_name])
 
-    def acyclic_preds_of(self, node_name: NodeName) -> Iterator[NodeName]:
+    def acyclic_preds_of(self, node_name: NodeName) -> Sequence[NodeName]:
         """ returns all the direct predecessors, removing the ones that would follow back edges """
-        return (p for p in self.cfg.all_preds[node_name] if (p, node_name) not in self.cfg.back_edges)
-
-    def traverse_topologically_bottom_up(self) -> Iterator[NodeName]:
-        q: list[NodeName] = [n for n, succs in self.cfg.all_succs.items() if len(
-            [succ for succ in succs if (n, succ) not in self.cfg.back_edges]) == 0]
-        visited: set[NodeName] = set()
+        return self.cfg.acyclic_preds_of(node_name)
 
-        while q:
-            n = q.pop(-1)
-            if n in visited:
-                continue
-
-            if any(succ not in visited for succ in self.cfg.all_succs[n] if (n, succ) not in self.cfg.back_edges):
-                continue
-
-            visited.add(n)
-            yield n
-
-            for pred in self.cfg.all_preds[n]:
-                if (pred, n) not in self.cfg.back_edges:
-                    q.append(pred)
+    @cached_property
+    def topological_order(self) -> Sequence[NodeName]:
+        """ Every node (including Err and Ret) after all its predecessors
+            (ignoring back edges), computed once per function
+        """
+        names = self.cfg.indexed.names
+        order = tuple(names[i] for i in self.cfg.indexed.topological_order())
+        assert clen(n for n in order if n not in (
+            NodeNameErr, NodeNameRet)) == len(self.nodes)
+        return order
+
+    @cached_property
+    def topological_order_bottom_up(self) -> Sequence[NodeName]:
+        """ Every node after all its successors (ignoring back edges) """
+        names = self.cfg.indexed.names
+        order = tuple(names[i]
+                      for i in self.cfg.indexed.topological_order_bottom_up())
+        assert clen(n for n in order if n not in (
+            NodeNameErr, NodeNameRet)) == len(self.nodes), set(order)
+        return order
+
+    @cached_property
+    def topological_position(self) -> Mapping[NodeName, int]:
+        """ node => its index in topological_order """
+        return {n: i for i, n in enumerate(self.topological_order)}
 
-        assert len(visited - {NodeNameErr, NodeNameRet}
-                   ) == len(self.nodes), visited
+    def traverse_topologically_bottom_up(self) -> Iterator[NodeName]:
+        return iter(self.topological_order_bottom_up)
 
     def traverse_topologically(self, skip_err_and_ret: bool = False) -> Iterator[NodeName]:
-        q: list[NodeName] = [
-            n for n, preds in self.cfg.all_preds.items() if len([p for p in self.acyclic_preds_of(n)]) == 0]
-        visited: set[NodeName] = set()
-        while q:
-            n = q.pop(-1)
-            if n in visited:
-                continue
-
-            if not all(p in visited for p in self.acyclic_preds_of(n)):
-                continue
-
-            visited.add(n)
-            if n not in (NodeNameErr, NodeNameRet) or not skip_err_and_ret:
-                yield n
-
-            for succ in self.cfg.all_succs[n]:
-                if (n, succ) not in self.cfg.back_edges:
-                    q.append(succ)
-
-        assert len(visited - {NodeNameErr, NodeNameRet}) == len(self.nodes)
+        if skip_err_and_ret:
+            return (n for n in self.topological_order if n not in (NodeNameErr, NodeNameRet))
+        return iter(self.topological_order)
 
     def all_variables(self) -> Set[ExprVarT[VarNameKind]]:
         all_vars: set[ExprVarT[VarNameKind]] = set()
@@ -1164,22 +1207,9 @@ def get_function_variables(func: GhostlessFunction[ProgVarName, Any], nodes: Map
     return s
 
 
-def can_reach(fn: GhostlessFunction[ProgVarName, Any], frm: NodeName, to: NodeName) -> bool:
-    if frm == to:
-        return True
-    for pred in fn.cfg.all_preds[frm]:
-        if (pred, frm) in fn.cfg.back_edges:
-            continue
-        if can_reach(fn, pred, to):
-            return True
-    return False
-
-
 def remove_unreachable(fn: GhostlessFunction[ProgVarName, Any]) -> GhostlessFunction[ProgVarName, Any]:
-    to_remove: Set[NodeName] = set()
-    for node in fn.nodes.keys():
-        if not can_reach(fn, node, fn.cfg.entry):
-            to_remove.add(node)
+    reachable = fn.cfg.reachable_from(fn.cfg.entry)
+    to_remove = set(fn.nodes.keys()) - reachable
 
     new_nodes: Dict[NodeName, Node[ProgVarName]] = {}
     for (name_, node_) in fn.nodes.items():
@@ -0,0 +1,114 @@
+""" Splits the verification of a function into one query per proof obligation.
+
+Instead of negating node_Entry_ok once for the whole function, we produce one
+query per node which can fail (a node going to Err, or a NodeAssert). Each
+query only contains the nodes on the paths reaching that obligation. The
+other obligations on those paths are assumed to hold: this is sound because
+the first obligation to fail on any execution is checked without assuming
+itself.
+
+The queries are independent, so they are solved in parallel.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Iterator, Mapping, Sequence
+
+import assume_prove as ap
+import dsa
+import smt
+import source
+
+
+def obligations(func: dsa.Function) -> Iterator[source.NodeName]:
+    """ Nodes which can fail: assertions and anything going to Err """
+    for n in func.traverse_topologically(skip_err_and_ret=True):
+        if isinstance(func.nodes[n], source.NodeAssert) or source.NodeNameErr in func.cfg.all_succs[n]:
+            yield n
+
+
+def reaching(func: dsa.Function, obligation: source.NodeName) -> set[source.NodeName]:
+    """ The obligation and all the nodes which can reach it (ignoring back edges) """
+    seen = {obligation}
+    q = [obligation]
+    while q:
+        n = q.pop()
+        for pred in func.acyclic_preds_of(n):
+            if pred not in seen:
+                seen.add(pred)
+                q.append(pred)
+    return seen
+
+
+def make_obligation_prog(func: dsa.Function, prog: ap.AssumeProveProg, obligation: source.NodeName) -> ap.AssumeProveProg:
+    """ The assume prove program that only checks the given obligation
+
+    For the nodes reaching the obligation,
+        - going to a node which doesn't reach the obligation is fine (that
+          node's ok variable is replaced with true, and 'prove c --> true' is
+          dropped)
+        - going to Err is fine too (they are checked in another query)
+        - assertions become assumptions
+        - the definitions of the variables the remaining instructions don't
+          depend on are dropped (see assume_prove.slice_prog)
+    """
+
+    cone = {ap.node_ok_name(n) for n in reaching(func, obligation)}
+    err_ok = ap.node_ok_name(source.NodeNameErr)
+
+    nodes_script: dict[ap.NodeOkName, ap.Script] = {}
+    for node_ok_name, script in prog.nodes_script.items():
+        if node_ok_name not in cone:
+            continue
+
+        new_script: list[ap.Instruction] = []
+        for ins in script:
+            if isinstance(ins, ap.InstructionAssume):
+                new_script.append(ins)
+                continue
+
+            succs_ok = set(ap.NodeOkName(ap.VarName(var.name)) for var in source.all_vars_in_expr(
+                ins.expr) if var.name in prog.nodes_script)
+            if ins.origin == obligation:
+                if succs_ok <= {err_ok}:
+                    new_script.append(ins)
+            elif len(succs_ok) == 0:
+                new_script.append(ap.InstructionAssume(ins.expr, ins.origin))
+            elif succs_ok <= cone:
+                new_script.append(ins)
+        nodes_script[node_ok_name] = new_script
+
+    nodes_script[err_ok] = prog.nodes_script[err_ok]
+    obligation_prog = ap.AssumeProveProg(
+        nodes_script=nodes_script, entry=prog.entry, arguments=prog.arguments, variables=prog.variables)
+    # only keep what this obligation depends on
+    return ap.slice_prog(func, obligation_prog)
+
+
+def solve_obligation(prog: ap.AssumeProveProg, prelude_files: Sequence[str], solver: smt.Solver) -> smt.VerificationResult:
+    query = smt.Query(ap.compact_prog(prog), prelude_files=prelude_files)
+    sats = tuple(smt.send_smtlib(query, solver))
+    assert len(sats) == 2
+    return smt.parse_sats(sats)
+
+
+def merge_results(results: Mapping[source.NodeName, smt.VerificationResult]) -> smt.VerificationResult:
+    if smt.VerificationResult.INCONSTENT in results.values():
+        return smt.VerificationResult.INCONSTENT
+    elif smt.VerificationResult.FAIL in results.values():
+        return smt.VerificationResult.FAIL
+    return smt.VerificationResult.OK
+
+
+def verify_split(func: dsa.Function, prog: ap.AssumeProveProg, prelude_files: Sequence[str], solver: smt.Solver, jobs: int | None = None) -> tuple[smt.VerificationResult, Mapping[source.NodeName, smt.VerificationResult]]:
+    """ Returns the result for the whole function, and the result of each obligation """
+
+    obligation_progs = {n: make_obligation_prog(
+        func, prog, n) for n in obligations(func)}
+
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {n: executor.submit(solve_obligation, p, prelude_files, solver)
+                   for n, p in obligation_progs.items()}
+        results = {n: future.result() for n, future in futures.items()}
+
+    return merge_results(results), results
@@ -16,6 +16,7 @@ def split_prove_nodes(func: ghost_code.Function) -> ghost_code.Function:
     """ splits prove nodes where the expression is a conjunction of n terms into n prove nodes
     """
 
+    builder = abc_cfg.CFGBuilder(func.cfg, func.loops)
     new_nodes: dict[source.NodeName,
                     source.Node[source.ProgVarName | nip.GuardVarName]] = {}
     for node_name, node in func.nodes.items():
@@ -45,12 +46,15 @@ def split_prove_nodes(func: ghost_code.Function) -> ghost_code.Function:
             new_nodes[new_node_name] = type(node)(
                 node.origin, conjunct, succ, source.NodeNameErr)
 
-    all_succs = abc_cfg.compute_all_successors_from_nodes(new_nodes)
-    cfg = abc_cfg.compute_cfg_from_all_succs(all_succs, func.cfg.entry)
-    loops = abc_cfg.compute_loops(
-        new_nodes, cfg)
-    assert loops.keys() == func.loops.keys(
-    ), "more work required: loop headers changed during conversion, need to keep ghost's loop invariant in sync"
+        chain_head = node.succ_then
+        for i in range(len(conjuncts), 1, -1):
+            conjunct_name = source.NodeName(f"{node_name}_conjunct_{i}")
+            builder.split_edge(node_name, chain_head,
+                               conjunct_name, new_nodes[conjunct_name])
+            chain_head = conjunct_name
+
+    cfg = builder.build(new_nodes)
+    loops = builder.build_loops()
 
     return ghost_code.Function(name=func.name,
                                variables=func.variables,
@@ -9,14 +9,19 @@
 # Syntax and simple operations for types, expressions, graph nodes
 # and graph functions (functions in graph-language format).
 
+import functools
+import gc
+import hashlib
 import inspect
+import pickle
 import pprint
 import os.path
 import sys
-from typing import Dict, Tuple, Optional, Any, List, Iterable
+from typing import Callable, Dict, Tuple, Optional, Any, List, Iterable
 
 from target_objects import structs, trace, printout
 import target_objects
+import disk_cache
 
 quick_reference = """
 Quick reference on the graph language and its syntax.
@@ -455,6 +460,7 @@ class Expr:
             return self.kind == 'Op' and self.name in nm
 
     def visit(self, visit):
+        # type: (Callable[[Expr], object]) -> None
         visit(self)
         if self.kind == 'Var':
             pass
@@ -546,7 +552,7 @@ class Expr:
         elif self.kind == 'Num':
             xs.append(str(self.val))
             self.typ.serialise(xs)
-        elif self.kind == 'Var':
+        elif self.kind in ('Var', 'Symbol', 'ConstGlobal'):
             xs.append(self.name)
             self.typ.serialise(xs)
         elif self.kind == 'Type':
@@ -694,6 +700,7 @@ class Node:
             return False
 
     def visit(self, visit_lval, visit_rval):
+        # type: (Callable[[Tuple[str, Type]], object], Callable[[Expr], object]) -> None
         if self.kind == 'Basic':
             for (lv, v) in self.upds:
                 visit_lval(lv)
@@ -858,7 +865,12 @@ class Function:
                     vs.append(c)
         return rs
 
-    def serialise(self):
+    def node_count(self):
+        # type: (Function) -> int
+        return len(self.nodes)
+
+    def serialise_header(self):
+        # type: (Function) -> str
         xs = ['Function', self.name, str(len(self.inputs))]
         for (nm, typ) in self.inputs:
             xs.append(nm)
@@ -867,7 +879,11 @@ class Function:
         for (nm, typ) in self.outputs:
             xs.append(nm)
             typ.serialise(xs)
-        ss = [' '.join(xs)]
+        return ' '.join(xs)
+
+    def serialise(self):
+        # type: (Function) -> List[str]
+        ss = [self.serialise_header()]
         if not self.entry:
             return ss
         for n in self.nodes:
@@ -913,6 +929,42 @@ class Function:
         return "<syntax.Function {!r}>".format(self.name)
 
 
+class LazyFunction(Function):
+    '''A function whose body (nodes and entry) is only parsed when it is
+first used. The header (name, inputs and outputs) is parsed straight away,
+it's all that callers need.'''
+
+    def __init__(self, name, inputs, outputs):
+        # type: (LazyFunction, str, List[Tuple[str, Type]], List[Tuple[str, Type]]) -> None
+        # nodes and entry are set by __getattr__
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.body = []  # type: List[str]
+
+    def node_count(self):
+        # type: (LazyFunction) -> int
+        if 'body' in self.__dict__:
+            # one node per line, and the EntryPoint line adds a dummy node
+            return len(self.body)
+        return len(self.nodes)
+
+    def __getattr__(self, attr):
+        # type: (LazyFunction, str) -> Any
+        # only called when the attribute isn't set yet
+        if attr not in ('nodes', 'entry') or 'body' not in self.__dict__:
+            raise AttributeError(attr)
+
+        body = self.__dict__.pop('body')
+        self.nodes = {}
+        self.entry = None
+        cfg_warnings = []  # type: List[Any]
+        for line in body:
+            parse_body_line(self, line.split(), cfg_warnings)
+        print_cfg_warnings(cfg_warnings)
+        return getattr(self, attr)
+
+
 def mk_builtinTs():
     # type: () -> Dict[str, Type]
     return dict([(n, Type('Builtin', n)) for n
@@ -1164,28 +1216,103 @@ unspecified_precond_term = Expr(
     'Op', boolT, name='UnspecifiedPrecond', vals=[])
 
 
-def parse_all(lines):
-    # type: (Any) -> Tuple[Dict[str, Struct], Dict[str, Function], Dict[str, Expr]]
+parse_cache: Optional[disk_cache.DiskCache] = disk_cache.DiskCache(
+    os.path.join(disk_cache.cache_root(), 'parse'), max_bytes=256 * 1024 * 1024)
+'''Pickled results of parse_lines, keyed on the SHA256 of the input lines.
+Set to None to always parse (--no-parse-cache).'''
+
+
+@functools.cache
+def parse_cache_version():
+    # type: () -> str
+    '''The snapshots are pickled instances of the classes defined here, so
+any change to this file invalidates them.'''
+    with open(__file__, 'rb') as f:
+        return disk_cache.hash_key(f.read(), str(pickle.HIGHEST_PROTOCOL))
+
+
+def load_parse_snapshot(key):
+    # type: (str) -> Optional[Tuple[Dict[str, Struct], Dict[str, Function], Dict[str, Expr], List[Any]]]
+    if parse_cache == None:
+        return None
+    data = parse_cache.get(key)
+    if data == None:
+        return None
+    # unpickling allocates millions of objects, and the cyclic garbage
+    # collector would run over and over again for nothing
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(data)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def parse_all(lines, lazy=False):
+    # type: (Any, bool) -> Tuple[Dict[str, Struct], Dict[str, Function], Dict[str, Expr]]
     '''Toplevel parser for input information. Accepts an iterator over
-lines. See syntax.quick_reference for an explanation.'''
+lines. See syntax.quick_reference for an explanation.
+
+If these exact lines have been parsed before (by any process), the result is
+loaded from parse_cache instead.
+
+If lazy, the functions' bodies are only parsed when they are first used (see
+LazyFunction). This is cheaper than loading a snapshot when only a few
+functions are needed.'''
     sourcename = "(an anonymous source)"
     if hasattr(lines, 'name'):
         sourcename = lines.name
 
     trace('Loading syntax from %s' % sourcename)
 
+    lines = list(lines)
+    hasher = hashlib.sha256()
+    for line in lines:
+        hasher.update(line.encode('utf-8'))
+
+    key = disk_cache.hash_key(hasher.hexdigest(), parse_cache_version(),
+                              repr(arch))
+    if lazy:
+        snapshot = parse_lines(lines, lazy=True)
+    else:
+        snapshot = load_parse_snapshot(key)
+    if snapshot == None:
+        snapshot = parse_lines(lines)
+        if parse_cache != None:
+            parse_cache.put(key, pickle.dumps(
+                snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+    (structs, functions, const_globals, cfg_warnings) = snapshot
+
+    printout('VERSION_INFO SHA256SUM %s - %s' %
+             (hasher.hexdigest(), sourcename))
+    print_cfg_warnings(cfg_warnings)
+    trace('Loaded %d functions, %d structs, %d globals.'
+          % (len(functions), len(structs), len(const_globals)))
+
+    return (structs, functions, const_globals)
+
+
+def parse_lines(lines, lazy=False):
+    # type: (List[str], bool) -> Tuple[Dict[str, Struct], Dict[str, Function], Dict[str, Expr], List[Any]]
+    '''If lazy, the bodies of the functions aren't parsed (see LazyFunction),
+and so the cfg warnings only show up once they are.'''
     structs = {}
     functions = {}
     const_globals = {}
-    cfg_warnings = []
-    import hashlib
-    hasher = hashlib.sha256()
+    cfg_warnings = []  # type: List[Any]
+    current_body = None  # type: Optional[List[str]]
     for line in lines:
-        hasher.update(line.encode('utf-8'))
-        bits = line.split()
+        head = line.split(None, 1)
         # empty lines and #-comments ignored
-        if not bits or bits[0][0] == '#':
+        if not head or head[0][0] == '#':
+            continue
+        if current_body != None and head[0] not in ('Struct', 'StructField', 'ConstGlobalDef', 'Function'):
+            current_body.append(line)
+            if head[0] == 'EntryPoint':
+                current_body = None
             continue
+        bits = line.split()
         if bits[0] == 'Struct':
             # Struct <name> <size> <alignment>
             # followed by block of StructField lines
@@ -1210,42 +1337,49 @@ lines. See syntax.quick_reference for an explanation.'''
             fname = bits[1]
             (n, inputs) = parse_list(parse_arg, bits, 2)
             (_, outputs) = parse_list(parse_arg, bits, n)
-            current_function = Function(fname, inputs, outputs)
+            if lazy:
+                current_function = LazyFunction(fname, inputs, outputs)
+                current_body = current_function.body
+            else:
+                current_function = Function(fname, inputs, outputs)
             assert fname not in functions, fname
             functions[fname] = current_function
         elif bits[0] == 'EntryPoint':
-            # EntryPoint <entry point>
-            entry = node_name(bits[1])
-            # instead of setting function.entry to this value,
-            # create a dummy node. this ensures there is always
-            # at least one node (EntryPoint Ret is valid) and
-            # also that the entry point is not in a loop
-            name = fresh_node(current_function.nodes)
-            current_function.nodes[name] = Node('Basic',
-                                                entry, [])
-            current_function.entry = name
-            # ensure that the function graph is closed
-            check_cfg(current_function, warnings=cfg_warnings)
+            parse_body_line(current_function, bits, cfg_warnings)
             current_function = None
         else:
-            # <node name> <node (encoded)>
-            name = node_name(bits[0])
-            assert name not in current_function.nodes, (name, bits)
-            current_function.nodes[name] = parse_node(bits, 1)
-    printout('VERSION_INFO SHA256SUM %s - %s' %
-             (hasher.hexdigest(), sourcename))
-    print_cfg_warnings(cfg_warnings)
-    trace('Loaded %d functions, %d structs, %d globals.'
-          % (len(functions), len(structs), len(const_globals)))
-
-    return (structs, functions, const_globals)
+            parse_body_line(current_function, bits, cfg_warnings)
+
+    return (structs, functions, const_globals, cfg_warnings)
+
+
+def parse_body_line(function, bits, cfg_warnings):
+    # type: (Function, List[str], List[Any]) -> None
+    if bits[0] == 'EntryPoint':
+        # EntryPoint <entry point>
+        entry = node_name(bits[1])
+        # instead of setting function.entry to this value,
+        # create a dummy node. this ensures there is always
+        # at least one node (EntryPoint Ret is valid) and
+        # also that the entry point is not in a loop
+        name = fresh_node(function.nodes)
+        function.nodes[name] = Node('Basic',
+                                    entry, [])
+        function.entry = name
+        # ensure that the function graph is closed
+        check_cfg(function, warnings=cfg_warnings)
+    else:
+        # <node name> <node (encoded)>
+        name = node_name(bits[0])
+        assert name not in function.nodes, (name, bits)
+        function.nodes[name] = parse_node(bits, 1)
 
 
-def parse_and_install_all(lines, tag, skip_functions=None):
-    # type: (Any, Any, Optional[List[str]]) -> Tuple[Dict[str, Struct], Dict[str, Function], Dict[str, Expr]]
+def parse_and_install_all(lines, tag, skip_functions=None, lazy=False):
+    # type: (Any, Any, Optional[List[str]], bool) -> Tuple[Dict[str, Struct], Dict[str, Function], Dict[str, Expr]]
     if skip_functions == None:
         skip_functions = []
-    (structs, functions, const_globals) = parse_all(lines)
+    (structs, functions, const_globals) = parse_all(lines, lazy=lazy)
     for f in skip_functions:
         if f in functions:
             del functions[f]
@@ -0,0 +1,48 @@
+import json
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import batch
+import function_cache
+import smt
+import syntax
+
+syntax.set_arch('rv64')
+
+with open('tests/all.txt') as f:
+    parsed = syntax.parse_and_install_all(f, None)
+del f
+
+
+def test_expected_result() -> None:
+    assert batch.expected_result(
+        'tmp.overflow_fail') is smt.VerificationResult.FAIL
+    assert batch.expected_result(
+        'tmp.fails_on_purpose') is smt.VerificationResult.FAIL
+    assert batch.expected_result(
+        'tmp.failsafe') is smt.VerificationResult.OK
+    # only the last component of the name counts
+    assert batch.expected_result(
+        'tmp_fail.add') is smt.VerificationResult.OK
+
+
+def test_verify_all(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(function_cache, 'results_cache', None)
+    job = batch.Job(filename='tests/all.txt', prelude_files=[],
+                    solver=smt.Solver.Z3, expect_from_names=True)
+
+    reports = batch.verify_all(job, parsed, jobs=2)
+    assert [report.name for report in reports] == list(parsed[1])
+    assert all(report.error is None for report in reports)
+    assert all('solver' in report.timings for report in reports)
+    assert [report.result for report in reports] == [
+        report.result for report in batch.verify_all(job, parsed, jobs=1)]
+
+    summary = json.loads(batch.json_report(job, reports))
+    assert summary['passed'] + summary['failed'] == len(reports)
+    assert summary['failed'] == sum(not report.passed for report in reports)
+
+    suite = ET.fromstring(batch.junit_report(job, reports))
+    assert suite.get('tests') == str(len(reports))
+    assert len(suite.findall('testcase/failure')) == summary['failed']
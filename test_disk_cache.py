@@ -0,0 +1,99 @@
+import os
+import pathlib
+
+import pytest
+
+import function_cache
+import smt
+import syntax
+from disk_cache import DiskCache, hash_key
+
+
+def test_get_put(tmp_path: pathlib.Path) -> None:
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=1024)
+    key = hash_key('z3', 'query')
+    assert cache.get(key) is None
+    cache.put(key, b'sat\nunsat\n')
+    assert cache.get(key) == b'sat\nunsat\n'
+
+
+def test_hash_key() -> None:
+    assert hash_key('ab', 'c') != hash_key('a', 'bc')
+    assert hash_key('a', b'b') == hash_key(b'a', 'b')
+
+
+def test_evicts_least_recently_used(tmp_path: pathlib.Path) -> None:
+    cache = DiskCache(str(tmp_path), max_bytes=250)
+    for i, key in enumerate(('a', 'b', 'c')):
+        cache.put(key, bytes(100))
+        # mtime resolution might be too coarse to order the entries
+        os.utime(cache.path(key), (i, i))
+
+    # c doesn't fit, so the least recently used entry goes
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+
+    # b is now the most recently used, c the least
+    os.utime(cache.path('c'), (10, 10))
+    os.utime(cache.path('b'), (20, 20))
+    cache.put('d', bytes(100))
+    assert cache.get('c') is None
+    assert cache.get('b') is not None
+    assert cache.get('d') is not None
+
+
+def test_parse_cache(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(syntax, 'parse_cache', DiskCache(
+        str(tmp_path), max_bytes=64 * 1024 * 1024))
+    syntax.set_arch('rv64')
+
+    with open('tests/all.txt') as f:
+        lines = f.readlines()
+    parsed = syntax.parse_all(lines)
+    assert len(os.listdir(tmp_path)) == 1
+    cached = syntax.parse_all(lines)
+
+    assert cached[1].keys() == parsed[1].keys()
+    for name in parsed[1]:
+        assert cached[1][name].serialise() == parsed[1][name].serialise()
+    # a fresh copy, not the same objects
+    assert all(cached[1][name] is not parsed[1][name] for name in parsed[1])
+
+    lines.append('\n')
+    syntax.parse_all(lines)
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_caches_are_isolated() -> None:
+    # see conftest.py
+    assert syntax.parse_cache is not None and smt.query_cache is not None and function_cache.results_cache is not None
+    for cache in (syntax.parse_cache, smt.query_cache, function_cache.results_cache):
+        assert cache.directory.startswith(os.environ['UBC_CACHE_DIR'])
+
+
+def test_put_only_scans_when_full(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = DiskCache(str(tmp_path), max_bytes=1000)
+    scans = 0
+    evict = cache.evict
+
+    def counting_evict() -> None:
+        nonlocal scans
+        scans += 1
+        evict()
+    monkeypatch.setattr(cache, 'evict', counting_evict)
+
+    for i in range(9):
+        cache.put(hash_key(str(i)), bytes(100))
+    # the first put learns the size, the others keep track of it
+    assert scans == 1
+
+    # over the limit: evict down to 7/8 of it
+    cache.put(hash_key('9'), bytes(100))
+    cache.put(hash_key('10'), bytes(100))
+    assert scans == 2
+    assert len(os.listdir(tmp_path)) == 8
+
+    # which leaves room for the next put
+    cache.put(hash_key('11'), bytes(100))
+    assert scans == 2
@@ -1,15 +1,23 @@
+import io
+import os
+import pathlib
 import pytest
 import abc_cfg
+import batch
+import disk_cache
 import source
 import nip
 import dsa
 import assume_prove
+import error_reporting
+import simplify
 import smt
 import syntax
 import ghost_data
 import ghost_code
 import split_prove_nodes
-from typing import Dict
+import split_obligations
+from typing import Any, Dict
 
 # global variables are bad :(
 syntax.set_arch('rv64')
@@ -26,35 +34,90 @@ with open('examples/dsa.txt') as f:
 del f
 
 
-def verify(filename: str, unsafe_func: syntax.Function, ctx: Dict[str, syntax.Function]) -> smt.VerificationResult:
+def make_dsa(filename: str, unsafe_func: syntax.Function, ctx: Dict[str, syntax.Function]) -> dsa.Function:
     prog_func = source.convert_function(unsafe_func).with_ghost(
         ghost_data.get(filename, unsafe_func.name))
     nip_func = nip.nip(prog_func)
     ghost_func = ghost_code.sprinkle_ghost_code(filename, nip_func, ctx)
     # ghost_func = split_prove_nodes.split_prove_nodes(ghost_func)
-    dsa_func = dsa.dsa(ghost_func)
+    return dsa.dsa(ghost_func)
 
-    prog = assume_prove.make_prog(dsa_func)
-    smtlib = smt.make_smtlib(prog, [])
-    sats = tuple(smt.send_smtlib(smtlib, smt.Solver.Z3))
+
+def make_prog(filename: str, unsafe_func: syntax.Function, ctx: Dict[str, syntax.Function]) -> tuple[dsa.Function, assume_prove.AssumeProveProg]:
+    dsa_func = make_dsa(filename, unsafe_func, ctx)
+    return dsa_func, assume_prove.make_prog(dsa_func)
+
+
+def verify(filename: str, unsafe_func: syntax.Function, ctx: Dict[str, syntax.Function]) -> smt.VerificationResult:
+    dsa_func = make_dsa(filename, unsafe_func, ctx)
+    simple_func = simplify.simplify(dsa_func)
+    prog = assume_prove.compact_prog(assume_prove.slice_prog(
+        simple_func, assume_prove.make_prog(simple_func)))
+    sats = tuple(smt.send_smtlib(smt.Query(prog), smt.Solver.Z3))
     return smt.parse_sats(sats)
 
 
 def do_test(filename: str, func: syntax.Function, ctx: Dict[str, syntax.Function]) -> None:
-    suffix = func.name.split('.')[-1]
-    should_fail = False
-    should_fail = should_fail or '_fail_' in suffix
-    should_fail = should_fail or suffix.endswith('_fail')
-    should_fail = should_fail or suffix.startswith('fail_')
-    should_fail = should_fail or '_fails_' in suffix
-    should_fail = should_fail or suffix.endswith('_fails')
-    should_fail = should_fail or suffix.startswith('fails_')
-
-    result = verify(filename, func, ctx)
-    if should_fail:
-        assert result is smt.VerificationResult.FAIL
-    else:
-        assert result is smt.VerificationResult.OK
+    assert verify(filename, func, ctx) is batch.expected_result(func.name)
+
+
+def assert_cfg_matches_nodes(func: source.GhostlessFunction[Any, Any]) -> None:
+    """ the cfg (updated incrementally by the passes) is the one we would
+        get by recomputing it from the nodes
+    """
+    all_succs = abc_cfg.compute_all_successors_from_nodes(func.nodes)
+    cfg = abc_cfg.compute_cfg_from_all_succs(all_succs, func.cfg.entry)
+    assert list(func.cfg.all_succs.items()) == list(cfg.all_succs.items())
+    assert list(func.cfg.all_preds.items()) == list(cfg.all_preds.items())
+    assert func.cfg.dominator_tree.idom == cfg.dominator_tree.idom
+    assert func.cfg.back_edges == cfg.back_edges
+    assert func.cfg.indexed == cfg.indexed
+
+    for lh, loop in func.loops.items():
+        assert loop.back_edge in cfg.back_edges
+        assert set(loop.nodes) == set(
+            abc_cfg.compute_natural_loop(cfg, loop.back_edge))
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_incremental_cfg(func_name: str) -> None:
+    unsafe_func = test_CFunctions[1][func_name]
+    prog_func = source.convert_function(unsafe_func).with_ghost(
+        ghost_data.get('tests/all.c', unsafe_func.name))
+    nip_func = nip.nip(prog_func)
+    assert_cfg_matches_nodes(nip_func)
+    ghost_func = ghost_code.sprinkle_ghost_code(
+        'tests/all.c', nip_func, test_CFunctions[1])
+    assert_cfg_matches_nodes(ghost_func)
+    split_func = split_prove_nodes.split_prove_nodes(ghost_func)
+    assert_cfg_matches_nodes(split_func)
+    assert_cfg_matches_nodes(dsa.dsa(split_func))
+
+    # dsa keeps its own loop targets, the others are the variables assigned in
+    # the loop
+    for func in (nip_func, ghost_func, split_func):
+        loops = abc_cfg.compute_loops(func.nodes, func.cfg)
+        assert {lh: set(loop.targets) for lh, loop in loops.items()} == {
+            lh: set(loop.targets) for lh, loop in func.loops.items()}
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_topological_order(func_name: str) -> None:
+    unsafe_func = test_CFunctions[1][func_name]
+    func = nip.nip(source.convert_function(unsafe_func).with_ghost(
+        ghost_data.get('tests/all.c', unsafe_func.name)))
+    order = func.topological_order
+    assert func.topological_order is order, "computed once"
+    assert sorted(order) == sorted(func.cfg.all_succs)
+
+    position = func.topological_position
+    bottom_up = {n: i for i, n in enumerate(
+        func.topological_order_bottom_up)}
+    for n in func.cfg.all_succs:
+        assert order[position[n]] == n
+        for succ in func.cfg.acyclic_succs_of(n):
+            assert position[n] < position[succ]
+            assert bottom_up[succ] < bottom_up[n]
 
 
 @pytest.mark.parametrize('func_name', example_dsa_CFunctions[1].keys())
@@ -63,7 +126,294 @@ def test_dsa(func_name: str) -> None:
             example_dsa_CFunctions[1][func_name], example_dsa_CFunctions[1])
 
 
+example_dsa_failing = [name for name in example_dsa_CFunctions[1]
+                       if batch.expected_result(name) is smt.VerificationResult.FAIL]
+
+
+@pytest.mark.parametrize('localisation', error_reporting.Localisation)
+@pytest.mark.parametrize('func_name', example_dsa_failing)
+def test_localisation(func_name: str, localisation: error_reporting.Localisation) -> None:
+    # each of these functions fails in one place only, so every strategy
+    # (bisecting too) must find the same node as walking the CFG and
+    # rebuilding the query for every question
+    dsa_func = make_dsa(
+        'examples/dsa.c', example_dsa_CFunctions[1][func_name], example_dsa_CFunctions[1])
+    reason, node_name, _ = error_reporting.debug_func_smt(
+        dsa_func, [], error_reporting.Localisation.REBUILD)
+    found_reason, found_node_name, _ = error_reporting.debug_func_smt(
+        dsa_func, [], localisation)
+    assert (found_reason, found_node_name) == (reason, node_name)
+
+
+@pytest.mark.parametrize('func_name', example_dsa_failing)
+def test_oracles(func_name: str) -> None:
+    dsa_func = make_dsa(
+        'examples/dsa.c', example_dsa_CFunctions[1][func_name], example_dsa_CFunctions[1])
+    prog = assume_prove.compact_prog(assume_prove.make_prog(dsa_func))
+    assert len(prog.merged_into) > 0
+
+    order = list(dsa_func.traverse_topologically(skip_err_and_ret=True))
+    # the incremental oracle keeps the program declared in its session
+    with smt.solver_pool.session(smt.Solver.Z3) as rebuilding_session, smt.solver_pool.session(smt.Solver.Z3) as session:
+        rebuilding = error_reporting.RebuildingOracle(
+            prog, [], rebuilding_session)
+        incremental = error_reporting.IncrementalOracle(prog, session)
+        try:
+            for i in range(len(order) + 1):
+                assert incremental.ask(order[i:]) == rebuilding.ask(order[i:])
+            # the nodes merged into their predecessor were defined on demand
+            assert len(incremental.defined) > 0
+        finally:
+            incremental.close()
+
+
 @pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
 def test_main(func_name: str) -> None:
     do_test('tests/all.c', test_CFunctions[1]
             [func_name], test_CFunctions[1])
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_split_obligations(func_name: str) -> None:
+    # splitting the obligations must neither lose nor invent failures
+    dsa_func, prog = make_prog(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+    result, _ = split_obligations.verify_split(
+        dsa_func, prog, [], smt.Solver.Z3, jobs=2)
+    assert result is verify(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+
+
+def test_shared_subterms_are_defined_once() -> None:
+    def var(name: str) -> source.ExprVarT[assume_prove.VarName]:
+        return source.ExprVar(source.type_word64, assume_prove.VarName(name))
+
+    a, b = var('a'), var('b')
+    added = source.ExprOp(source.type_word64,
+                          source.Operator.PLUS, (a, b))
+    product = source.ExprOp(source.type_word64,
+                            source.Operator.TIMES, (added, added))
+    lhs = source.ExprOp(source.type_bool,
+                        source.Operator.EQUALS, (product, a))
+    rhs = source.ExprOp(source.type_bool,
+                        source.Operator.LESS, (b, product))
+    alone = source.ExprOp(source.type_bool, source.Operator.EQUALS, (a, b))
+
+    definitions, (new_lhs, new_rhs, new_alone) = smt.share_subterms(
+        [lhs, rhs, alone])
+    assert [smt.emit_cmd(cmd) for cmd in definitions] == [
+        '(define-fun shared%0 () (_ BitVec 64) (bvadd a b))',
+        '(define-fun shared%1 () (_ BitVec 64) (bvmul shared%0 shared%0))',
+    ]
+    assert smt.emit_expr(new_lhs) == '(= shared%1 a)'
+    assert smt.emit_expr(new_rhs) == '(bvult b shared%1)'
+    assert new_alone is alone, "nothing to share"
+
+
+@pytest.mark.parametrize('func_name', ['tmp.arith_sum', 'tmp.ghost_add_1__fail'])
+def test_streamed_query(func_name: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    _, prog = make_prog(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+    query = smt.Query(prog)
+    sink = io.StringIO()
+    query.write(sink)
+    assert sink.getvalue() == smt.make_smtlib(prog, [])
+
+    output = smt.run_solver(query, smt.Solver.Z3)
+    assert output is not None
+    with smt.solver_pool.session(smt.Solver.Z3) as session:
+        assert smt.run_solver_uncached(
+            query, smt.Solver.Z3, session) == output
+
+    # without a cache, the query goes straight to the solver's stdin
+    monkeypatch.setattr(smt, 'query_cache', None)
+    assert smt.run_solver(query, smt.Solver.Z3) == output
+
+
+def test_query_cache(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    monkeypatch.setattr(smt, 'query_cache', disk_cache.DiskCache(
+        str(tmp_path), max_bytes=1024 * 1024))
+    _, prog = make_prog(
+        'tests/all.c', test_CFunctions[1]['tmp.arith_sum'], test_CFunctions[1])
+    query = smt.Query(prog)
+
+    emitted = 0
+    cmds = smt.Query.cmds
+
+    def counting_cmds(self: smt.Query) -> list[smt.Cmd]:
+        nonlocal emitted
+        emitted += 1
+        return cmds(self)
+    monkeypatch.setattr(smt.Query, 'cmds', counting_cmds)
+
+    # hashed on its way to the solver, and cached
+    output = smt.run_solver(query, smt.Solver.Z3)
+    assert output is not None
+    assert emitted == 1
+    [entry] = os.listdir(tmp_path)
+
+    # a hit returns the cached output (not what the solver would say)
+    (tmp_path / entry).write_bytes(b'cached\n')
+    assert smt.run_solver(query, smt.Solver.Z3) == 'cached\n'
+    assert emitted == 2
+
+    # in a session, the query's key is only known once it has run: it isn't
+    # cached
+    (tmp_path / entry).unlink()
+    with smt.solver_pool.session(smt.Solver.Z3) as session:
+        assert smt.run_solver(query, smt.Solver.Z3, session) == output
+    assert emitted == 3
+    assert os.listdir(tmp_path) == []
+
+
+def test_solver_output_is_read_while_writing() -> None:
+    # much more output than a pipe holds, while the query is still being
+    # written
+    n = 50000
+    query = smt.SMTLIB(smt.make_smtlib_prelude(()) + '(check-sat)\n' * n)
+    assert smt.run_solver_uncached(query, smt.Solver.Z3) == 'sat\n' * n
+    with smt.solver_pool.session(smt.Solver.Z3) as session:
+        assert smt.run_solver_uncached(
+            query, smt.Solver.Z3, session) == 'sat\n' * n
+
+
+def test_solver_session() -> None:
+    prelude = smt.make_smtlib_prelude(())
+    queries: list[smt.SMTLIB | smt.Query] = [
+        smt.SMTLIB(
+            prelude + '(declare-fun x () (_ BitVec 8))\n(assert (= x #x01))\n(check-sat)\n'),
+        # fails if the previous query's x is still declared
+        smt.SMTLIB(
+            prelude + '(declare-fun x () (_ BitVec 8))\n(assert (= x #x02))\n(assert (= x #x01))\n(check-sat)\n'),
+    ]
+    for func_name in ('tmp.arith_sum', 'tmp.ghost_add_1__fail'):
+        _, prog = make_prog(
+            'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+        # both programs declare the same node_ok variables
+        queries.append(smt.Query(prog))
+
+    session = smt.SolverSession(smt.Solver.Z3)
+    try:
+        outputs = []
+        for query in queries:
+            output = session.run(query)
+            assert output is not None
+            # the same answers as a fresh solver
+            assert output == smt.run_solver_uncached(query, smt.Solver.Z3)
+            assert session.depth == 0
+            outputs.append(output)
+    finally:
+        session.close()
+    assert outputs[:2] == ['sat\n', 'unsat\n']
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_compact_prog(func_name: str) -> None:
+    dsa_func, prog = make_prog(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+    compact = assume_prove.compact_prog(prog)
+
+    removed = compact.aliases.keys() | compact.merged_into.keys()
+    assert len(removed) + len(compact.nodes_script) == len(prog.nodes_script)
+    for script in compact.nodes_script.values():
+        for ins in script:
+            assert all(var.name not in removed for var in source.all_vars_in_expr(
+                ins.expr)), "uses a removed node_ok variable"
+
+    def sats(prog: assume_prove.AssumeProveProg, assert_ok_nodes: list[source.NodeName]) -> tuple[smt.CheckSatResult, ...]:
+        return tuple(smt.send_smtlib(smt.Query(prog, assert_ok_nodes=assert_ok_nodes), smt.Solver.Z3))
+
+    # the error reporting can still assume any node is ok
+    nodes = list(dsa_func.traverse_topologically(skip_err_and_ret=True))
+    for assert_ok_nodes in ([], nodes[len(nodes) // 2:], nodes[-1:]):
+        assert sats(compact, assert_ok_nodes) == sats(prog, assert_ok_nodes)
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_weakest_preconditions(func_name: str) -> None:
+    _, prog = make_prog(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+    compact = assume_prove.compact_prog(prog)
+
+    for name, script in compact.nodes_script.items():
+        wps = assume_prove.weakest_preconditions(script)
+        assert len(wps) == len(script) + 1
+        for i in range(len(script) + 1):
+            assert wps[i] is assume_prove.apply_weakest_precondition(
+                script[i:])
+            assert compact.weakest_precondition(name, i) is wps[i]
+
+    # computed once, node_ok_expr reuses them
+    assert compact.suffix_weakest_preconditions is compact.suffix_weakest_preconditions
+    for name, (into, i) in compact.merged_into.items():
+        assert compact.node_ok_expr(
+            name) is compact.suffix_weakest_preconditions[into][i]
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_slice_prog(func_name: str) -> None:
+    dsa_func, prog = make_prog(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+    sliced = assume_prove.slice_prog(dsa_func, prog)
+
+    dropped: set[assume_prove.VarName] = set()
+    for name, script in prog.nodes_script.items():
+        kept = sliced.nodes_script[name]
+        for ins in script:
+            if ins not in kept:
+                var = assume_prove.defined_variable(dsa_func, ins)
+                assert var is not None, "only definitions are dropped"
+                dropped.add(var.name)
+
+    for script in sliced.nodes_script.values():
+        for ins in script:
+            assert all(var.name not in dropped for var in source.all_vars_in_expr(
+                ins.expr)), "uses a variable whose definition was dropped"
+
+    assert tuple(smt.send_smtlib(smt.Query(sliced), smt.Solver.Z3)) == tuple(
+        smt.send_smtlib(smt.Query(prog), smt.Solver.Z3))
+
+
+def test_simplify_expr() -> None:
+    x = source.ExprVar(source.type_word32, 'x')
+    b = source.ExprVar(source.type_bool, 'b')
+
+    def num(n: int) -> source.ExprT[str]:
+        return source.ExprNum(source.type_word32, n)
+
+    assert simplify.simplify_expr(source.expr_plus(
+        num(0xffffffff), num(2))) is num(1)
+    assert simplify.simplify_expr(source.expr_slt(
+        num(0xffffffff), num(0))) is source.expr_true
+    assert simplify.simplify_expr(source.expr_udiv(
+        x, num(0))) is source.expr_udiv(x, num(0)), "division by zero isn't folded"
+    assert simplify.simplify_expr(source.expr_plus(x, num(0))) is x
+    assert simplify.simplify_expr(source.expr_and(
+        b, source.expr_eq(x, x))) is b
+    assert simplify.simplify_expr(source.expr_implies(
+        source.expr_ult(num(1), num(2)), b)) is b
+    assert simplify.simplify_expr(source.expr_ite(
+        b, source.expr_false, source.expr_true)) is source.expr_negate(b)
+    assert simplify.simplify_expr(
+        x, lambda v: num(3) if v is x else v) is num(3)
+
+
+@pytest.mark.parametrize('func_name', test_CFunctions[1].keys())
+def test_simplify(func_name: str) -> None:
+    dsa_func = make_dsa(
+        'tests/all.c', test_CFunctions[1][func_name], test_CFunctions[1])
+    simple_func = simplify.simplify(dsa_func)
+    assert simple_func.cfg is dsa_func.cfg
+    assert all(type(simple_func.nodes[n]) is type(node)
+               for n, node in dsa_func.nodes.items())
+
+    propagated = simplify.propagated_definitions(dsa_func)
+    for node in simple_func.nodes.values():
+        assert not any(var in propagated for var in source.used_variables_in_node(
+            node)), "uses a variable which was propagated"
+
+    prog = assume_prove.make_prog(dsa_func)
+    simple_prog = assume_prove.slice_prog(
+        simple_func, assume_prove.make_prog(simple_func))
+    assert tuple(smt.send_smtlib(smt.Query(simple_prog), smt.Solver.Z3)) == tuple(
+        smt.send_smtlib(smt.Query(prog), smt.Solver.Z3))
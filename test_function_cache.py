@@ -0,0 +1,52 @@
+import smt
+import syntax
+from function_cache import function_key, is_test_module
+
+syntax.set_arch('rv64')
+
+
+def keys(lines: list[str]) -> dict[str, str]:
+    _, functions, _ = syntax.parse_and_install_all(lines, None)
+    return {name: function_key('tests/all.txt', func, functions, [], smt.Solver.Z3, split_prove_conjunctions=False) for name, func in functions.items()}
+
+
+def test_function_key() -> None:
+    with open('tests/all.txt') as f:
+        lines = f.readlines()
+
+    before = keys(lines)
+    assert keys(lines) == before
+
+    # changes the body of tmp.caller, but not its header
+    body = "Op Times Word 32 2 Var ret__int#v Word 32 Num 2 Word 32"
+    i = next(i for i, line in enumerate(lines) if body in line)
+    lines[i] = lines[i].replace(body, body.replace("Num 2", "Num 3"))
+    after = keys(lines)
+
+    assert after['tmp.caller'] != before['tmp.caller']
+    # only depends on the header of tmp.caller
+    assert after['tmp.caller2'] == before['tmp.caller2']
+    assert after['tmp.callee'] == before['tmp.callee']
+
+
+def test_const_globals() -> None:
+    with open('tests/all.txt') as f:
+        lines = f.readlines()
+
+    # tmp.caller multiplies by a constant global instead of by 2
+    body = "Op Times Word 32 2 Var ret__int#v Word 32 Num 2 Word 32"
+    i = next(i for i, line in enumerate(lines) if body in line)
+    lines[i] = lines[i].replace(
+        body, body.replace("Num 2", "ConstGlobal tmp.factor"))
+    before = keys(['ConstGlobalDef tmp.factor Num 2 Word 32\n'] + lines)
+    after = keys(['ConstGlobalDef tmp.factor Num 3 Word 32\n'] + lines)
+
+    assert after['tmp.caller'] != before['tmp.caller']
+    assert after['tmp.callee'] == before['tmp.callee']
+
+
+def test_tests_are_not_part_of_the_tool() -> None:
+    # editing a test doesn't throw away every cached result
+    assert is_test_module('/src/test_function_cache.py')
+    assert is_test_module('conftest.py')
+    assert not is_test_module('/src/function_cache.py')
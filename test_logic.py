@@ -0,0 +1,35 @@
+import logic
+
+
+def test_binary_search_least() -> None:
+    # the least n from which the test is true, None if it's never true
+    assert logic.binary_search_least(lambda n: n >= 2, 0, 3) == 2
+    assert logic.binary_search_least(lambda n: n >= 0, 0, 3) == 0
+    assert logic.binary_search_least(lambda n: n >= 3, 0, 3) == 3
+    assert logic.binary_search_least(lambda n: False, 0, 3) is None
+    assert logic.binary_search_least(lambda n: True, 5, 5) == 5
+    assert logic.binary_search_least(lambda n: False, 5, 5) is None
+
+    for minimum in range(4):
+        for maximum in range(minimum, 10):
+            for threshold in range(minimum, maximum + 2):
+                expected = threshold if threshold <= maximum else None
+                assert logic.binary_search_least(
+                    lambda n: n >= threshold, minimum, maximum) == expected
+
+
+def test_binary_search_greatest() -> None:
+    # the greatest n up to which the test is true, None if it's never true
+    assert logic.binary_search_greatest(lambda n: n <= 1, 0, 3) == 1
+    assert logic.binary_search_greatest(lambda n: n <= 0, 0, 3) == 0
+    assert logic.binary_search_greatest(lambda n: n <= 3, 0, 3) == 3
+    assert logic.binary_search_greatest(lambda n: False, 0, 3) is None
+    assert logic.binary_search_greatest(lambda n: True, 5, 5) == 5
+    assert logic.binary_search_greatest(lambda n: False, 5, 5) is None
+
+    for minimum in range(4):
+        for maximum in range(minimum, 10):
+            for threshold in range(minimum - 1, maximum + 1):
+                expected = threshold if threshold >= minimum else None
+                assert logic.binary_search_greatest(
+                    lambda n: n <= threshold, minimum, maximum) == expected
@@ -117,7 +117,8 @@ def ensure_correspondence(prog_func: source.Function, nip_func: nip.Function) ->
     assert len(prog_func.nodes) + num_nip_nodes == len(nip_func.nodes)
 
 
-def ensure_guard_and_state_update_correctness(nip_func: nip.Function) -> None:
+def ensure_guard_and_state_update_correctness(prog_func: source.Function, nip_func: nip.Function) -> None:
+    initialised = nip.compute_initialised(prog_func)
     for n in nip_func.traverse_topologically():
         if n in (source.NodeNameRet, source.NodeNameErr):
             continue
@@ -128,7 +129,14 @@ def ensure_guard_and_state_update_correctness(nip_func: nip.Function) -> None:
 
         used_variables = set(v for v in source.used_variables_in_node(
             node) if not source.is_loop_counter_name(v.name))
-        if len(used_variables) > 0:
+        # the variables which are statically known to be initialised aren't
+        # checked
+        used_variables -= nip.statically_checked(prog_func, initialised,
+                                                 n, cast(Set[source.ProgVar], used_variables))
+        if len(used_variables) == 0:
+            assert not any(isinstance(nip_func.nodes.get(pred), nip.NodeGuard)
+                           for pred in nip_func.cfg.all_preds[n])
+        else:
             preds = nip_func.cfg.all_preds[n]
             assert len(preds) == 1, f'{n=} {preds=}'
             guard = nip_func.nodes[preds[0]]
@@ -151,9 +159,14 @@ def ensure_guard_and_state_update_correctness(nip_func: nip.Function) -> None:
             assert set(source.expr_split_conjuncts(guard.expr)) == set(
                 (nip.guard_var(v) for v in used_prog_variables if not source.is_loop_counter_name(v.name)))
 
+        # the guard variables which nothing reads aren't updated
         assigned_variables = set(v for v in source.assigned_variables_in_node(
-            nip_func, n, with_loop_targets=False) if not source.is_loop_counter_name(v.name))
-        if len(assigned_variables) > 0:
+            nip_func, n, with_loop_targets=False) if not source.is_loop_counter_name(v.name) and nip.guard_var(cast(source.ProgVar, v)) in nip_func.variables)
+        if len(assigned_variables) == 0:
+            # (the entry is followed by the initial state)
+            assert n == nip_func.cfg.entry or not any(isinstance(nip_func.nodes.get(succ), nip.NodeStateUpdate)
+                                                      for succ in nip_func.cfg.all_succs[n])
+        else:
             succs = nip_func.cfg.all_succs[n]
             assert len(succs) == 1, f'{n=} {succs=}'
             upd_node = nip_func.nodes[succs[0]]
@@ -182,7 +195,7 @@ def do_nip_test(func: syntax.Function) -> None:
     prog_func = source.convert_function(func).with_ghost(None)
     nip_func = nip.nip(prog_func)
     ensure_correspondence(prog_func, nip_func)
-    ensure_guard_and_state_update_correctness(nip_func)
+    ensure_guard_and_state_update_correctness(prog_func, nip_func)
 
 
 @pytest.mark.parametrize('func', (f for f in example_test_CFunctions[1].values() if f.entry is not None))
@@ -197,3 +210,33 @@ def test_nip_kernel_functions(func: syntax.Function) -> None:
         pytest.skip("loop headers change during transformation, not supported")
 
     do_nip_test(func)
+
+
+def test_only_possibly_uninitialised_variables_are_checked() -> None:
+    def guarded_variables(name: str) -> set[source.ExprVarT[nip.GuardVarName]]:
+        func = example_test_CFunctions[1][name]
+        nip_func = nip.nip(source.convert_function(func).with_ghost(None))
+        return set(v for node in nip_func.nodes.values() if isinstance(node, nip.NodeGuard)
+                   for v in source.all_vars_in_expr(node.expr))
+
+    # the argument is initialised
+    assert guarded_variables('tmp.signed_cast') == set()
+    # a is never assigned
+    assert {v.name for v in guarded_variables(
+        'tmp.used_undefined_variable1__fail')} == {'a___int#v#assigned'}
+    assert {v.name for v in guarded_variables(
+        'tmp.used_undefined_variable3__ok')} == {'a___int#v#assigned'}
+
+
+@pytest.mark.parametrize('func_name', ['tmp.arith_sum', 'tmp.signed_cast', 'tmp.special_call__fail'])
+def test_parameters_stay_initialised(func_name: str) -> None:
+    # including the ones the body never mentions (Mem, HTD, ...), and
+    # around the loops
+    func = source.convert_function(
+        example_test_CFunctions[1][func_name]).with_ghost(None)
+    initialised = nip.compute_initialised(func)
+    parameters = set(p for p in func.signature.parameters
+                     if not source.is_loop_counter_name(p.name))
+    assert len(parameters) > 0
+    for n in func.nodes:
+        assert initialised.variables(n, parameters) == parameters
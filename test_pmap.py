@@ -0,0 +1,66 @@
+import random
+
+from pmap import PMap
+
+
+class Key:
+    """ A key with a chosen hash, to force collisions """
+
+    def __init__(self, name: int, h: int):
+        self.name = name
+        self.h = h
+
+    def __hash__(self) -> int:
+        return self.h
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Key) and other.name == self.name
+
+
+def test_set_is_persistent() -> None:
+    empty: PMap[str, int] = PMap()
+    a = empty.set('a', 1)
+    b = a.set('b', 2)
+    c = b.set('a', 3)
+    assert dict(empty) == {}
+    assert dict(a) == {'a': 1}
+    assert dict(b) == {'a': 1, 'b': 2}
+    assert dict(c) == {'a': 3, 'b': 2}
+    assert len(c) == 2
+    assert 'b' in c and 'c' not in c
+    assert c.get('c') is None
+    assert b.set('a', 1) is b, "setting the same value doesn't copy anything"
+
+
+def test_matches_dict() -> None:
+    rng = random.Random(0)
+    # a few hashes are shared by many keys, some differ only in the top bits
+    hashes = {name: rng.choice([rng.getrandbits(64), rng.randint(0, 3), rng.getrandbits(64) | (1 << 63)])
+              for name in range(100)}
+
+    for _ in range(50):
+        expected: dict[Key | int, float] = {}
+        m: PMap[Key | int, float] = PMap()
+        snapshots: list[tuple[PMap[Key | int, float],
+                              dict[Key | int, float]]] = []
+        for _ in range(rng.randint(0, 300)):
+            name = rng.randint(0, 99)
+            key: Key | int = Key(
+                name, hashes[name]) if rng.random() < 0.5 else name
+            value = rng.random()
+            snapshots.append((m, dict(expected)))
+            m = m.set(key, value)
+            expected[key] = value
+
+        assert m == expected
+        assert len(m) == len(expected)
+        assert Key(1000, 3) not in m
+        for old, old_expected in snapshots:
+            assert old == old_expected
+
+
+def test_constructor_and_update() -> None:
+    m = PMap({'a': 1, 'b': 2})
+    assert m == PMap([('a', 1), ('b', 2)])
+    assert dict(m.update({'b': 3, 'c': 4})) == {'a': 1, 'b': 3, 'c': 4}
+    assert dict(m) == {'a': 1, 'b': 2}
@@ -200,6 +200,84 @@ def test_is_not_reducible(all_succs: Mapping[source.NodeName, Sequence[source.No
         compute_cfg_from_all_succs(all_succs, source.NodeName("_start")))
 
 
+def test_reachable_from() -> None:
+    all_succs = {"_start": ["a"], "a": ["b", "c"],
+                 "b": ["a"], "c": [], "dead": ["c"]}
+    cfg = compute_cfg_from_all_succs(cast(Mapping[source.NodeName, Sequence[source.NodeName]], all_succs),
+                                     source.NodeName("_start"))
+    assert cfg.reachable_from(source.NodeName("_start")) == {
+        "_start", "a", "b", "c"}
+    assert cfg.reachable_from(source.NodeName("b")) == {"a", "b", "c"}
+    assert cfg.reachable_from(source.NodeName("dead")) == {"dead", "c"}
+
+
+def reference_dominators(all_succs: Mapping[str, Sequence[str]]) -> dict[str, set[str]]:
+    """ the textbook fixpoint """
+    all_preds: dict[str, list[str]] = {n: [] for n in all_succs}
+    for n, succs in all_succs.items():
+        for succ in succs:
+            all_preds[succ].append(n)
+
+    doms = {n: {n} if len(all_preds[n]) == 0 else set(all_succs)
+            for n in all_succs}
+    changed = True
+    while changed:
+        changed = False
+        for n in all_succs:
+            if all_preds[n]:
+                new = set.intersection(
+                    *(doms[p] for p in all_preds[n])) | {n}
+                changed = changed or new != doms[n]
+                doms[n] = new
+    return doms
+
+
+@pytest.mark.parametrize("all_succs", [
+    # diamond in a loop
+    {"_start": ["a"], "a": ["b", "c"], "b": ["d"],
+        "c": ["d"], "d": ["a", "e"], "e": []},
+    # irreducible
+    {"_start": ["a", "b"], "a": ["b"], "b": ["a"]},
+    # unreachable nodes, with and without predecessors
+    {"_start": ["a"], "a": [], "dead": ["a", "dead2"],
+        "dead2": [], "cycle1": ["cycle2"], "cycle2": ["cycle1", "a"]},
+])
+def test_dominators(all_succs: Mapping[str, Sequence[str]]) -> None:
+    cfg = compute_cfg_from_all_succs(cast(Mapping[source.NodeName, Sequence[source.NodeName]], all_succs),
+                                     source.NodeName("_start"))
+    expected = reference_dominators(all_succs)
+    for b in all_succs:
+        assert set(cfg.all_doms[source.NodeName(b)]) == expected[b]
+        for a in all_succs:
+            assert cfg.dominates(source.NodeName(a), source.NodeName(
+                b)) == (a in expected[b])
+
+
+def test_indexed_cfg() -> None:
+    all_succs = {"_start": ["a"], "a": ["b", "c"], "b": ["d"],
+                 "c": ["d"], "d": ["a", "e"], "e": []}
+    cfg = compute_cfg_from_all_succs(cast(Mapping[source.NodeName, Sequence[source.NodeName]], all_succs),
+                                     source.NodeName("_start"))
+    g = cfg.indexed
+    assert list(g.names) == list(all_succs)
+    for n, succs in cfg.all_succs.items():
+        i = g.ids[n]
+        assert [g.names[j]
+                for j in g.succ[g.succ_start[i]:g.succ_start[i + 1]]] == succs
+        assert [g.names[j] for j in g.pred[g.pred_start[i]                                           :g.pred_start[i + 1]]] == cfg.all_preds[n]
+        for succ in succs:
+            assert cfg.is_back_edge(n, succ) == ((n, succ) in cfg.back_edges)
+    assert cfg.is_back_edge(source.NodeName("d"), source.NodeName("a"))
+    assert cfg.acyclic_succs_of(source.NodeName("d")) == ["e"]
+    assert cfg.acyclic_preds_of(source.NodeName("a")) == ["_start"]
+
+    order = [g.names[i] for i in g.topological_order()]
+    assert order[0] == "_start" and order[-1] == "e"
+    assert set(order) == set(all_succs)
+    bottom_up = [g.names[i] for i in g.topological_order_bottom_up()]
+    assert bottom_up[0] == "e" and bottom_up[-1] == "_start"
+
+
 with open('examples/kernel_CFunctions.txt') as f:
     kernel_C = syntax.parse_and_install_all(f, None)
 
@@ -1,3 +1,5 @@
+import copy
+import pickle
 from typing import Sequence
 import pytest
 import source
@@ -243,3 +245,23 @@ if __name__ == "__main__":
     expr = parse_full_sexpr("(Plus (Minus 2 a:w32) 1)")
     print(expr)
     print(source.pretty_expr_ascii(expr))
+
+
+def test_expressions_are_interned() -> None:
+    x = source.ExprVar(w64, 'x')
+    e = source.ExprOp(w64, ops.PLUS, (x, source.ExprNum(w64, 1)))
+    assert source.ExprOp(w64, ops.PLUS, (source.ExprVar(w64, 'x'),
+                                         source.ExprNum(w64, 1))) is e
+    assert source.ExprOp(bol, ops.TRUE, ()) is source.expr_true
+    symbol: source.ExprT[str] = source.ExprSymbol(w64, 'x')
+    assert symbol is not source.ExprVar(w64, 'x')
+    assert source.ExprNum(w32, 1) != source.ExprNum(w64, 1)
+
+    # same hash as the structural dataclass one
+    assert hash(x) == hash((w64, 'x'))
+
+    f = source.ExprFunction(w64, source.FunctionName('f'), [x])
+    assert source.ExprFunction(w64, source.FunctionName('f'), (x,)) is f
+
+    assert pickle.loads(pickle.dumps(e)) is e
+    assert copy.deepcopy(e) is e
@@ -0,0 +1,23 @@
+import syntax
+
+syntax.set_arch('rv64')
+
+
+def test_lazy_parse() -> None:
+    with open('tests/all.txt') as f:
+        lines = f.readlines()
+
+    _, eager, _ = syntax.parse_all(lines)
+    _, lazy, _ = syntax.parse_all(lines, lazy=True)
+    assert lazy.keys() == eager.keys()
+
+    for name in eager:
+        func = lazy[name]
+        assert isinstance(func, syntax.LazyFunction)
+        assert func.serialise_header() == eager[name].serialise_header()
+        assert 'nodes' not in func.__dict__
+
+        assert func.node_count() == len(eager[name].nodes)
+        assert func.serialise() == eager[name].serialise()
+        assert func.entry == eager[name].entry
+        assert func.node_count() == len(eager[name].nodes)
@@ -5,6 +5,7 @@ import source
 import nip
 import ghost_code
 import dsa
+from pmap import PMap
 
 
 def compute_all_path(cfg: abc_cfg.CFG) -> Sequence[Sequence[source.NodeName]]:
@@ -19,13 +20,13 @@ def compute_all_path(cfg: abc_cfg.CFG) -> Sequence[Sequence[source.NodeName]]:
         if len(succs) == 0:
             return
 
-        if len(succs) == 1 and (n, succs[0]) not in cfg.back_edges:
+        if len(succs) == 1 and not cfg.is_back_edge(n, succs[0]):
             dfs(succs[0])
             return
 
         path_so_far = list(all_paths[-1])
         for i, succ in enumerate(succs):
-            if (n, succ) not in cfg.back_edges:
+            if not cfg.is_back_edge(n, succ):
                 if i > 0:
                     all_paths.append(path_so_far)
                 dfs(succ)
@@ -37,6 +38,117 @@ def compute_all_path(cfg: abc_cfg.CFG) -> Sequence[Sequence[source.NodeName]]:
     return all_paths
 
 
+def count_paths(cfg: abc_cfg.CFG) -> int:
+    """ Number of paths from the roots to the sinks (ignoring back edges),
+        without enumerating them
+    """
+    g = cfg.indexed
+    paths = [0] * len(g.names)
+    total = 0
+    for i in g.topological_order():
+        if g.pred_start[i] == g.pred_start[i + 1]:
+            paths[i] = 1
+        for succ in g.acyclic_succs(i):
+            paths[succ] += paths[i]
+        if len(g.acyclic_succs(i)) == 0:
+            total += paths[i]
+    return total
+
+
+def assigned_variables_in_order(func: dsa.Function, n: source.NodeName) -> list[dsa.Var[source.ProgVarName | nip.GuardVarName]]:
+    """ with the duplicates (unlike source.assigned_variables_in_node, which
+        would hide them from us)
+    """
+    assigned_variables: list[dsa.Var[source.ProgVarName |
+                                     nip.GuardVarName]] = []
+    node = func.nodes[n]
+    if isinstance(node, source.NodeBasic):
+        assigned_variables.extend(upd.var for upd in node.upds)
+    elif isinstance(node, source.NodeCall):
+        assigned_variables.extend(ret for ret in node.rets)
+    elif not isinstance(node, source.NodeEmpty | source.NodeCond | source.NodeAssume | source.NodeAssert):
+        assert_never(node)
+
+    if loop_header := func.is_loop_header(n):
+        assigned_variables.extend(func.loops[loop_header].targets)
+    return assigned_variables
+
+
+def ensure_assigned_at_most_once_on_all_paths(func: dsa.Function) -> None:
+    """ Same as ensure_assigned_at_most_once on every path, in one forward pass
+
+    For each node, we compute the set of variables which are assigned on some
+    path reaching it. The node must not assign any of them.
+    """
+    bit: dict[dsa.Var[source.ProgVarName | nip.GuardVarName], int] = {}
+    # bitset of the variables assigned on some path reaching the end of the node
+    assigned_out: dict[source.NodeName, int] = {}
+    for n in func.traverse_topologically(skip_err_and_ret=True):
+        assigned_in = 0
+        for p in func.acyclic_preds_of(n):
+            assigned_in |= assigned_out[p]
+
+        assigned = assigned_variables_in_order(func, n)
+        assert len(assigned) == len(set(assigned)), f"{n=} {assigned=}"
+        for var in assigned:
+            b = 1 << bit.setdefault(var, len(bit))
+            assert not assigned_in & b, f"{var=} assigned twice on a path to {n=}"
+            assigned_in |= b
+        assigned_out[n] = assigned_in
+
+
+def ensure_using_latest_incarnation_on_all_paths(func: dsa.Function) -> None:
+    """ Same as ensure_using_latest_incarnation on every path, in one forward
+        pass
+
+    For each node, we compute the possible latest incarnations of every
+    variable (on all the paths reaching it). A node can only use an
+    incarnation if it's the only possible one (or if the variable was never
+    assigned).
+    """
+    params: PMap[source.ExprVarT[source.ProgVarName |
+                                 nip.GuardVarName], frozenset[dsa.IncarnationNum]] = PMap()
+    for arg in func.signature.parameters:
+        prog_var, inc = dsa.unpack_dsa_var(arg)
+        assert prog_var not in params
+        params = params.set(prog_var, frozenset([inc]))
+
+    latest_out: dict[source.NodeName, PMap[source.ExprVarT[source.ProgVarName |
+                                                           nip.GuardVarName], frozenset[dsa.IncarnationNum]]] = {}
+    for n in func.traverse_topologically(skip_err_and_ret=True):
+        preds = func.acyclic_preds_of(n)
+        if len(preds) == 0:
+            latest = params
+        elif len(preds) == 1:
+            latest = latest_out[preds[0]]
+        else:
+            latest = latest_out[preds[0]]
+            for p in preds[1:]:
+                for var, incs in latest_out[p].items():
+                    if var not in latest:
+                        latest = latest.set(var, incs)
+                    elif not incs <= latest[var]:
+                        latest = latest.set(var, latest[var] | incs)
+
+        # loop targets are havoc'd at the top of the loop header
+        # that is, it is legal to use them in the loop header itself
+        if loop_header := func.is_loop_header(n):
+            for target in func.loops[loop_header].targets:
+                prog_var, inc = dsa.unpack_dsa_var(target)
+                latest = latest.set(prog_var, frozenset([inc]))
+
+        for dsa_var in source.used_variables_in_node(func.nodes[n]):
+            prog_var, inc = dsa.unpack_dsa_var(dsa_var)
+            if prog_var in latest:
+                assert latest[prog_var] == {
+                    inc}, f"{prog_var=} {n=} {latest[prog_var]=}"
+
+        for dsa_var in source.assigned_variables_in_node(func, n, with_loop_targets=True):
+            prog_var, inc = dsa.unpack_dsa_var(dsa_var)
+            latest = latest.set(prog_var, frozenset([inc]))
+        latest_out[n] = latest
+
+
 def ensure_assigned_at_most_once(func: dsa.Function, path: Collection[source.NodeName]) -> None:
     """ Ensure that each variable (name, typ) is assigned at most once
     """
@@ -99,6 +211,12 @@ def ensure_using_latest_incarnation(func: dsa.Function, path: Collection[source.
 
 
 def ensure_valid_dsa(dsa_func: dsa.Function) -> None:
+    ensure_assigned_at_most_once_on_all_paths(dsa_func)
+    ensure_using_latest_incarnation_on_all_paths(dsa_func)
+
+
+def ensure_valid_dsa_exhaustive(dsa_func: dsa.Function) -> None:
+    """ Checks every path one by one (exponential, but obviously right) """
     all_paths = compute_all_path(dsa_func.cfg)
     for i, path in enumerate(all_paths):
         ensure_assigned_at_most_once(dsa_func, path)
@@ -237,19 +355,16 @@ def ensure_valid_contexts(func: dsa.Function) -> None:
             continue
         assert n not in new_contexts, f'{n=}'
 
-        conflicting_vars: set[source.ExprVarT[source.ProgVarName |
-                                              nip.GuardVarName]] = set()
+        # the predecessors only disagree on the variables which are dead (dsa
+        # doesn't join those), and then the context has the biggest
+        # incarnation. If one of them was actually used, we would catch it in
+        # ensure_using_latest_incarnation.
         new_contexts[n] = {}
         for p in func.acyclic_preds_of(n):
             assert p in new_contexts, f'{n=} {p=}'
             for var, inc in new_contexts[p].items():
-
-                if var in new_contexts[n] and new_contexts[n][var] != inc:
-                    conflicting_vars.add(var)
-
-                new_contexts[n][var] = inc
-
-        assert len(conflicting_vars) == 0
+                if var not in new_contexts[n] or new_contexts[n][var] < inc:
+                    new_contexts[n][var] = inc
 
         for v in source.assigned_variables_in_node(func, n, with_loop_targets=True):
             new_contexts[n][dsa.get_base_var(v)] = v.name.inc
@@ -305,8 +420,14 @@ def ensure_valid_variables(func: dsa.Function) -> None:
     assert len(var_types) == len(func.all_variables())
 
 
-def validate(func: ghost_code.Function, dsa_func: dsa.Function) -> None:
+def validate(func: ghost_code.Function, dsa_func: dsa.Function, exhaustive_paths: bool = False) -> None:
+    """ exhaustive_paths: also check each path on its own, to test
+        ensure_valid_dsa (the number of paths is exponential in the number of
+        branches)
+    """
     ensure_valid_variables(dsa_func)
     ensure_correspondence(func, dsa_func)
     ensure_valid_dsa(dsa_func)
+    if exhaustive_paths:
+        ensure_valid_dsa_exhaustive(dsa_func)
     ensure_valid_contexts(dsa_func)